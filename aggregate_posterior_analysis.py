@@ -58,7 +58,7 @@ def gather_posteriors(timestr_list, inject_sz_frac=None, tail_name='6_4_20', ban
             if i==0:
                 print('gdat file name is ', gdat.tail_name, ' and injected sz frac is ', gdat.inject_sz_frac)
             # print('inject sz frac is ', inject_sz_frac, ' while in gdat it is ', gdat.inject_sz_frac)
-            chain = np.load(filepath+'/chain.npz')
+            chain = load_chain(filepath)
 
             band=band_dict[gdat.bands[i]]
             sim_idxs.append(gdat.tail_name[-8:-5])
@@ -337,7 +337,7 @@ def aggregate_posterior_corner_plot(timestr_list, temp_amplitudes=True, bkgs=Tru
 	samples = []
 
 	for i, timestr in enumerate(timestr_list):
-		chain = np.load('spire_results/'+timestr+'/chain.npz')
+		chain = load_chain('spire_results/'+timestr)
 
 		if nsrcs:
 			nsrc.extend(chain['n'][n_burn_in:])
@@ -462,7 +462,7 @@ def gather_posteriors_different_amps(timestr_list, label_dict):
 		for j, timestr in enumerate(timestr_list):
 			gdat, filepath, result_path = load_param_dict(timestr, result_path='spire_results/')
 
-			chain = np.load(filepath+'/chain.npz')
+			chain = load_chain(filepath)
 
 			band=band_dict[gdat.bands[i+1]]
 
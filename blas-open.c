@@ -1,4 +1,6 @@
 #include <stdlib.h>
+#include <string.h>
+#include <math.h>
 #include <stdbool.h>
 #include "OpenBLAS/cblas.h"
 #include "i_malloc.h"
@@ -7,19 +9,75 @@
 #define max(a,b) ({ typeof (a) _a = (a); typeof (b) _b = (b); _a > _b ? _a : _b; })
 #define min(a,b) ({ typeof (a) _a = (a); typeof (b) _b = (b); _a < _b ? _a : _b; })
 
+// open-addressing table used to coalesce phonions that land on the same pixel. it is allocated once per band 
+// and reused between calls, so its size scales with the number of phonions rather than the number of pixels, 
+// and only the slots filled during a call are cleared afterwards
+typedef struct {
+    int sizetabl;   // number of slots, always a power of two
+    int shft;       // 32 - log2(sizetabl), used by the multiplicative hash
+    int numbused;
+    int* keys;      // pixel index held by each slot, -1 if the slot is empty
+    int* vals;      // row of the shortened A matrix for that pixel
+    int* used;      // slots filled during the current call
+} clib_wksp;
+
+static void clib_wksp_resz(clib_wksp* wksp, int numbphon){
+    int i, sizetabl, shft;
+    // keep the load factor at or below one half
+    sizetabl = 16; shft = 28;
+    while (sizetabl < 2*numbphon){
+        sizetabl *= 2;
+        shft--;
+    }
+    free(wksp->keys); free(wksp->vals); free(wksp->used);
+    wksp->keys = malloc(sizetabl*sizeof(int));
+    wksp->vals = malloc(sizetabl*sizeof(int));
+    wksp->used = malloc(sizetabl*sizeof(int));
+    for (i=0; i<sizetabl; i++)
+        wksp->keys[i] = -1;
+    wksp->sizetabl = sizetabl;
+    wksp->shft = shft;
+    wksp->numbused = 0;
+}
+
+void* clib_wksp_alloc(int numbphon){
+    clib_wksp* wksp = malloc(sizeof(clib_wksp));
+    wksp->keys = NULL; wksp->vals = NULL; wksp->used = NULL;
+    clib_wksp_resz(wksp, numbphon);
+    return wksp;
+}
+
+void clib_wksp_free(void* wksp){
+    clib_wksp* work = wksp;
+    if (work == NULL)
+        return;
+    free(work->keys); free(work->vals); free(work->used);
+    free(work);
+}
+
+// returns the slot holding pixel idx, or the empty slot where it should go
+static int clib_wksp_find(clib_wksp* wksp, int idx){
+    int slot = (int) (((unsigned int) idx * 2654435761u) >> wksp->shft);
+    while (wksp->keys[slot] != -1 && wksp->keys[slot] != idx)
+        slot = (slot + 1) & (wksp->sizetabl - 1);
+    return slot;
+}
+
+static void clib_wksp_clear(clib_wksp* wksp){
+    int i;
+    for (i=0; i<wksp->numbused; i++)
+        wksp->keys[wksp->used[i]] = -1;
+    wksp->numbused = 0;
+}
+
 void clib_updt_modl(int numbsidexpos, int numbsideypos,
                     float* cntpmodl, float* cntpmodlacpt, int* regiacpt,
-                    int sizeregi, int marg, int offsxpos, int offsypos, int booltile){
+                    int sizeregi, int marg, int offsxpos, int offsypos){
     
+    // regions tile the image with one extra row and column to cover the random offsets, same layout as diff2 on the Python side
     int NREGY, NREGX;
-    if (booltile > 0){
-        NREGX = (numbsidexpos / sizeregi) + 1;
-        NREGY = (numbsideypos / sizeregi) + 1;
-    }
-    else {
-        NREGX = (numbsidexpos / sizeregi);
-        NREGY = (numbsideypos / sizeregi);
-    }
+    NREGX = (numbsidexpos / sizeregi) + 1;
+    NREGY = (numbsideypos / sizeregi) + 1;
     int y0, y1, x0, x1, i, j, ii, jj;
     for (j=0 ; j < NREGY ; j++){
         y0 = max(j*sizeregi-offsypos-marg, 0);
@@ -39,17 +97,12 @@ void clib_updt_modl(int numbsidexpos, int numbsideypos,
 
 void clib_eval_llik(int numbsidexpos, int numbsideypos, 
                     float* cntpmodl, float* cntpresi, float* weig, double* chi2,
-                    int sizeregi, int marg, int offsxpos, int offsypos, int booltile){
+                    int sizeregi, int marg, int offsxpos, int offsypos){
     
+    // regions tile the image with one extra row and column to cover the random offsets, same layout as diff2 on the Python side
     int NREGY, NREGX;
-    if (booltile > 0){
-        NREGX = (numbsidexpos / sizeregi) + 1;
-        NREGY = (numbsideypos / sizeregi) + 1;
-    }
-    else {
-        NREGX = (numbsidexpos / sizeregi);
-        NREGY = (numbsideypos / sizeregi);
-    }
+    NREGX = (numbsidexpos / sizeregi) + 1;
+    NREGY = (numbsideypos / sizeregi) + 1;
     //printf("offsxpos, offsypos: %d %d\n", offsxpos, offsypos);
     
     int y0, y1, x0, x1, i, j, ii, jj;
@@ -78,38 +131,62 @@ void clib_eval_llik(int numbsidexpos, int numbsideypos,
     }
 }
 
+// adds the numbphon stamps in C, centered on pixels (x, y), to cntpmodl
+static void clib_inst_psfn(int numbsidexpos, int numbsideypos, int numbphon, int numbpixlpsfnside, float* C, int* x, int* y, float* cntpmodl){
+    int i, m, imax, j, r, jmax, rad, p, xposthis, yposthis;
+    rad = numbpixlpsfnside / 2;
+    for (p = 0 ; p < numbphon ; p++){
+	    xposthis = x[p];
+	    yposthis = y[p];
+	    imax = min(xposthis+rad, numbsidexpos-1);
+	    jmax = min(yposthis+rad, numbsideypos-1);
+	    for (j = max(yposthis-rad, 0), r = (p*numbpixlpsfnside+j-yposthis+rad)*numbpixlpsfnside ; j <= jmax ; j++, r+=numbpixlpsfnside){
+	        for (i = max(xposthis - rad, 0), m = i-xposthis+rad ; i <= imax ; i++, m++){
+                cntpmodl[j*numbsidexpos+i] += C[m+r];
+            }
+        }
+    }
+}
+
 void clib_eval_modl(int numbsidexpos, int numbsideypos, int numbphon, int numbpixlpsfnside, int numbparaspix,
                      float* A, float* B, float* C,
                      int* x, int* y, 
-                     float* cntpmodl, float* cntpresi, float* weig, double* chi2, 
-                     int sizeregi, int marg, int offsxpos, int offsypos, int booltile)
+                     float* cntpmodl, float* cntpresi, float* weig, double* chi2, void* wksp, 
+                     int sizeregi, int marg, int offsxpos, int offsypos)
 {
     
 
-    int i, m, t, imax, j, r, jmax, rad, p, xposthis, yposthis;
+    int i, p, xposthis, yposthis;
     float alpha, beta;
     int numbpixlpsfn = numbpixlpsfnside * numbpixlpsfnside;
     int numbpixl = numbsidexpos * numbsideypos;
-    rad = numbpixlpsfnside / 2;
     alpha = 1.; beta = 0.;
 
-    // save time if there are many phonions per pixel by overwriting and shorting the A matrix
-    int hash[numbsideypos*numbsidexpos];
-    for (i=0; i<numbsideypos*numbsidexpos; i++)
-        hash[i] = -1;
+    // save time if there are many phonions per pixel by overwriting and shorting the A matrix. callers that 
+    // don't hold a workspace get a temporary one
+    clib_wksp* work = wksp;
+    bool boolwkspfree = (work == NULL);
+    if (boolwkspfree)
+        work = clib_wksp_alloc(numbphon);
+    else if (work->sizetabl < 2*numbphon)
+        clib_wksp_resz(work, numbphon);
 
     int numbphonshrt = 0;
+    int slot;
     for (p = 0; p < numbphon; p++){
         xposthis = x[p];
         yposthis = y[p];
         int idx = yposthis*numbsidexpos+xposthis;
-        if (hash[idx] != -1){
+        slot = clib_wksp_find(work, idx);
+        if (work->keys[slot] != -1){
             for (i=0; i<numbparaspix; i++){
-                A[hash[idx]*numbparaspix+i] += A[p*numbparaspix+i];
+                A[work->vals[slot]*numbparaspix+i] += A[p*numbparaspix+i];
             }
         }
         else{
-            hash[idx] = numbphonshrt;
+            work->keys[slot] = idx;
+            work->vals[slot] = numbphonshrt;
+            work->used[work->numbused++] = slot;
             for (i=0; i<numbparaspix; i++)
                 A[numbphonshrt*numbparaspix+i] = A[p*numbparaspix+i];
             x[numbphonshrt] = x[p];
@@ -118,6 +195,10 @@ void clib_eval_modl(int numbsidexpos, int numbsideypos, int numbphon, int numbpi
         }
     }
     numbphon = numbphonshrt;
+    if (boolwkspfree)
+        clib_wksp_free(work);
+    else
+        clib_wksp_clear(work);
     
     //  matrix multiplication
     cblas_sgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans, 
@@ -135,19 +216,242 @@ void clib_eval_modl(int numbsidexpos, int numbsideypos, int numbphon, int numbpi
     //     }
     // }
     
-    //  loop over phonions, insert psfs into cntpmodl    
-    for (p = 0 ; p < numbphon ; p++){
-	    xposthis = x[p];
-	    yposthis = y[p];
-	    imax = min(xposthis+rad, numbsidexpos-1);
-	    jmax = min(yposthis+rad, numbsideypos-1);
-	    for (j = max(yposthis-rad, 0), r = (p*numbpixlpsfnside+j-yposthis+rad)*numbpixlpsfnside ; j <= jmax ; j++, r+=numbpixlpsfnside){
-	        for (i = max(xposthis - rad, 0), m = i-xposthis+rad ; i <= imax ; i++, m++){
-                cntpmodl[j*numbsidexpos+i] += C[m+r];
+    //  loop over phonions, insert psfs into cntpmodl
+    clib_inst_psfn(numbsidexpos, numbsideypos, numbphon, numbpixlpsfnside, C, x, y, cntpmodl);
+     
+    //printf("sizeregi offsypos marg numbsideypos numbsidexpos: %d %d %d %d %d\n", sizeregi, sizeregi, marg, numbsideypos, numbsidexpos);
+    clib_eval_llik(numbsidexpos, numbsideypos, cntpmodl, cntpresi, weig, chi2, sizeregi, marg, offsxpos, offsypos);
+}
+
+// per band evaluation context, created once so that the PSF coefficients, weights, region geometry and the 
+// phonion scratch buffers don't have to be converted and passed over from Python on every proposal
+typedef struct {
+    int numbsidexpos, numbsideypos, numbpixlpsfnside, numbparaspix, sizeregi;
+    float* coef;    // PSF polynomial coefficients, numbparaspix x numbpixlpsfnside^2
+    float* weig;    // pixel weights, numbsideypos x numbsidexpos
+    int sizephon;   // number of phonions the scratch buffers below can hold
+    float* A;
+    float* C;
+    int* x;
+    int* y;
+    float* xposband;
+    float* yposband;
+    double* chi2band;
+    clib_wksp* wksp;
+    // fast astrometry arrays from the pivot band to this one (xtrans, ytrans, dxpdx, dypdx, dxpdy, dypdy), NULL for 
+    // the pivot band and for bands sharing its pixel grid
+    double* astr;
+    int numbsidexposastr, numbsideyposastr;
+    // cubic coefficients of the x and y profiles of a separable PSF (2 x 4 x numbpixlpsfnside, see psf_separable_fit), 
+    // NULL when the polynomial PSF coefficients are used
+    float* sepa;
+} clib_ctxt;
+
+static void clib_ctxt_resz(clib_ctxt* ctxt, int numbphon){
+    ctxt->sizephon = max(numbphon, 1);
+    free(ctxt->A); free(ctxt->C); free(ctxt->x); free(ctxt->y); free(ctxt->xposband); free(ctxt->yposband);
+    ctxt->A = malloc(ctxt->sizephon*ctxt->numbparaspix*sizeof(float));
+    ctxt->C = malloc(ctxt->sizephon*ctxt->numbpixlpsfnside*ctxt->numbpixlpsfnside*sizeof(float));
+    ctxt->x = malloc(ctxt->sizephon*sizeof(int));
+    ctxt->y = malloc(ctxt->sizephon*sizeof(int));
+    ctxt->xposband = malloc(ctxt->sizephon*sizeof(float));
+    ctxt->yposband = malloc(ctxt->sizephon*sizeof(float));
+}
+
+void* clib_ctxt_alloc(int numbsidexpos, int numbsideypos, int numbpixlpsfnside, int numbparaspix, 
+                      float* coef, float* weig, int sizeregi, int numbphon){
+    int numbcoef = numbparaspix*numbpixlpsfnside*numbpixlpsfnside;
+    int numbpixl = numbsidexpos*numbsideypos;
+    clib_ctxt* ctxt = malloc(sizeof(clib_ctxt));
+    ctxt->numbsidexpos = numbsidexpos;
+    ctxt->numbsideypos = numbsideypos;
+    ctxt->numbpixlpsfnside = numbpixlpsfnside;
+    ctxt->numbparaspix = numbparaspix;
+    ctxt->sizeregi = sizeregi;
+    ctxt->coef = malloc(numbcoef*sizeof(float));
+    memcpy(ctxt->coef, coef, numbcoef*sizeof(float));
+    ctxt->weig = malloc(numbpixl*sizeof(float));
+    memcpy(ctxt->weig, weig, numbpixl*sizeof(float));
+    ctxt->A = NULL; ctxt->C = NULL; ctxt->x = NULL; ctxt->y = NULL; ctxt->xposband = NULL; ctxt->yposband = NULL;
+    clib_ctxt_resz(ctxt, numbphon);
+    ctxt->chi2band = malloc(((numbsidexpos / sizeregi) + 1)*((numbsideypos / sizeregi) + 1)*sizeof(double));
+    ctxt->wksp = clib_wksp_alloc(numbphon);
+    ctxt->astr = NULL;
+    ctxt->sepa = NULL;
+    return ctxt;
+}
+
+// copies the fast astrometry arrays (6 x numbsideyposastr x numbsidexposastr, see wcs_astrometry.fit_astrom_arrays) 
+// mapping pivot band positions onto this band
+void clib_ctxt_astr(void* ctxt, double* astr, int numbsidexposastr, int numbsideyposastr){
+    clib_ctxt* cont = ctxt;
+    int numbastr = 6*numbsidexposastr*numbsideyposastr;
+    free(cont->astr);
+    cont->astr = malloc(numbastr*sizeof(double));
+    memcpy(cont->astr, astr, numbastr*sizeof(double));
+    cont->numbsidexposastr = numbsidexposastr;
+    cont->numbsideyposastr = numbsideyposastr;
+}
+
+// switches the context to the separable PSF mode, where each stamp is the outer product of two 1D sub-pixel kernels
+void clib_ctxt_sepa(void* ctxt, float* sepa){
+    clib_ctxt* cont = ctxt;
+    free(cont->sepa);
+    cont->sepa = malloc(8*cont->numbpixlpsfnside*sizeof(float));
+    memcpy(cont->sepa, sepa, 8*cont->numbpixlpsfnside*sizeof(float));
+}
+
+// separable PSF stamps for the numbphon phonions whose flux and sub-pixel offsets are in the first three columns of A
+static void clib_sepa_psfn(clib_ctxt* cont, int numbphon){
+    int p, m, n;
+    int numbside = cont->numbpixlpsfnside;
+    float* sepx = cont->sepa;
+    float* sepy = cont->sepa + 4*numbside;
+    #pragma omp parallel for private(m, n) schedule(static)
+    for (p=0; p<numbphon; p++){
+        float kernxpos[numbside], kernypos[numbside];
+        float* A = cont->A + p*cont->numbparaspix;
+        float* C = cont->C + p*numbside*numbside;
+        float dx = A[1];
+        float dy = A[2];
+        for (n=0; n<numbside; n++){
+            kernxpos[n] = sepx[n] + dx*(sepx[n+numbside] + dx*(sepx[n+2*numbside] + dx*sepx[n+3*numbside]));
+            kernypos[n] = A[0] * (sepy[n] + dy*(sepy[n+numbside] + dy*(sepy[n+2*numbside] + dy*sepy[n+3*numbside])));
+        }
+        for (m=0; m<numbside; m++)
+            for (n=0; n<numbside; n++)
+                C[m*numbside+n] = kernypos[m]*kernxpos[n];
+    }
+}
+
+void clib_ctxt_free(void* ctxt){
+    clib_ctxt* cont = ctxt;
+    if (cont == NULL)
+        return;
+    free(cont->coef); free(cont->weig);
+    free(cont->A); free(cont->C); free(cont->x); free(cont->y); free(cont->xposband); free(cont->yposband);
+    free(cont->chi2band); free(cont->astr); free(cont->sepa);
+    clib_wksp_free(cont->wksp);
+    free(cont);
+}
+
+static void clib_ctxt_modl(clib_ctxt* cont, int numbphon, float* xpos, float* ypos, float* flux, double fluxscal, float back, 
+                           float* cntptemp, float* cntpmodl, float* cntpresi, double* chi2, int marg, int offsxpos, int offsypos){
+    int p, t, numbphongood;
+    int numbpixl = cont->numbsidexpos*cont->numbsideypos;
+    double dx, dy;
+    float fluxthis;
+    float* A;
+
+    if (numbphon > cont->sizephon)
+        clib_ctxt_resz(cont, numbphon);
+
+    if (cntptemp != NULL){
+        for (t=0; t<numbpixl; t++)
+            cntpmodl[t] = back + cntptemp[t];
+    }
+    else{
+        for (t=0; t<numbpixl; t++)
+            cntpmodl[t] = back;
+    }
+
+    // cubic sub-pixel design matrix, same terms and order as phonion_design_matrix (so numbparaspix is 10)
+    numbphongood = 0;
+    for (p=0; p<numbphon; p++){
+        if (!(xpos[p] > 0 && xpos[p] < cont->numbsidexpos-1 && ypos[p] > 0 && ypos[p] < cont->numbsideypos-1))
+            continue;
+        cont->x[numbphongood] = (int) ceilf(xpos[p]);
+        cont->y[numbphongood] = (int) ceilf(ypos[p]);
+        dx = cont->x[numbphongood] - (double) xpos[p];
+        dy = cont->y[numbphongood] - (double) ypos[p];
+        fluxthis = (float) (fluxscal*flux[p]);
+        A = cont->A + numbphongood*cont->numbparaspix;
+        if (cont->sepa != NULL){
+            // separable PSF, only the flux and the offsets are needed
+            A[0] = fluxthis;
+            A[1] = (float) dx;
+            A[2] = (float) dy;
+            numbphongood++;
+            continue;
+        }
+        A[0] = fluxthis;
+        A[1] = (float) dx * fluxthis;
+        A[2] = (float) dy * fluxthis;
+        A[3] = (float) (dx*dx) * fluxthis;
+        A[4] = (float) (dx*dy) * fluxthis;
+        A[5] = (float) (dy*dy) * fluxthis;
+        A[6] = (float) (dx*dx*dx) * fluxthis;
+        A[7] = (float) (dx*dx*dy) * fluxthis;
+        A[8] = (float) (dx*dy*dy) * fluxthis;
+        A[9] = (float) (dy*dy*dy) * fluxthis;
+        numbphongood++;
+    }
+
+    if (cont->sepa != NULL){
+        clib_sepa_psfn(cont, numbphongood);
+        clib_inst_psfn(cont->numbsidexpos, cont->numbsideypos, numbphongood, cont->numbpixlpsfnside, cont->C, cont->x, cont->y, cntpmodl);
+        clib_eval_llik(cont->numbsidexpos, cont->numbsideypos, cntpmodl, cntpresi, cont->weig, chi2, cont->sizeregi, marg, offsxpos, offsypos);
+    }
+    else
+        clib_eval_modl(cont->numbsidexpos, cont->numbsideypos, numbphongood, cont->numbpixlpsfnside, cont->numbparaspix, 
+                       cont->A, cont->coef, cont->C, cont->x, cont->y, cntpmodl, cntpresi, cont->weig, chi2, cont->wksp, 
+                       cont->sizeregi, marg, offsxpos, offsypos);
+}
+
+// fills cntpmodl with the background (plus an optional template), adds the PSFs of the phonions at (xpos, ypos) 
+// with fluxes flux and fills chi2 with the regional chi squared against cntpresi. phonions within a pixel of the 
+// image edge are dropped, as in image_model_eval
+void clib_ctxt_eval(void* ctxt, int numbphon, float* xpos, float* ypos, float* flux, float back, float* cntptemp, 
+                    float* cntpmodl, float* cntpresi, double* chi2, int marg, int offsxpos, int offsypos){
+    clib_ctxt_modl(ctxt, numbphon, xpos, ypos, flux, 1., back, cntptemp, cntpmodl, cntpresi, chi2, marg, offsxpos, offsypos);
+}
+
+// evaluates all bands in one call from pivot band positions. for each band the positions are moved onto its pixel grid 
+// with the fast astrometry arrays (first order expansion around the nearest lattice point, as in 
+// wcs_astrometry.transform_q), the fluxes in row b of flux are scaled by fluxscal[b] and the model image and regional 
+// chi squared are computed as in clib_ctxt_eval. chi2 is the sum of the regional chi squared over bands
+void clib_ctxt_eval_mult(int numbband, void** ctxt, int numbphon, float* xpos, float* ypos, float* flux, double* fluxscal, 
+                         float* back, void** cntptemp, void** cntpmodl, void** cntpresi, double* chi2, 
+                         int* marg, int* offsxpos, int* offsypos){
+    int b, p, t, xint, yint, numbregi, numbastr;
+    float xdif, ydif;
+    double* astr;
+    clib_ctxt* cont;
+    float* xposthis;
+    float* yposthis;
+
+    for (b=0; b<numbband; b++){
+        cont = ctxt[b];
+        if (numbphon > cont->sizephon)
+            clib_ctxt_resz(cont, numbphon);
+
+        xposthis = xpos;
+        yposthis = ypos;
+        if (cont->astr != NULL){
+            astr = cont->astr;
+            numbastr = cont->numbsidexposastr*cont->numbsideyposastr;
+            for (p=0; p<numbphon; p++){
+                xint = (int) floorf(xpos[p] + 0.5f);
+                yint = (int) floorf(ypos[p] + 0.5f);
+                xdif = xpos[p] - xint;
+                ydif = ypos[p] - yint;
+                // phonions are kept inside the pivot image, clipping only guards the lookup at its far edges
+                xint = min(max(xint, 0), cont->numbsidexposastr-1);
+                yint = min(max(yint, 0), cont->numbsideyposastr-1);
+                t = yint*cont->numbsidexposastr + xint;
+                cont->xposband[p] = (float) (astr[t] + xdif*astr[2*numbastr+t] + ydif*astr[4*numbastr+t]);
+                cont->yposband[p] = (float) (astr[numbastr+t] + xdif*astr[3*numbastr+t] + ydif*astr[5*numbastr+t]);
             }
+            xposthis = cont->xposband;
+            yposthis = cont->yposband;
+        }
+
+        clib_ctxt_modl(cont, numbphon, xposthis, yposthis, flux + b*numbphon, fluxscal[b], back[b], cntptemp[b], cntpmodl[b], 
+                       cntpresi[b], b == 0 ? chi2 : cont->chi2band, marg[b], offsxpos[b], offsypos[b]);
+        if (b > 0){
+            numbregi = ((cont->numbsidexpos / cont->sizeregi) + 1)*((cont->numbsideypos / cont->sizeregi) + 1);
+            for (t=0; t<numbregi; t++)
+                chi2[t] += cont->chi2band[t];
         }
     }
-     
-    //printf("sizeregi offsypos marg numbsideypos numbsidexpos: %d %d %d %d %d\n", sizeregi, sizeregi, marg, numbsideypos, numbsidexpos);
-    clib_eval_llik(numbsidexpos, numbsideypos, cntpmodl, cntpresi, weig, chi2, sizeregi, marg, offsxpos, offsypos, booltile);
-}
\ No newline at end of file
+}
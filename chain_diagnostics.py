@@ -0,0 +1,108 @@
+import numpy as np
+
+def autocovariance(chains):
+    '''
+    Biased (normalized by the chain length) autocovariance of each chain, computed with an FFT.
+
+    Parameters
+    ----------
+
+    chains : `~numpy.ndarray' of shape (nchain, nsamp)
+        Samples of a scalar quantity from each chain.
+
+    Returns
+    -------
+
+    acov : `~numpy.ndarray' of shape (nchain, nsamp)
+        acov[c, t] is the autocovariance of chain c at lag t.
+
+    '''
+    chains = np.asarray(chains, dtype=np.float64)
+    nsamp = chains.shape[-1]
+    nfft = 2**int(np.ceil(np.log2(2*nsamp)))
+    four = np.fft.rfft(chains - np.mean(chains, axis=-1, keepdims=True), n=nfft, axis=-1)
+    return np.fft.irfft(four*np.conjugate(four), n=nfft, axis=-1)[..., :nsamp]/nsamp
+
+def split_chains(chains):
+    '''
+    Splits each chain in two halves, dropping the middle sample of chains with an odd number of samples, so that
+    trends within chains show up as disagreement between chains.
+
+    Parameters
+    ----------
+
+    chains : `~numpy.ndarray' of shape (nchain, nsamp)
+
+    Returns
+    -------
+
+    split : `~numpy.ndarray' of shape (2*nchain, nsamp//2)
+
+    '''
+    chains = np.asarray(chains, dtype=np.float64)
+    half = chains.shape[1]//2
+    return np.concatenate([chains[:, :half], chains[:, chains.shape[1]-half:]])
+
+def split_rhat(chains):
+    '''
+    Split-Rhat (Gelman et al., Bayesian Data Analysis 3rd ed.), the potential scale reduction factor of
+    compute_gelman_rubin_diagnostic computed on the halves of each chain.
+
+    Parameters
+    ----------
+
+    chains : `~numpy.ndarray' of shape (nchain, nsamp)
+        Samples of a scalar quantity from each chain, with at least 4 samples per chain.
+
+    Returns
+    -------
+
+    rhat : float
+        Split-Rhat. Chains that are all constant give 1 if they agree and infinity otherwise.
+
+    '''
+    split = split_chains(chains)
+    n = split.shape[1]
+    within = np.mean(np.var(split, axis=1, ddof=1))
+    between_over_n = np.var(np.mean(split, axis=1), ddof=1)
+    if within == 0:
+        return 1. if between_over_n == 0 else np.inf
+    return np.sqrt(((n-1.)/n*within + between_over_n)/within)
+
+def effective_sample_size(chains):
+    '''
+    Effective sample size of a scalar quantity summed over chains, from the autocorrelation combined across chains and
+    truncated with Geyer's initial monotone sequence (as in Stan). Chains are split in halves first, as for split_rhat.
+
+    Parameters
+    ----------
+
+    chains : `~numpy.ndarray' of shape (nchain, nsamp)
+        Samples of a scalar quantity from each chain, with at least 4 samples per chain.
+
+    Returns
+    -------
+
+    ess : float
+        Effective sample size, capped at log10 of the total number of samples times that number as in Stan. Zero if 
+        all chains are constant.
+
+    '''
+    split = split_chains(chains)
+    m, n = split.shape
+    acov = autocovariance(split)
+    mean_var = np.mean(acov[:, 0])*n/(n-1.)
+    var_plus = mean_var*(n-1.)/n + np.var(np.mean(split, axis=1), ddof=1)
+    if var_plus == 0:
+        return 0.
+
+    rho = 1. - (mean_var - np.mean(acov, axis=0))/var_plus
+    rho[0] = 1.
+    # sums of consecutive pairs of autocorrelations, kept while positive and forced to be non-increasing
+    npair = n//2
+    pairs = rho[:2*npair].reshape(npair, 2).sum(axis=1)
+    if np.any(pairs <= 0):
+        pairs = pairs[:np.argmax(pairs <= 0)]
+    pairs = np.minimum.accumulate(pairs)
+    tau = -1. + 2.*np.sum(pairs)
+    return m*n/max(tau, 1./np.log10(m*n))
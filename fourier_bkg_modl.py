@@ -5,7 +5,7 @@ from astropy.io import fits
 import matplotlib.pyplot as plt
 from astropy.stats import sigma_clipped_stats
 from image_eval import psf_poly_fit, image_model_eval
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, gaussian_filter1d
 
 def multiband_fourier_templates(imszs, n_terms, show_templates=False, psf_fwhms=None):
     '''
@@ -44,6 +44,137 @@ def multiband_fourier_templates(imszs, n_terms, show_templates=False, psf_fwhms=
         all_templates.append(make_fourier_templates(imszs[b][0], imszs[b][1], n_terms, show_templates=show_templates, psf_fwhm=psf_fwhm))
     return all_templates
 
+def multiband_fourier_bases(imszs, n_terms, psf_fwhms=None, dtype=np.float32):
+    '''
+    Separable counterpart of multiband_fourier_templates, returning the 1D bases from make_fourier_basis for each observation.
+
+    Parameters
+    ----------
+
+    imszs : list of lists
+        List containing image dimensions for each of the three observations
+
+    n_terms : int
+        Order of Fourier expansion for templates.
+
+    psf_fwhms : list, optional
+        List of beam sizes across observations. Default is 'None'.
+
+    dtype : optional
+        Data type of the bases. Default is np.float32.
+
+    Returns
+    -------
+
+    all_bases : list of tuples
+        (xbasis, ybasis) for each observation.
+
+    '''
+
+    all_bases = []
+    for b in range(len(imszs)):
+        if psf_fwhms is None:
+            psf_fwhm = None
+        else:
+            psf_fwhm = psf_fwhms[b]
+        all_bases.append(make_fourier_basis(imszs[b][0], imszs[b][1], n_terms, psf_fwhm=psf_fwhm, dtype=dtype))
+    return all_bases
+
+def make_fourier_basis(N, M, n_terms, psf_fwhm=None, dtype=np.float32):
+
+    '''
+
+    Generates the 1D profiles that make up the 2D Fourier templates of make_fourier_templates. Every template is separable, 
+    with template [i,j,k] equal to the outer product of ybasis[k,j] (along the first image axis) and xbasis[i] (along the second), 
+    so only O(n_terms*(N+M)) numbers need to be stored. A Gaussian beam is separable too, so smoothing each 1D profile 
+    gives the same result as smoothing the 2D templates.
+
+    Parameters
+    ----------
+
+    N : int
+        length of image
+
+    M : int
+        width of image
+
+    n_terms : int
+        Order of Fourier expansion for templates.
+
+    psf_fwhm : float, optional
+        Observation PSF full width at half maximum (FWHM), used to pre-convolve the profiles. Default is 'None'.
+
+    dtype : optional
+        Data type of the returned profiles. Default is np.float32.
+
+    Returns
+    -------
+
+    xbasis : `numpy.ndarray' of shape (n_terms, M)
+        Sine profiles along the second image axis.
+
+    ybasis : `numpy.ndarray' of shape (2, n_terms, N)
+        Sine (k=0) and cosine (k=1) profiles along the first image axis.
+
+    '''
+
+    n = np.arange(1, n_terms+1)[:,None]
+    x = np.arange(M)[None,:]
+    y = np.arange(N)[None,:]
+
+    xbasis = np.sin(n*np.pi*x/M)
+    ybasis = np.array([np.sin(n*np.pi*y/N), np.cos(n*np.pi*y/N)])
+
+    if psf_fwhm is not None: # if beam size given, convolve with PSF assumed to be Gaussian
+        xbasis = gaussian_filter1d(xbasis, sigma=psf_fwhm/2.355, axis=-1)
+        ybasis = gaussian_filter1d(ybasis, sigma=psf_fwhm/2.355, axis=-1)
+
+    return xbasis.astype(dtype), ybasis.astype(dtype)
+
+def fourier_basis_template(basis, i, j, k):
+    '''
+    Returns the single 2D template [i,j,k] described by separable basis (xbasis, ybasis), as a rank-1 outer product.
+    '''
+    xbasis, ybasis = basis
+    return np.outer(ybasis[k,j], xbasis[i])
+
+def fourier_basis_sum(fourier_coeffs, basis):
+    '''
+    Evaluates sum_ijk fourier_coeffs[...,i,j,k]*template[i,j,k] for a stack of coefficient states. This is the one place 
+    Fourier backgrounds are reconstructed, in the sampler and in post-processing. For a separable basis (xbasis, ybasis) 
+    it is two matrix products per state, sum_k ybasis[k]^T . (fourier_coeffs[...,:,:,k]^T . xbasis), and no 2D template 
+    is formed. Dense templates from make_fourier_templates are contracted with a single tensordot. If the coefficients 
+    have fewer terms than the basis, only the leading terms of the basis are used.
+
+    Parameters
+    ----------
+
+    fourier_coeffs : `numpy.ndarray' of shape (..., n_terms, n_terms, 2)
+        Coefficients of truncated Fourier expansion, optionally with leading sample dimensions.
+
+    basis : tuple or `numpy.ndarray'
+        (xbasis, ybasis) from make_fourier_basis, or templates of shape (n_terms, n_terms, 2, N, M) from make_fourier_templates.
+
+    Returns
+    -------
+
+    sum_temp : `numpy.ndarray' of shape (..., N, M)
+        The summed template for each coefficient state.
+
+    '''
+    if isinstance(basis, tuple):
+        xbasis, ybasis = basis
+        coeffs = np.asarray(fourier_coeffs, dtype=xbasis.dtype)
+        n = coeffs.shape[-3]
+        # (..., j, k, M), then contract (j, k) with the first-axis profiles
+        cx = np.tensordot(coeffs, xbasis[:n], axes=([-3],[0]))
+        sum_temp = np.tensordot(cx, ybasis[:, :n], axes=([-3,-2],[1,0]))
+        return np.ascontiguousarray(np.swapaxes(sum_temp, -1, -2))
+
+    coeffs = np.asarray(fourier_coeffs)
+    n, nk = coeffs.shape[-3], coeffs.shape[-1]
+    return np.tensordot(coeffs, basis[:n, :n, :nk], axes=([-3,-2,-1],[0,1,2]))
+
 def make_fourier_templates(N, M, n_terms, show_templates=False, psf_fwhm=None):
         
     '''
@@ -125,7 +256,7 @@ def make_fourier_templates(N, M, n_terms, show_templates=False, psf_fwhm=None):
     return templates
 
 
-def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M=None, psf_fwhm=None):
+def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M=None, psf_fwhm=None, fourier_basis=None):
 
     '''
     Given a set of coefficients and Fourier templates, computes their dot product.
@@ -133,8 +264,8 @@ def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M
     Parameters
     ----------
 
-    fourier_coeffs : `~numpy.ndarray' of shape (n_terms, n_terms, 2)
-        Coefficients of truncated Fourier expansion.
+    fourier_coeffs : `~numpy.ndarray' of shape (n_terms, n_terms, 2) or (nsamp, n_terms, n_terms, 2)
+        Coefficients of truncated Fourier expansion. A stack of samples gives a stack of templates.
 
     n_terms : int
         Order of Fourier expansion to compute sum over. This is left explicit as an input
@@ -142,8 +273,7 @@ def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M
         if the underlying truncated series has more terms.
 
     fourier_templates : `~numpy.ndarray' of shape (n_terms, n_terms, 2, N, M), optional
-        Contains 2D Fourier templates for truncated series. If left unspecified, a set of Fourier templates is generated
-        on the fly. Default is 'None'.
+        Contains 2D Fourier templates for truncated series. Default is 'None'.
 
     N : int, optional
         length of image. Default is 'None'.
@@ -155,19 +285,25 @@ def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M
         Observation PSF full width at half maximum (FWHM). This can be used to pre-convolve templates for background modeling 
         Default is 'None'.
 
+    fourier_basis : tuple, optional
+        Separable basis (xbasis, ybasis) from make_fourier_basis. If neither this nor fourier_templates is given, 
+        a double precision basis is generated on the fly. Default is 'None'.
+
     Returns
     -------
 
-    sum_temp : `~numpy.ndarray' of shape (N, M)
+    sum_temp : `~numpy.ndarray' of shape (N, M) or (nsamp, N, M)
         The summed template.
 
     '''
-    if fourier_templates is None:
-        fourier_templates = make_fourier_templates(N, M, n_terms, psf_fwhm=psf_fwhm)
-
-    sum_temp = np.sum([fourier_coeffs[i,j,k]*fourier_templates[i,j,k] for i in range(n_terms) for j in range(n_terms) for k in range(fourier_coeffs.shape[-1])], axis=0)
-    
-    return sum_temp
+    if fourier_templates is not None:
+        basis = fourier_templates
+    elif fourier_basis is not None:
+        basis = fourier_basis
+    else:
+        basis = make_fourier_basis(N, M, n_terms, psf_fwhm=psf_fwhm, dtype=np.float64)
+
+    return fourier_basis_sum(np.asarray(fourier_coeffs)[..., :n_terms, :n_terms, :], basis)
 
 def fit_coeffs_to_observed_comb(observed_comb, obs_noise_sig,ftemplates, true_fcoeffs = None, true_comb=None, n_terms=None, sig_dtemp=0.1, niter=100, init_nsig=1.):
     if true_fcoeffs is not None:
@@ -1,37 +1,351 @@
+import os
+import hashlib
+import warnings
 import numpy as np
+try:
+    import numba
+except ImportError: # the Numba engine is optional
+    numba = None
 
-def psf_poly_fit(psf0, nbin):
+_psf_cfs = dict()
+
+def psf_poly_fit(psf0, nbin, cache_dir=None):
+        ''' Fits the cubic sub-pixel polynomial coefficients cf used by the model evaluation to an upsampled PSF. All nbin x nbin 
+        blocks share one design matrix, so they are fit with a single least squares solve. Results are cached in memory and, if 
+        cache_dir is given, on disk under a hash of the PSF pixels and nbin. '''
         assert psf0.shape[0] == psf0.shape[1] # assert PSF is square
         npix = psf0.shape[0]
 
+        key = hashlib.sha1(np.ascontiguousarray(psf0, dtype=np.float32).tobytes() + str((psf0.shape, nbin)).encode()).hexdigest()
+        if key in _psf_cfs:
+            return _psf_cfs[key].copy()
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, 'cf_'+key+'.npy')
+            if os.path.isfile(cache_path):
+                _psf_cfs[key] = np.load(cache_path)
+                return _psf_cfs[key].copy()
+
         # pad by one row and one column
         psf = np.zeros((npix+1, npix+1), dtype=np.float32)
         psf[0:npix, 0:npix] = psf0
 
         # make design matrix for each nbin x nbin region
-        # print(type(npix), type(nbin))
         nc = int(npix/nbin) # dimension of original psf
         nx = nbin+1
         y, x = np.mgrid[0:nx, 0:nx] / np.float32(nbin)
         x = x.flatten()
         y = y.flatten()
         A = np.column_stack([np.full(nx*nx, 1, dtype=np.float32), x, y, x*x, x*y, y*y, x*x*x, x*x*y, x*y*y, y*y*y]).astype(np.float32)
-        # output array of coefficients
-        
-        cf = np.zeros((A.shape[1], nc, nc), dtype=np.float32)
-
-        # loop over original psf pixels and get fit coefficients
-        for iy in range(nc):
-            for ix in range(nc):
-                # solve p = A cf for cf
-                p = psf[iy*nbin:(iy+1)*nbin+1, ix*nbin:(ix+1)*nbin+1].flatten()
-                AtAinv = np.linalg.inv(np.dot(A.T, A))
-                ans = np.dot(AtAinv, np.dot(A.T, p))
-                cf[:,iy,ix] = ans
-
-        return cf.reshape(cf.shape[0], cf.shape[1]*cf.shape[2])
-
-def image_model_eval(x, y, f, back, imsz, nc, cf, regsize=None, margin=0, offsetx=0, offsety=0, weights=None, ref=None, lib=None, template=None):
+
+        # (nx*nx, nc*nc) matrix whose columns are the flattened (nbin+1) x (nbin+1) blocks, neighbouring blocks share an edge
+        iy, ix = np.mgrid[0:nc, 0:nc]
+        dy, dx = np.mgrid[0:nx, 0:nx]
+        p = psf[(iy.reshape(1, -1)*nbin + dy.reshape(-1, 1)), (ix.reshape(1, -1)*nbin + dx.reshape(-1, 1))]
+
+        # solve p = A cf for cf, for all blocks at once
+        cf = np.linalg.lstsq(A.astype(np.float64), p.astype(np.float64), rcond=None)[0].astype(np.float32)
+
+        _psf_cfs[key] = cf
+        if cache_dir is not None:
+            # write to a temporary file first so that concurrent runs never read a partial file
+            try:
+                os.makedirs(cache_dir)
+            except OSError: # already there
+                pass
+            tmp_path = cache_path+'.'+str(os.getpid())+'.tmp.npy'
+            np.save(tmp_path, cf)
+            os.rename(tmp_path, cache_path)
+
+        return cf.copy()
+
+def psf_separable_fit(psf0, nbin, tol=5e-3, cache_dir=None):
+    ''' Separable counterpart of psf_poly_fit for PSFs that are an outer product of two 1D profiles, such as Gaussian beams. 
+    Returns sepcf of shape (2, 4, nc) holding the cubic sub-pixel coefficients of the x and y profiles, so that a stamp is 
+    f * outer(ky, kx) with kx = (1, dx, dx^2, dx^3) . sepcf[0] and ky likewise. Raises ValueError if the separable stamps 
+    differ from the psf_poly_fit ones by more than tol times the stamp peak anywhere on a grid of sub-pixel offsets. '''
+    assert psf0.shape[0] == psf0.shape[1] # assert PSF is square
+    npix = psf0.shape[0]
+    nc = int(npix/nbin)
+    nx = nbin+1
+
+    u, s, vt = np.linalg.svd(np.array(psf0, dtype=np.float64))
+    prof_y = u[:,0]*np.sqrt(s[0])
+    prof_x = vt[0]*np.sqrt(s[0])
+    if np.sum(prof_y) < 0:
+        prof_y, prof_x = -prof_y, -prof_x
+
+    # cubic fit over each nbin+1 sample block of the padded profiles, all blocks in one solve as in psf_poly_fit
+    t = np.arange(nx) / float(nbin)
+    A = np.column_stack([np.ones(nx), t, t*t, t*t*t])
+    blocks = np.arange(nc)[None, :]*nbin + np.arange(nx)[:, None]
+    sepcf = np.zeros((2, 4, nc), dtype=np.float32)
+    for i, prof in enumerate([prof_x, prof_y]):
+        prof_pad = np.zeros(npix+1)
+        prof_pad[:npix] = prof
+        sepcf[i] = np.linalg.lstsq(A, prof_pad[blocks], rcond=None)[0]
+
+    # compare against the polynomial path on a grid of sub-pixel offsets
+    cf = psf_poly_fit(psf0, nbin, cache_dir=cache_dir)
+    dy, dx = [d.ravel() for d in np.mgrid[0:1:11j, 0:1:11j]]
+    dd = np.column_stack((np.ones_like(dx), dx, dy, dx*dx, dx*dy, dy*dy, dx*dx*dx, dx*dx*dy, dx*dy*dy, dy*dy*dy))
+    poly_stamps = np.dot(dd, cf)
+    sep_stamps = separable_stamps(dx, dy, np.ones_like(dx), sepcf)
+    err = np.max(np.abs(sep_stamps - poly_stamps)) / np.max(np.abs(poly_stamps))
+    if err > tol:
+        raise ValueError('PSF is not separable to within tol=%g of the polynomial fit (max deviation %g of the peak)' % (tol, err))
+    return sepcf
+
+def separable_stamps(dx, dy, f, sepcf):
+    ''' PSF stamps (nstar, nc*nc) built as f times the outer product of the 1D sub-pixel kernels from psf_separable_fit. '''
+    kx = np.dot(np.column_stack((np.ones_like(dx), dx, dx*dx, dx*dx*dx)), sepcf[0])
+    ky = np.dot(np.column_stack((np.ones_like(dy), dy, dy*dy, dy*dy*dy)), sepcf[1])
+    return ((f[:, None]*ky)[:, :, None] * kx[:, None, :]).reshape(dx.size, kx.shape[1]*ky.shape[1]).astype(np.float32)
+
+_stencils = dict()
+
+def psf_stencil(nc):
+    ''' Pixel offsets (dy, dx) of every element of a flattened nc x nc PSF stamp, relative to the stamp center. '''
+    if nc not in _stencils:
+        rad = nc//2
+        dy, dx = np.mgrid[-rad:rad+1, -rad:rad+1]
+        _stencils[nc] = (dy.ravel().astype(np.int64), dx.ravel().astype(np.int64))
+    return _stencils[nc]
+
+def region_bounds(NX, NY, regsize, margin, offsetx, offsety):
+    ''' Pixel bounds [y0, y1) x [x0, x1) of each subregion, following the convention of the C likelihood kernels. '''
+    regsize = int(regsize)
+    nregx = (NX // regsize) + 1
+    nregy = (NY // regsize) + 1
+    i = np.arange(nregx)
+    j = np.arange(nregy)
+    x0 = np.maximum(i*regsize - offsetx - margin, 0)
+    x1 = np.maximum(np.minimum((i+1)*regsize - offsetx + margin, NX), x0)
+    y0 = np.maximum(j*regsize - offsety - margin, 0)
+    y1 = np.maximum(np.minimum((j+1)*regsize - offsety + margin, NY), y0)
+    return y0, y1, x0, x1
+
+def scatter_add(flat, idx, vals):
+    ''' Adds vals into flat[idx] in place, accumulating repeated indices. '''
+    if idx.size > flat.size:
+        flat += np.bincount(idx, weights=vals, minlength=flat.size).astype(flat.dtype)
+    else:
+        uidx, inv = np.unique(idx, return_inverse=True)
+        flat[uidx] += np.bincount(inv.ravel(), weights=vals).astype(flat.dtype)
+
+def numpy_updt_modl(NX, NY, image, image_acpt, reg_acpt, regsize, margin, offsetx, offsety):
+    ''' NumPy equivalent of clib_updt_modl/pcat_imag_acpt: copies image into image_acpt over accepted regions. '''
+    y0, y1, x0, x1 = region_bounds(NX, NY, regsize, margin, offsetx, offsety)
+    jacpt, iacpt = np.nonzero(reg_acpt > 0)
+    if jacpt.size == 0:
+        return
+    # coverage of the (possibly overlapping) accepted regions from a 2D difference array
+    cover = np.zeros((NY+1, NX+1), dtype=np.int32)
+    np.add.at(cover, (y0[jacpt], x0[iacpt]), 1)
+    np.add.at(cover, (y0[jacpt], x1[iacpt]), -1)
+    np.add.at(cover, (y1[jacpt], x0[iacpt]), -1)
+    np.add.at(cover, (y1[jacpt], x1[iacpt]), 1)
+    mask = (np.cumsum(np.cumsum(cover, axis=0), axis=1)[:NY, :NX] > 0).ravel()
+    image_acpt.reshape(-1)[mask] = image.reshape(-1)[mask]
+
+def numpy_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety):
+    ''' NumPy equivalent of clib_eval_llik/pcat_like_eval: weighted chi squared of image - ref in each region. '''
+    y0, y1, x0, x1 = region_bounds(NX, NY, regsize, margin, offsetx, offsety)
+    diff = image.reshape(NY, NX) - ref.reshape(NY, NX)
+    # summed area table, so overlapping regions (margins) each cost O(1)
+    sat = np.zeros((NY+1, NX+1), dtype=np.float64)
+    sat[1:, 1:] = np.cumsum(np.cumsum(diff*diff*weight.reshape(NY, NX), axis=0, dtype=np.float64), axis=1)
+    diff2.reshape(y0.size, x0.size)[:,:] = sat[np.ix_(y1, x1)] - sat[np.ix_(y0, x1)] - sat[np.ix_(y1, x0)] + sat[np.ix_(y0, x0)]
+
+def numpy_eval_modl(NX, NY, nstar, nc, k, A, B, C, x, y, image, ref, weight, diff2, wksp, regsize, margin, offsetx, offsety):
+    ''' NumPy equivalent of clib_eval_modl/pcat_model_eval. Takes the same arguments, adds all PSF stamps to image 
+    in a single scatter-add and fills diff2 with the regional chi squared against ref. wksp is unused, the 
+    scatter-add already coalesces phonions that share a pixel. '''
+    C[:nstar] = np.dot(A[:nstar], B)
+    numpy_add_stamps(NX, NY, nstar, nc, C, x, y, image)
+    numpy_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety)
+
+def numpy_eval_sepa(NX, NY, nstar, nc, k, A, B, C, x, y, image, ref, weight, diff2, wksp, regsize, margin, offsetx, offsety):
+    ''' Separable PSF version of numpy_eval_modl. The columns of A are the flux and sub-pixel offsets dx, dy of each 
+    phonion and B is sepcf from psf_separable_fit. '''
+    C[:nstar] = separable_stamps(A[:nstar, 1], A[:nstar, 2], A[:nstar, 0], B)
+    numpy_add_stamps(NX, NY, nstar, nc, C, x, y, image)
+    numpy_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety)
+
+def numpy_add_stamps(NX, NY, nstar, nc, C, x, y, image):
+    ''' Adds the nc x nc stamps C, centered on pixels (x, y), to image in a single scatter-add. '''
+    dy, dx = psf_stencil(nc)
+    px = x[:nstar, None].astype(np.int64) + dx
+    py = y[:nstar, None].astype(np.int64) + dy
+    inimage = (px >= 0) & (px < NX) & (py >= 0) & (py < NY)
+    scatter_add(image.reshape(-1), (py*NX + px)[inimage], C[:nstar][inimage])
+
+class numpy_lib():
+    ''' Stands in for the compiled library (libmmult) when no C toolchain is available. '''
+    clib_eval_modl = pcat_model_eval = staticmethod(numpy_eval_modl)
+    clib_updt_modl = pcat_imag_acpt = staticmethod(numpy_updt_modl)
+    clib_eval_llik = pcat_like_eval = staticmethod(numpy_eval_llik)
+    clib_wksp_alloc = pcat_wksp_alloc = staticmethod(lambda nphon: None)
+    clib_wksp_free = pcat_wksp_free = staticmethod(lambda wksp: None)
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _numba_add_stamps(NX, NY, nstar, nc, C, x, y, image):
+        rad = nc//2
+        for i in range(nstar):
+            for j in range(nc):
+                py = y[i] + j - rad
+                if py < 0 or py >= NY:
+                    continue
+                for l in range(nc):
+                    px = x[i] + l - rad
+                    if px >= 0 and px < NX:
+                        image[py*NX+px] += C[i, j*nc+l]
+
+    @numba.njit(cache=True)
+    def _numba_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety):
+        nregx = NX//regsize + 1
+        nregy = NY//regsize + 1
+        for j in range(nregy):
+            y0 = max(j*regsize - offsety - margin, 0)
+            y1 = min((j+1)*regsize - offsety + margin, NY)
+            for i in range(nregx):
+                x0 = max(i*regsize - offsetx - margin, 0)
+                x1 = min((i+1)*regsize - offsetx + margin, NX)
+                chi2 = 0.
+                for py in range(y0, y1):
+                    for px in range(x0, x1):
+                        d = image[py*NX+px] - ref[py*NX+px]
+                        chi2 += d*d*weight[py*NX+px]
+                diff2[j*nregx+i] = chi2
+
+    @numba.njit(cache=True)
+    def _numba_updt_modl(NX, NY, image, image_acpt, reg_acpt, regsize, margin, offsetx, offsety):
+        nregx = NX//regsize + 1
+        nregy = NY//regsize + 1
+        for j in range(nregy):
+            for i in range(nregx):
+                if reg_acpt[j*nregx+i] > 0:
+                    for py in range(max(j*regsize - offsety - margin, 0), min((j+1)*regsize - offsety + margin, NY)):
+                        for px in range(max(i*regsize - offsetx - margin, 0), min((i+1)*regsize - offsetx + margin, NX)):
+                            image_acpt[py*NX+px] = image[py*NX+px]
+
+def numba_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety):
+    ''' Numba equivalent of clib_eval_llik/pcat_like_eval. '''
+    _numba_eval_llik(NX, NY, image.reshape(-1), ref.reshape(-1), weight.reshape(-1), diff2.reshape(-1), int(regsize), margin, offsetx, offsety)
+
+def numba_updt_modl(NX, NY, image, image_acpt, reg_acpt, regsize, margin, offsetx, offsety):
+    ''' Numba equivalent of clib_updt_modl/pcat_imag_acpt. '''
+    _numba_updt_modl(NX, NY, image.reshape(-1), image_acpt.reshape(-1), reg_acpt.reshape(-1), int(regsize), margin, offsetx, offsety)
+
+def numba_eval_modl(NX, NY, nstar, nc, k, A, B, C, x, y, image, ref, weight, diff2, wksp, regsize, margin, offsetx, offsety):
+    ''' Numba equivalent of clib_eval_modl/pcat_model_eval. The stamps come from a single BLAS product as in 
+    numpy_eval_modl, insertion and the regional chi squared are compiled loops following the C routines. '''
+    C[:nstar] = np.dot(A[:nstar], B)
+    _numba_add_stamps(NX, NY, nstar, nc, C, x, y, image.reshape(-1))
+    numba_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety)
+
+def numba_eval_sepa(NX, NY, nstar, nc, k, A, B, C, x, y, image, ref, weight, diff2, wksp, regsize, margin, offsetx, offsety):
+    ''' Separable PSF version of numba_eval_modl, see numpy_eval_sepa. '''
+    C[:nstar] = separable_stamps(A[:nstar, 1], A[:nstar, 2], A[:nstar, 0], B)
+    _numba_add_stamps(NX, NY, nstar, nc, C, x, y, image.reshape(-1))
+    numba_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety)
+
+class numba_lib(numpy_lib):
+    ''' numpy_lib with the pixel loops compiled by Numba, only usable when numba is installed. '''
+    clib_eval_modl = pcat_model_eval = staticmethod(numba_eval_modl)
+    clib_updt_modl = pcat_imag_acpt = staticmethod(numba_updt_modl)
+    clib_eval_llik = pcat_like_eval = staticmethod(numba_eval_llik)
+
+def phonion_offsets(x, y, f, imsz):
+    ''' Integer pixel positions, sub-pixel offsets and fluxes of the phonions inside the image. '''
+    # FIXME sometimes phonions are outside image... what is best way to handle?
+    goodsrc = (x > 0) * (x < imsz[0] - 1) * (y > 0) * (y < imsz[1] - 1)
+    x = x.compress(goodsrc)
+    y = y.compress(goodsrc)
+    f = f.compress(goodsrc)
+
+    ix = np.ceil(x).astype(np.int32)
+    dx = ix - x
+    iy = np.ceil(y).astype(np.int32)
+    dy = iy - y
+    return ix, iy, dx, dy, f
+
+def phonion_design_matrix(x, y, f, imsz):
+    ''' Integer pixel positions and flux-weighted cubic sub-pixel design matrix for the phonions inside the image. '''
+    ix, iy, dx, dy, f = phonion_offsets(x, y, f, imsz)
+    nstar = ix.size
+
+    dd = np.column_stack((np.full(nstar, 1., dtype=np.float32), dx, dy, dx*dx, dx*dy, dy*dy, dx*dx*dx, dx*dx*dy, dx*dy*dy, dy*dy*dy)).astype(np.float32) * f[:, None]
+    return ix, iy, dd
+
+def pixel_regions(pix, NX, NY, regsize, margin, offsetx, offsety):
+    ''' For flat pixel indices pix, yields (region y index, region x index, membership mask) for every region 
+    that can contain the pixels once margins are included. '''
+    regsize = int(regsize)
+    y0, y1, x0, x1 = region_bounds(NX, NY, regsize, margin, offsetx, offsety)
+    py, px = np.divmod(pix, NX)
+    basey = (py + offsety) // regsize
+    basex = (px + offsetx) // regsize
+    nextra = -(-margin // regsize) # regions a margin can reach into
+    for ky in range(-nextra, nextra+1):
+        jy = basey + ky
+        membery = (jy >= 0) & (jy < y0.size)
+        jy = np.clip(jy, 0, y0.size-1)
+        membery &= (py >= y0[jy]) & (py < y1[jy])
+        for kx in range(-nextra, nextra+1):
+            jx = basex + kx
+            member = membery & (jx >= 0) & (jx < x0.size)
+            jx = np.clip(jx, 0, x0.size-1)
+            member &= (px >= x0[jx]) & (px < x1[jx])
+            yield jy, jx, member
+
+def region_sums(pix, vals, NX, NY, regsize, margin, offsetx, offsety):
+    ''' Sums vals, defined on flat pixel indices pix, over each region (margins included). '''
+    y0, y1, x0, x1 = region_bounds(NX, NY, regsize, margin, offsetx, offsety)
+    sums = np.zeros(y0.size*x0.size, dtype=np.float64)
+    for jy, jx, member in pixel_regions(pix, NX, NY, regsize, margin, offsetx, offsety):
+        sums += np.bincount((jy*x0.size + jx)[member], weights=vals[member], minlength=sums.size)
+    return sums.reshape(y0.size, x0.size)
+
+def in_regions(pix, reg_acpt, NX, NY, regsize, margin, offsetx, offsety):
+    ''' Boolean mask of the pixels pix that fall inside any region flagged in reg_acpt, as in clib_updt_modl. '''
+    inside = np.zeros(pix.shape, dtype=bool)
+    for jy, jx, member in pixel_regions(pix, NX, NY, regsize, margin, offsetx, offsety):
+        inside |= member & (reg_acpt[jy, jx] > 0)
+    return inside
+
+def image_model_footprint(x, y, f, imsz, nc, cf, sepcf=None):
+    ''' Sparse model evaluation. Returns the sorted flat indices of the pixels touched by the phonion PSF stamps 
+    and the summed model at those pixels, without touching the rest of the image. '''
+    if sepcf is not None:
+        ix, iy, dx, dy, f = phonion_offsets(x, y, f, imsz)
+        recon = separable_stamps(dx, dy, f, sepcf)
+    else:
+        ix, iy, dd = phonion_design_matrix(x, y, f, imsz)
+        recon = np.dot(dd, cf)
+    dy, dx = psf_stencil(nc)
+    px = ix[:, None].astype(np.int64) + dx
+    py = iy[:, None].astype(np.int64) + dy
+    inimage = (px >= 0) & (px < imsz[0]) & (py >= 0) & (py < imsz[1])
+    pix, inv = np.unique((py*imsz[0] + px)[inimage], return_inverse=True)
+    dmodel = np.bincount(inv.ravel(), weights=recon[inimage], minlength=pix.size)
+    return pix, dmodel
+
+def footprint_delta_chi2(pix, dmodel, resid, weight, imsz, regsize, margin, offsetx, offsety):
+    ''' Change in the regional chi squared when dmodel is added to the model at pixels pix, where resid = data - model. '''
+    r = resid.reshape(-1)[pix]
+    w = weight.reshape(-1)[pix]
+    return region_sums(pix, w*dmodel*(dmodel - 2*r), imsz[0], imsz[1], regsize, margin, offsetx, offsety)
+
+def separable_engine(lib):
+    ''' Separable PSF counterpart of the engine lib (None standing for NumPy), None if it has none. '''
+    if lib is None or lib is numpy_eval_modl:
+        return numpy_eval_sepa
+    if lib is numba_eval_modl:
+        return numba_eval_sepa
+    return None
+
+def image_model_eval(x, y, f, back, imsz, nc, cf, regsize=None, margin=0, offsetx=0, offsety=0, weights=None, ref=None, lib=None, template=None, wksp=None, sepcf=None):
     assert x.dtype == np.float32
     assert y.dtype == np.float32
     # assert f.dtype == np.float32
@@ -46,61 +360,45 @@ def image_model_eval(x, y, f, back, imsz, nc, cf, regsize=None, margin=0, offset
     if regsize is None:
         regsize = max(imsz[0], imsz[1])
 
-    # FIXME sometimes phonions are outside image... what is best way to handle?
-    goodsrc = (x > 0) * (x < imsz[0] - 1) * (y > 0) * (y < imsz[1] - 1)
-    x = x.compress(goodsrc)
-    y = y.compress(goodsrc)
-    f = f.compress(goodsrc)
+    if sepcf is not None and separable_engine(lib) is None:
+        # the compiled routines only take the dense cf, the separable PSF is only used there through the evaluation contexts
+        warnings.warn('separable PSF is not supported by '+getattr(lib, '__name__', str(lib))+', evaluating with the dense cf', Warning)
+        sepcf = None
 
-    nstar = x.size
-    rad = nc/2 # 12 for nc = 25
+    if sepcf is not None:
+        # separable PSF (see psf_separable_fit)
+        ix, iy, dx, dy, f = phonion_offsets(x, y, f, imsz)
+        dd = np.column_stack((f, dx, dy)).astype(np.float32)
+        cf = sepcf
+    else:
+        ix, iy, dd = phonion_design_matrix(x, y, f, imsz)
+    nstar = ix.size
 
     nregy = int(imsz[1]/regsize + 1) # assumes imsz % regsize = 0?
     nregx = int(imsz[0]/regsize + 1)
 
-    ix = np.ceil(x).astype(np.int32)
-    dx = ix - x
-    iy = np.ceil(y).astype(np.int32)
-    dy = iy - y
-
-    dd = np.column_stack((np.full(nstar, 1., dtype=np.float32), dx, dy, dx*dx, dx*dy, dy*dy, dx*dx*dx, dx*dx*dy, dx*dy*dy, dy*dy*dy)).astype(np.float32) * f[:, None]
     if lib is None:
-        image = np.full((imsz[1]+2*rad+1,imsz[0]+2*rad+1), back, dtype=np.float32)
-        recon2 = np.dot(dd, cf).reshape((nstar,nc,nc))
-        recon = np.zeros((nstar,nc,nc), dtype=np.float32)
-        recon[:,:,:] = recon2[:,:,:]
-        for i in range(nstar):
-            image[iy[i]:iy[i]+rad+rad+1,ix[i]:ix[i]+rad+rad+1] += recon[i,:,:]
-
-        image = image[rad:imsz[1]+rad,rad:imsz[0]+rad]
-
-        if ref is not None:
-            diff = ref - image
-            diff2 = np.zeros((nregy, nregx), dtype=np.float64)
-            for i in range(nregy):
-                y0 = max(i*regsize - offsety - margin, 0)
-                y1 = min((i+1)*regsize - offsety + margin, imsz[1])
-                for j in range(nregx):
-                    x0 = max(j*regsize - offsetx - margin, 0)
-                    x1 = min((j+1)*regsize - offsetx + margin, imsz[0])
-                    subdiff = diff[y0:y1,x0:x1]
-                    diff2[i,j] = np.sum(subdiff*subdiff*weights[y0:y1,x0:x1])
+        # vectorized NumPy engine, same memory layout and outputs as the C routines
+        lib = numpy_eval_modl
+        image = np.full((imsz[1], imsz[0]), back, dtype=np.float32)
     else:
         # image = np.full((imsz[1], imsz[0]), back, dtype=np.float32)
         image = np.full((imsz[0], imsz[1]), back, dtype=np.float32)
+    if sepcf is not None:
+        lib = separable_engine(lib)
 
-        recon = np.zeros((nstar,nc*nc), dtype=np.float32)
-        reftemp = ref
-        if ref is None:
-            reftemp = np.zeros((imsz[0], imsz[1]), dtype=np.float32)
-            # reftemp = np.zeros((imsz[1], imsz[0]), dtype=np.float32)
-        diff2 = np.zeros((nregy, nregx), dtype=np.float64)
-
-        if template is not None: # template
-            image += np.array(template)
-        
-        lib(imsz[0], imsz[1], nstar, nc, cf.shape[0], dd, cf, recon, ix, iy, image, reftemp, weights, diff2, regsize, margin, offsetx, offsety)
+    recon = np.zeros((nstar,nc*nc), dtype=np.float32)
+    reftemp = ref
+    if ref is None:
+        reftemp = np.zeros((imsz[0], imsz[1]), dtype=np.float32)
+        # reftemp = np.zeros((imsz[1], imsz[0]), dtype=np.float32)
+    diff2 = np.zeros((nregy, nregx), dtype=np.float64)
 
+    if template is not None: # template
+        image += np.array(template).reshape(image.shape)
+    
+    # wksp is a phonion-coalescing workspace from (clib|pcat)_wksp_alloc reused between calls, with None the C routine allocates a temporary one
+    lib(imsz[0], imsz[1], nstar, nc, cf.shape[0], dd, cf, recon, ix, iy, image, reftemp, weights, diff2, wksp, regsize, margin, offsetx, offsety)
 
     if ref is not None:
         return image, diff2
@@ -11,6 +11,60 @@
 	typeof (b) _b = (b);   \
         _a < _b ? _a : _b; })
 
+// open-addressing table used to merge stars that land on the same pixel. it is allocated once per band 
+// and reused between calls, so its size scales with the number of stars rather than the number of pixels, 
+// and only the slots filled during a call are cleared afterwards
+typedef struct {
+    int size;       // number of slots, always a power of two
+    int shift;      // 32 - log2(size), used by the multiplicative hash
+    int nused;
+    int* keys;      // pixel index held by each slot, -1 if the slot is empty
+    int* vals;      // row of the shortened A matrix for that pixel
+    int* used;      // slots filled during the current call
+} pcat_wksp;
+
+static void pcat_wksp_resize(pcat_wksp* wksp, int nstar) {
+    int i, size, shift;
+    // keep the load factor at or below one half
+    size = 16; shift = 28;
+    while (size < 2*nstar) { size *= 2; shift--; }
+    free(wksp->keys); free(wksp->vals); free(wksp->used);
+    wksp->keys = malloc(size*sizeof(int));
+    wksp->vals = malloc(size*sizeof(int));
+    wksp->used = malloc(size*sizeof(int));
+    for (i=0; i<size; i++) { wksp->keys[i] = -1; }
+    wksp->size = size;
+    wksp->shift = shift;
+    wksp->nused = 0;
+}
+
+void* pcat_wksp_alloc(int nstar) {
+    pcat_wksp* wksp = malloc(sizeof(pcat_wksp));
+    wksp->keys = NULL; wksp->vals = NULL; wksp->used = NULL;
+    pcat_wksp_resize(wksp, nstar);
+    return wksp;
+}
+
+void pcat_wksp_free(void* wksp) {
+    pcat_wksp* work = wksp;
+    if (work == NULL) { return; }
+    free(work->keys); free(work->vals); free(work->used);
+    free(work);
+}
+
+// returns the slot holding pixel idx, or the empty slot where it should go
+static int pcat_wksp_find(pcat_wksp* wksp, int idx) {
+    int slot = (int) (((unsigned int) idx * 2654435761u) >> wksp->shift);
+    while (wksp->keys[slot] != -1 && wksp->keys[slot] != idx) { slot = (slot + 1) & (wksp->size - 1); }
+    return slot;
+}
+
+static void pcat_wksp_clear(pcat_wksp* wksp) {
+    int i;
+    for (i=0; i<wksp->nused; i++) { wksp->keys[wksp->used[i]] = -1; }
+    wksp->nused = 0;
+}
+
 // void pcat_imag_acpt(int NX, int NY, float* image, float* image_acpt, int* reg_acpt, int regsize, int margin, int offsetx, int offsety) {
 void pcat_imag_acpt(int NX, int NY, float* image, float* image_acpt, int* reg_acpt, int regsize, int margin, int offsetx, int offsety) {
     int NREGX = (NX / regsize) + 1;
@@ -50,7 +104,7 @@ void pcat_like_eval(int NX, int NY, float* image, float* ref, float* weight, dou
 }
 
 void pcat_model_eval(int NX, int NY, int nstar, int nc, int k, float* A, float* B, float* C, int* x,
-	int* y, float* image, float* ref, float* weight, double* diff2, int regsize, int margin,
+	int* y, float* image, float* ref, float* weight, double* diff2, void* wksp, int regsize, int margin,
 	int offsetx, int offsety)
 {
     int      i,i2,imax,j,j2,jmax,rad,istar,xx,yy;
@@ -63,19 +117,26 @@ void pcat_model_eval(int NX, int NY, int nstar, int nc, int k, float* A, float*
 
     // overwrite and shorten A matrix
     // save time if there are many sources per pixel
-    int hash[NY*NX];
-    for (i=0; i<NY*NX; i++) { hash[i] = -1; }
+    // callers that don't hold a workspace get a temporary one
+    pcat_wksp* work = wksp;
+    bool free_work = (work == NULL);
+    if (free_work) { work = pcat_wksp_alloc(nstar); }
+    else if (work->size < 2*nstar) { pcat_wksp_resize(work, nstar); }
     int jstar = 0;
+    int slot;
     for (istar = 0; istar < nstar; istar++)
     {
         xx = x[istar];
         yy = y[istar];
         int idx = yy*NX+xx;
-        if (hash[idx] != -1) {
-            for (i=0; i<k; i++) { A[hash[idx]*k+i] += A[istar*k+i]; }
+        slot = pcat_wksp_find(work, idx);
+        if (work->keys[slot] != -1) {
+            for (i=0; i<k; i++) { A[work->vals[slot]*k+i] += A[istar*k+i]; }
         }
         else {
-            hash[idx] = jstar;
+            work->keys[slot] = idx;
+            work->vals[slot] = jstar;
+            work->used[work->nused++] = slot;
             for (i=0; i<k; i++) { A[jstar*k+i] = A[istar*k+i]; }
             x[jstar] = x[istar];
             y[jstar] = y[istar];
@@ -83,6 +144,8 @@ void pcat_model_eval(int NX, int NY, int nstar, int nc, int k, float* A, float*
         }
     }
     nstar = jstar;
+    if (free_work) { pcat_wksp_free(work); }
+    else { pcat_wksp_clear(work); }
 
     //  matrix multiplication
     cblas_sgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
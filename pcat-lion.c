@@ -1,7 +1,12 @@
 #include <stdlib.h>
+#include <string.h>
+#include <math.h>
 #include <stdbool.h>
 #include "mkl_cblas.h"
 #include "i_malloc.h"
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 #define max(a,b) \
     ({ typeof (a) _a = (a);    \
 	typeof (b) _b = (b);   \
@@ -11,14 +16,78 @@
 	typeof (b) _b = (b);   \
         _a < _b ? _a : _b; })
 
+// sets the number of threads used by the region kernels, no-op when compiled without OpenMP
+void pcat_set_nthreads(int nthreads) {
+#ifdef _OPENMP
+    if (nthreads > 0)
+        omp_set_num_threads(nthreads);
+#endif
+}
+
+// open-addressing table used to merge stars that land on the same pixel. it is allocated once per band 
+// and reused between calls, so its size scales with the number of stars rather than the number of pixels, 
+// and only the slots filled during a call are cleared afterwards
+typedef struct {
+    int size;       // number of slots, always a power of two
+    int shift;      // 32 - log2(size), used by the multiplicative hash
+    int nused;
+    int* keys;      // pixel index held by each slot, -1 if the slot is empty
+    int* vals;      // row of the shortened A matrix for that pixel
+    int* used;      // slots filled during the current call
+} pcat_wksp;
+
+static void pcat_wksp_resize(pcat_wksp* wksp, int nstar) {
+    int i, size, shift;
+    // keep the load factor at or below one half
+    size = 16; shift = 28;
+    while (size < 2*nstar) { size *= 2; shift--; }
+    free(wksp->keys); free(wksp->vals); free(wksp->used);
+    wksp->keys = malloc(size*sizeof(int));
+    wksp->vals = malloc(size*sizeof(int));
+    wksp->used = malloc(size*sizeof(int));
+    for (i=0; i<size; i++) { wksp->keys[i] = -1; }
+    wksp->size = size;
+    wksp->shift = shift;
+    wksp->nused = 0;
+}
+
+void* pcat_wksp_alloc(int nstar) {
+    pcat_wksp* wksp = malloc(sizeof(pcat_wksp));
+    wksp->keys = NULL; wksp->vals = NULL; wksp->used = NULL;
+    pcat_wksp_resize(wksp, nstar);
+    return wksp;
+}
+
+void pcat_wksp_free(void* wksp) {
+    pcat_wksp* work = wksp;
+    if (work == NULL) { return; }
+    free(work->keys); free(work->vals); free(work->used);
+    free(work);
+}
+
+// returns the slot holding pixel idx, or the empty slot where it should go
+static int pcat_wksp_find(pcat_wksp* wksp, int idx) {
+    int slot = (int) (((unsigned int) idx * 2654435761u) >> wksp->shift);
+    while (wksp->keys[slot] != -1 && wksp->keys[slot] != idx) { slot = (slot + 1) & (wksp->size - 1); }
+    return slot;
+}
+
+static void pcat_wksp_clear(pcat_wksp* wksp) {
+    int i;
+    for (i=0; i<wksp->nused; i++) { wksp->keys[wksp->used[i]] = -1; }
+    wksp->nused = 0;
+}
+
 void pcat_imag_acpt(int NX, int NY, float* image, float* image_acpt, int* reg_acpt, int regsize, int margin, int offsetx, int offsety) {
     int NREGX = (NX / regsize) + 1;
     int NREGY = (NY / regsize) + 1;
     int y0, y1, x0, x1, i, j, ii, jj;
+    // regions overlap only through their margins, where both write the same value
+    #pragma omp parallel for collapse(2) private(y0, y1, x0, x1, ii, jj) schedule(static)
     for (j=0 ; j < NREGY ; j++) {
-        y0 = max(j*regsize-offsety-margin, 0);
-        y1 = min((j+1)*regsize-offsety+margin, NY);
         for (i=0 ; i < NREGX ; i++) {
+                y0 = max(j*regsize-offsety-margin, 0);
+                y1 = min((j+1)*regsize-offsety+margin, NY);
                 x0 = max(i*regsize-offsetx-margin, 0);
                 x1 = min((i+1)*regsize-offsetx+margin, NX);
                 if (reg_acpt[j*NREGX+i] > 0) {
@@ -34,47 +103,86 @@ void pcat_like_eval(int NX, int NY, float* image, float* ref, float* weight, dou
     int NREGX = (NX / regsize) + 1;
     int NREGY = (NY / regsize) + 1;
     int y0, y1, x0, x1, i, j, ii, jj;
+    double diff2reg;
+    // each region only writes its own diff2 element
+    #pragma omp parallel for collapse(2) private(y0, y1, x0, x1, ii, jj, diff2reg) schedule(static)
     for (j=0 ; j < NREGY ; j++) {
-        y0 = max(j*regsize-offsety-margin, 0);
-        y1 = min((j+1)*regsize-offsety+margin, NY);
         for (i=0 ; i < NREGX ; i++) {
+                y0 = max(j*regsize-offsety-margin, 0);
+                y1 = min((j+1)*regsize-offsety+margin, NY);
                 x0 = max(i*regsize-offsetx-margin, 0);
                 x1 = min((i+1)*regsize-offsetx+margin, NX);
-                diff2[j*NREGX+i] = 0.;
+                diff2reg = 0.;
                 for (jj=y0 ; jj<y1; jj++)
                  for (ii=x0 ; ii<x1; ii++)
-                    diff2[j*NREGX+i] += (image[jj*NX+ii]-ref[jj*NX+ii])*(image[jj*NX+ii]-ref[jj*NX+ii]) * weight[jj*NX+ii];
+                    diff2reg += (image[jj*NX+ii]-ref[jj*NX+ii])*(image[jj*NX+ii]-ref[jj*NX+ii]) * weight[jj*NX+ii];
+                diff2[j*NREGX+i] = diff2reg;
         }
     }
 }
 
+// adds the nstar stamps in C, centered on pixels (x, y), to image. stamps from different stars overlap, so each thread 
+// owns a strip of rows and only inserts the part of every stamp that falls in it
+static void pcat_insert_psfs(int NX, int NY, int nstar, int nc, float* C, int* x, int* y, float* image)
+{
+    int i, i2, imax, j, j2, jmin, jmax, rad, istar, xx, yy;
+    int nstrip, s, jstrip0, jstrip1;
+    rad = nc/2;
+    nstrip = 1;
+#ifdef _OPENMP
+    nstrip = min(omp_get_max_threads(), NY);
+#endif
+    #pragma omp parallel for private(istar, i, i2, imax, j, j2, jmin, jmax, xx, yy, jstrip0, jstrip1) schedule(static)
+    for (s = 0 ; s < nstrip ; s++)
+    {
+	jstrip0 = (s*NY) / nstrip;
+	jstrip1 = ((s+1)*NY) / nstrip - 1;
+	for (istar = 0 ; istar < nstar ; istar++)
+	{
+	    xx = x[istar];
+	    yy = y[istar];
+	    imax = min(xx+rad,NX-1);
+	    jmin = max(max(yy-rad,0),jstrip0);
+	    jmax = min(min(yy+rad,NY-1),jstrip1);
+	    for (j = jmin, j2 = (istar*nc+j-yy+rad)*nc ; j <= jmax ; j++, j2+=nc)
+		for (i = max(xx-rad,0), i2 = i-xx+rad ; i <= imax ; i++, i2++)
+		    image[j*NX+i] += C[i2+j2];
+	}
+    }
+}
+
 void pcat_model_eval(int NX, int NY, int nstar, int nc, int k, float* A, float* B, float* C, int* x,
-	int* y, float* image, float* ref, float* weight, double* diff2, int regsize, int margin,
+	int* y, float* image, float* ref, float* weight, double* diff2, void* wksp, int regsize, int margin,
 	int offsetx, int offsety)
 {
-    int      i,i2,imax,j,j2,jmax,rad,istar,xx,yy;
+    int      i,istar,xx,yy;
     float    alpha, beta;
 
     int n = nc*nc;
-    rad = nc/2;
-
     alpha = 1.0; beta = 0.0;
 
     // overwrite and shorten A matrix
     // save time if there are many sources per pixel
-    int hash[NY*NX];
-    for (i=0; i<NY*NX; i++) { hash[i] = -1; }
+    // callers that don't hold a workspace get a temporary one
+    pcat_wksp* work = wksp;
+    bool free_work = (work == NULL);
+    if (free_work) { work = pcat_wksp_alloc(nstar); }
+    else if (work->size < 2*nstar) { pcat_wksp_resize(work, nstar); }
     int jstar = 0;
+    int slot;
     for (istar = 0; istar < nstar; istar++)
     {
         xx = x[istar];
         yy = y[istar];
         int idx = yy*NX+xx;
-        if (hash[idx] != -1) {
-            for (i=0; i<k; i++) { A[hash[idx]*k+i] += A[istar*k+i]; }
+        slot = pcat_wksp_find(work, idx);
+        if (work->keys[slot] != -1) {
+            for (i=0; i<k; i++) { A[work->vals[slot]*k+i] += A[istar*k+i]; }
         }
         else {
-            hash[idx] = jstar;
+            work->keys[slot] = idx;
+            work->vals[slot] = jstar;
+            work->used[work->nused++] = slot;
             for (i=0; i<k; i++) { A[jstar*k+i] = A[istar*k+i]; }
             x[jstar] = x[istar];
             y[jstar] = y[istar];
@@ -82,22 +190,233 @@ void pcat_model_eval(int NX, int NY, int nstar, int nc, int k, float* A, float*
         }
     }
     nstar = jstar;
+    if (free_work) { pcat_wksp_free(work); }
+    else { pcat_wksp_clear(work); }
 
     //  matrix multiplication
     cblas_sgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
         nstar, n, k, alpha, A, k, B, n, beta, C, n);
 
-    //  loop over stars, insert psfs into image    
+    //  loop over stars, insert psfs into image
+    pcat_insert_psfs(NX, NY, nstar, nc, C, x, y, image);
+
+    pcat_like_eval(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety);
+}
+
+// per band evaluation context, created once so that the PSF coefficients, weights, region geometry and the 
+// star scratch buffers don't have to be converted and passed over from Python on every proposal
+typedef struct {
+    int NX, NY, nc, k, regsize;
+    float* cf;      // PSF polynomial coefficients, k x nc*nc
+    float* weight;  // pixel weights, NY x NX
+    int nmax;       // number of stars the scratch buffers below can hold
+    float* A;
+    float* C;
+    int* x;
+    int* y;
+    float* xb;
+    float* yb;
+    double* diff2b;
+    pcat_wksp* wksp;
+    // fast astrometry arrays from the pivot band to this one (xtrans, ytrans, dxpdx, dypdx, dxpdy, dypdy), NULL for 
+    // the pivot band and for bands sharing its pixel grid
+    double* astr;
+    int NXastr, NYastr;
+    // cubic coefficients of the x and y profiles of a separable PSF (2 x 4 x nc, see psf_separable_fit), NULL when 
+    // the polynomial PSF coefficients are used
+    float* sepcf;
+} pcat_ctx;
+
+static void pcat_ctx_resize(pcat_ctx* ctx, int nstar) {
+    ctx->nmax = max(nstar, 1);
+    free(ctx->A); free(ctx->C); free(ctx->x); free(ctx->y); free(ctx->xb); free(ctx->yb);
+    ctx->A = malloc(ctx->nmax*ctx->k*sizeof(float));
+    ctx->C = malloc(ctx->nmax*ctx->nc*ctx->nc*sizeof(float));
+    ctx->x = malloc(ctx->nmax*sizeof(int));
+    ctx->y = malloc(ctx->nmax*sizeof(int));
+    ctx->xb = malloc(ctx->nmax*sizeof(float));
+    ctx->yb = malloc(ctx->nmax*sizeof(float));
+}
+
+void* pcat_ctx_alloc(int NX, int NY, int nc, int k, float* cf, float* weight, int regsize, int nstar) {
+    pcat_ctx* ctx = malloc(sizeof(pcat_ctx));
+    ctx->NX = NX; ctx->NY = NY; ctx->nc = nc; ctx->k = k; ctx->regsize = regsize;
+    ctx->cf = malloc(k*nc*nc*sizeof(float));
+    memcpy(ctx->cf, cf, k*nc*nc*sizeof(float));
+    ctx->weight = malloc(NX*NY*sizeof(float));
+    memcpy(ctx->weight, weight, NX*NY*sizeof(float));
+    ctx->A = NULL; ctx->C = NULL; ctx->x = NULL; ctx->y = NULL; ctx->xb = NULL; ctx->yb = NULL;
+    pcat_ctx_resize(ctx, nstar);
+    ctx->diff2b = malloc(((NX / regsize) + 1)*((NY / regsize) + 1)*sizeof(double));
+    ctx->wksp = pcat_wksp_alloc(nstar);
+    ctx->astr = NULL;
+    ctx->sepcf = NULL;
+    return ctx;
+}
+
+// copies the fast astrometry arrays (6 x NYastr x NXastr, see wcs_astrometry.fit_astrom_arrays) mapping pivot band 
+// positions onto this band
+void pcat_ctx_astr(void* ctx, double* astr, int NXastr, int NYastr) {
+    pcat_ctx* c = ctx;
+    free(c->astr);
+    c->astr = malloc(6*NXastr*NYastr*sizeof(double));
+    memcpy(c->astr, astr, 6*NXastr*NYastr*sizeof(double));
+    c->NXastr = NXastr; c->NYastr = NYastr;
+}
+
+// switches the context to the separable PSF mode, where each stamp is the outer product of two 1D sub-pixel kernels
+void pcat_ctx_separable(void* ctx, float* sepcf) {
+    pcat_ctx* c = ctx;
+    free(c->sepcf);
+    c->sepcf = malloc(8*c->nc*sizeof(float));
+    memcpy(c->sepcf, sepcf, 8*c->nc*sizeof(float));
+}
+
+// separable PSF stamps for the nstar stars whose flux and sub-pixel offsets are in the first three columns of A
+static void pcat_separable_psfs(pcat_ctx* c, int nstar) {
+    int istar, i, j;
+    int nc = c->nc;
+    float* sx = c->sepcf;
+    float* sy = c->sepcf + 4*nc;
+    #pragma omp parallel for private(i, j) schedule(static)
     for (istar = 0 ; istar < nstar ; istar++)
     {
-	xx = x[istar];
-	yy = y[istar];
-	imax = min(xx+rad,NX-1);
-	jmax = min(yy+rad,NY-1);
-	for (j = max(yy-rad,0), j2 = (istar*nc+j-yy+rad)*nc ; j <= jmax ; j++, j2+=nc)
-	    for (i = max(xx-rad,0), i2 = i-xx+rad ; i <= imax ; i++, i2++)
-		image[j*NX+i] += C[i2+j2];
+        float kx[nc], ky[nc];
+        float* A = c->A + istar*c->k;
+        float* C = c->C + istar*nc*nc;
+        float dx = A[1];
+        float dy = A[2];
+        for (i = 0 ; i < nc ; i++)
+        {
+            kx[i] = sx[i] + dx*(sx[i+nc] + dx*(sx[i+2*nc] + dx*sx[i+3*nc]));
+            ky[i] = A[0] * (sy[i] + dy*(sy[i+nc] + dy*(sy[i+2*nc] + dy*sy[i+3*nc])));
+        }
+        for (j = 0 ; j < nc ; j++)
+            for (i = 0 ; i < nc ; i++)
+                C[j*nc+i] = ky[j]*kx[i];
     }
+}
 
-    pcat_like_eval(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety);
+void pcat_ctx_free(void* ctx) {
+    pcat_ctx* c = ctx;
+    if (c == NULL) { return; }
+    free(c->cf); free(c->weight);
+    free(c->A); free(c->C); free(c->x); free(c->y); free(c->xb); free(c->yb);
+    free(c->diff2b); free(c->astr); free(c->sepcf);
+    pcat_wksp_free(c->wksp);
+    free(c);
+}
+
+static void pcat_ctx_model(pcat_ctx* c, int nstar, float* x, float* y, float* f, double fscale, float back, float* template,
+	float* image, float* ref, double* diff2, int margin, int offsetx, int offsety)
+{
+    int istar, i, ngood;
+    double dx, dy;
+    float fs;
+    float* A;
+
+    if (nstar > c->nmax) { pcat_ctx_resize(c, nstar); }
+
+    if (template != NULL) { for (i=0; i<c->NX*c->NY; i++) { image[i] = back + template[i]; } }
+    else { for (i=0; i<c->NX*c->NY; i++) { image[i] = back; } }
+
+    // cubic sub-pixel design matrix, same terms and order as phonion_design_matrix (so k is 10)
+    ngood = 0;
+    for (istar = 0; istar < nstar; istar++)
+    {
+        if (!(x[istar] > 0 && x[istar] < c->NX-1 && y[istar] > 0 && y[istar] < c->NY-1)) { continue; }
+        c->x[ngood] = (int) ceilf(x[istar]);
+        c->y[ngood] = (int) ceilf(y[istar]);
+        dx = c->x[ngood] - (double) x[istar];
+        dy = c->y[ngood] - (double) y[istar];
+        fs = (float) (fscale*f[istar]);
+        A = c->A + ngood*c->k;
+        if (c->sepcf != NULL)
+        {
+            // separable PSF, only the flux and the offsets are needed
+            A[0] = fs; A[1] = (float) dx; A[2] = (float) dy;
+            ngood++;
+            continue;
+        }
+        A[0] = fs;
+        A[1] = (float) dx * fs;
+        A[2] = (float) dy * fs;
+        A[3] = (float) (dx*dx) * fs;
+        A[4] = (float) (dx*dy) * fs;
+        A[5] = (float) (dy*dy) * fs;
+        A[6] = (float) (dx*dx*dx) * fs;
+        A[7] = (float) (dx*dx*dy) * fs;
+        A[8] = (float) (dx*dy*dy) * fs;
+        A[9] = (float) (dy*dy*dy) * fs;
+        ngood++;
+    }
+
+    if (c->sepcf != NULL)
+    {
+        pcat_separable_psfs(c, ngood);
+        pcat_insert_psfs(c->NX, c->NY, ngood, c->nc, c->C, c->x, c->y, image);
+        pcat_like_eval(c->NX, c->NY, image, ref, c->weight, diff2, c->regsize, margin, offsetx, offsety);
+    }
+    else
+        pcat_model_eval(c->NX, c->NY, ngood, c->nc, c->k, c->A, c->cf, c->C, c->x, c->y, image, ref, c->weight, diff2, 
+            c->wksp, c->regsize, margin, offsetx, offsety);
+}
+
+// fills image with the background (plus an optional template), adds the PSFs of the stars at (x, y) with 
+// fluxes f and fills diff2 with the regional chi squared against ref. stars within a pixel of the image 
+// edge are dropped, as in image_model_eval
+void pcat_ctx_eval(void* ctx, int nstar, float* x, float* y, float* f, float back, float* template,
+	float* image, float* ref, double* diff2, int margin, int offsetx, int offsety)
+{
+    pcat_ctx_model(ctx, nstar, x, y, f, 1., back, template, image, ref, diff2, margin, offsetx, offsety);
+}
+
+// evaluates all bands in one call from pivot band positions. for each band the positions are moved onto its pixel grid 
+// with the fast astrometry arrays (first order expansion around the nearest lattice point, as in 
+// wcs_astrometry.transform_q), the fluxes in row b of f are scaled by fscale[b] and the model image and regional 
+// chi squared are computed as in pcat_ctx_eval. diff2 is the sum of the regional chi squared over bands
+void pcat_ctx_eval_multiband(int nbands, void** ctx, int nstar, float* x, float* y, float* f, double* fscale, float* back,
+	void** templates, void** images, void** refs, double* diff2, int* margin, int* offsetx, int* offsety)
+{
+    int b, istar, i, xi, yi, nreg, na;
+    float ddx, ddy;
+    pcat_ctx* c;
+    float* xx;
+    float* yy;
+
+    for (b = 0 ; b < nbands ; b++)
+    {
+        c = ctx[b];
+        if (nstar > c->nmax) { pcat_ctx_resize(c, nstar); }
+
+        xx = x;
+        yy = y;
+        if (c->astr != NULL)
+        {
+            na = c->NXastr*c->NYastr;
+            for (istar = 0 ; istar < nstar ; istar++)
+            {
+                xi = (int) floorf(x[istar] + 0.5f);
+                yi = (int) floorf(y[istar] + 0.5f);
+                ddx = x[istar] - xi;
+                ddy = y[istar] - yi;
+                // stars are kept inside the pivot image, clipping only guards the lookup at its far edges
+                xi = min(max(xi, 0), c->NXastr-1);
+                yi = min(max(yi, 0), c->NYastr-1);
+                i = yi*c->NXastr + xi;
+                c->xb[istar] = (float) (c->astr[i] + ddx*c->astr[2*na+i] + ddy*c->astr[4*na+i]);
+                c->yb[istar] = (float) (c->astr[na+i] + ddx*c->astr[3*na+i] + ddy*c->astr[5*na+i]);
+            }
+            xx = c->xb;
+            yy = c->yb;
+        }
+
+        pcat_ctx_model(c, nstar, xx, yy, f + b*nstar, fscale[b], back[b], templates[b], images[b], refs[b], 
+            b == 0 ? diff2 : c->diff2b, margin[b], offsetx[b], offsety[b]);
+        if (b > 0)
+        {
+            nreg = ((c->NX / c->regsize) + 1)*((c->NY / c->regsize) + 1);
+            for (i = 0 ; i < nreg ; i++) { diff2[i] += c->diff2b[i]; }
+        }
+    }
 }
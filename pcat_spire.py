@@ -2,7 +2,7 @@ from __future__ import print_function
 import numpy as np
 import numpy.ctypeslib as npct
 import ctypes
-from ctypes import c_int, c_double
+from ctypes import c_int, c_double, c_float, c_void_p, POINTER
 # in order for visual=True to work, interactive backend should be loaded before importing pyplot
 import matplotlib
 #matplotlib.use('TkAgg')
@@ -13,15 +13,25 @@ import os.path
 from os import path
 import sys
 import warnings
+import multiprocessing
+import multiprocessing.connection
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 import scipy.stats as stats
 from scipy.ndimage import gaussian_filter
-from image_eval import psf_poly_fit, image_model_eval
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from image_eval import psf_poly_fit, image_model_eval, numpy_lib, numba_lib, numba, image_model_footprint, footprint_delta_chi2, in_regions
 from fast_astrom import *
 import pickle
 from spire_data_utils import *
 #from spire_roc import *
 from spire_plotting_fns import *
 from fourier_bkg_modl import * # fourier comps
+from chain_diagnostics import split_rhat, effective_sample_size
+try:
+	import h5py
+except ImportError: # without it the samples are kept in memory and saved to chain.npz
+	h5py = None
 
 
 
@@ -47,6 +57,7 @@ def save_params(dir, gdat):
 	# save parameters as dictionary, then pickle them to txt file
 	param_dict = vars(gdat).copy()
 	param_dict['fc_templates'] = None # these take up too much space and not necessary
+	param_dict['flog'] = None # open log file of the run, can't be pickled
 	
 	with open(dir+'/params.txt', 'wb') as file:
 		file.write(pickle.dumps(param_dict))
@@ -61,37 +72,223 @@ def save_params(dir, gdat):
 def fluxes_to_color(flux1, flux2):
 	return 2.5*np.log10(flux1/flux2)
 
-def initialize_c(gdat, libmmult, cblas=False):
+def initialize_c(gdat, libmmult, cblas=False, dat=None):
 
 	if gdat.verbtype > 1:
 		print('initializing c routines and data structs', file=gdat.flog)
 
 	array_2d_float = npct.ndpointer(dtype=np.float32, ndim=2, flags="C_CONTIGUOUS")
 	array_1d_int = npct.ndpointer(dtype=np.int32, ndim=1, flags="C_CONTIGUOUS")
+	array_1d_float = npct.ndpointer(dtype=np.float32, ndim=1, flags="C_CONTIGUOUS")
+	array_1d_double = npct.ndpointer(dtype=np.float64, ndim=1, flags="C_CONTIGUOUS")
 	array_2d_double = npct.ndpointer(dtype=np.float64, ndim=2, flags="C_CONTIGUOUS")
+	array_3d_double = npct.ndpointer(dtype=np.float64, ndim=3, flags="C_CONTIGUOUS")
+	array_3d_float = npct.ndpointer(dtype=np.float32, ndim=3, flags="C_CONTIGUOUS")
 	array_2d_int = npct.ndpointer(dtype=np.int32, ndim=2, flags="C_CONTIGUOUS")
 
 	if cblas:
-		if os.path.getmtime('pcat-lion.c') > os.path.getmtime('pcat-lion.so'):
-			warnings.warn('pcat-lion.c modified after compiled pcat-lion.so', Warning)		
-				
 		libmmult.pcat_model_eval.restype = None
-		libmmult.pcat_model_eval.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
+		libmmult.pcat_model_eval.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_void_p, c_int, c_int, c_int, c_int]
+		libmmult.pcat_wksp_alloc.restype = c_void_p
+		libmmult.pcat_wksp_alloc.argtypes = [c_int]
+		libmmult.pcat_wksp_free.restype = None
+		libmmult.pcat_wksp_free.argtypes = [c_void_p]
+		libmmult.pcat_ctx_alloc.restype = c_void_p
+		libmmult.pcat_ctx_alloc.argtypes = [c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, c_int, c_int]
+		libmmult.pcat_ctx_free.restype = None
+		libmmult.pcat_ctx_free.argtypes = [c_void_p]
+		libmmult.pcat_ctx_eval.restype = None
+		libmmult.pcat_ctx_eval.argtypes = [c_void_p, c_int, array_1d_float, array_1d_float, array_1d_float, c_float, c_void_p, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int]
+		libmmult.pcat_ctx_astr.restype = None
+		libmmult.pcat_ctx_astr.argtypes = [c_void_p, array_3d_double, c_int, c_int]
+		libmmult.pcat_ctx_eval_multiband.restype = None
+		libmmult.pcat_ctx_eval_multiband.argtypes = [c_int, POINTER(c_void_p), c_int, array_1d_float, array_1d_float, array_2d_float, array_1d_double, array_1d_float, \
+													POINTER(c_void_p), POINTER(c_void_p), POINTER(c_void_p), array_2d_double, array_1d_int, array_1d_int, array_1d_int]
+		libmmult.pcat_ctx_separable.restype = None
+		libmmult.pcat_ctx_separable.argtypes = [c_void_p, array_3d_float]
+		ctx_alloc, ctx_astr, ctx_sepa = libmmult.pcat_ctx_alloc, libmmult.pcat_ctx_astr, libmmult.pcat_ctx_separable
 		libmmult.pcat_imag_acpt.restype = None
 		libmmult.pcat_imag_acpt.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_int, c_int, c_int, c_int, c_int]
 		libmmult.pcat_like_eval.restype = None
 		libmmult.pcat_like_eval.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
+		if hasattr(libmmult, 'pcat_set_nthreads'): # libraries compiled before the OpenMP kernels don't have this
+			libmmult.pcat_set_nthreads.restype = None
+			libmmult.pcat_set_nthreads.argtypes = [c_int]
+			libmmult.pcat_set_nthreads(gdat.nthreads)
+		elif gdat.nthreads > 1:
+			warnings.warn('compiled library has no OpenMP support, running single threaded', Warning)
 
 	else:
-		if os.path.getmtime('blas.c') > os.path.getmtime('blas.so'):
-			warnings.warn('blas.c modified after compiled blas.so', Warning)		
-		
 		libmmult.clib_eval_modl.restype = None
-		libmmult.clib_eval_modl.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
+		libmmult.clib_eval_modl.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_void_p, c_int, c_int, c_int, c_int]
+		libmmult.clib_wksp_alloc.restype = c_void_p
+		libmmult.clib_wksp_alloc.argtypes = [c_int]
+		libmmult.clib_wksp_free.restype = None
+		libmmult.clib_wksp_free.argtypes = [c_void_p]
+		libmmult.clib_ctxt_alloc.restype = c_void_p
+		libmmult.clib_ctxt_alloc.argtypes = [c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, c_int, c_int]
+		libmmult.clib_ctxt_free.restype = None
+		libmmult.clib_ctxt_free.argtypes = [c_void_p]
+		libmmult.clib_ctxt_eval.restype = None
+		libmmult.clib_ctxt_eval.argtypes = [c_void_p, c_int, array_1d_float, array_1d_float, array_1d_float, c_float, c_void_p, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int]
+		libmmult.clib_ctxt_astr.restype = None
+		libmmult.clib_ctxt_astr.argtypes = [c_void_p, array_3d_double, c_int, c_int]
+		libmmult.clib_ctxt_eval_mult.restype = None
+		libmmult.clib_ctxt_eval_mult.argtypes = [c_int, POINTER(c_void_p), c_int, array_1d_float, array_1d_float, array_2d_float, array_1d_double, array_1d_float, \
+												POINTER(c_void_p), POINTER(c_void_p), POINTER(c_void_p), array_2d_double, array_1d_int, array_1d_int, array_1d_int]
+		libmmult.clib_ctxt_sepa.restype = None
+		libmmult.clib_ctxt_sepa.argtypes = [c_void_p, array_3d_float]
+		ctx_alloc, ctx_astr, ctx_sepa = libmmult.clib_ctxt_alloc, libmmult.clib_ctxt_astr, libmmult.clib_ctxt_sepa
 		libmmult.clib_updt_modl.restype = None
 		libmmult.clib_updt_modl.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_int, c_int, c_int, c_int, c_int]
 		libmmult.clib_eval_llik.restype = None
 		libmmult.clib_eval_llik.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
+		if hasattr(libmmult, 'clib_set_nthreads'): # libraries compiled before the OpenMP kernels don't have this
+			libmmult.clib_set_nthreads.restype = None
+			libmmult.clib_set_nthreads.argtypes = [c_int]
+			libmmult.clib_set_nthreads(gdat.nthreads)
+		elif gdat.nthreads > 1:
+			warnings.warn('compiled library has no OpenMP support, running single threaded', Warning)
+
+	# persistent per-band evaluation contexts holding the PSF coefficients, weights, region geometry and scratch buffers,
+	# so that proposals only pass their phonions to the C library
+	gdat.eval_ctxs = None
+	if dat is not None:
+		gdat.eval_ctxs = [ctx_alloc(gdat.imszs[b][0], gdat.imszs[b][1], dat.ncs[b], np.array(dat.cfs[b]).shape[0], \
+									np.ascontiguousarray(dat.cfs[b], dtype=np.float32), np.ascontiguousarray(dat.weights[b], dtype=np.float32), \
+									int(gdat.regsizes[b]), 2*gdat.max_nsrc) for b in range(gdat.nbands)]
+		# bands on a different pixel grid than the pivot band get the fast astrometry arrays used by the fused multiband kernel
+		for b in range(1, gdat.nbands):
+			if gdat.bands[b] != gdat.bands[0]:
+				astr = np.ascontiguousarray(dat.fast_astrom.all_fast_arrays[b-1], dtype=np.float64)
+				ctx_astr(gdat.eval_ctxs[b], astr, astr.shape[2], astr.shape[1])
+		if gdat.separable_psf:
+			for b in range(gdat.nbands):
+				ctx_sepa(gdat.eval_ctxs[b], np.ascontiguousarray(dat.sepcfs[b], dtype=np.float32))
+
+def free_c(gdat, libmmult, cblas=False):
+	''' Releases the evaluation contexts created by initialize_c. '''
+	if getattr(gdat, 'eval_ctxs', None) is not None:
+		ctx_free = libmmult.pcat_ctx_free if cblas else libmmult.clib_ctxt_free
+		for ctx in gdat.eval_ctxs:
+			ctx_free(ctx)
+	gdat.eval_ctxs = None
+
+# evaluation backends that can stand in for libmmult. Compiled ones give their source, shared library, and a routine that 
+# builds older than the current interface lack. cblas marks libraries exporting the pcat_* (MKL) instead of the clib_* names
+eval_backends = dict({'mkl':dict(src='pcat-lion.c', lib='pcat-lion.so', cblas=True, symb='pcat_ctx_separable'), \
+					'openblas':dict(src='blas-open.c', lib='blas-open.so', cblas=False, symb='clib_ctxt_sepa'), \
+					'blas':dict(src='blas.c', lib='blas.so', cblas=False, symb='clib_ctxt_sepa'), \
+					'numba':dict(cblas=False), \
+					'numpy':dict(cblas=False)})
+
+def load_eval_backend(name, libdir=None):
+	''' Returns the libmmult object of backend name, or None if it is not available on this machine (library not compiled 
+	or out of date, missing shared dependencies such as MKL, or numba not installed). Compiled libraries are looked up in 
+	libdir, which defaults to the directory of this module. '''
+	spec = eval_backends[name]
+	if name == 'numpy':
+		return numpy_lib()
+	if name == 'numba':
+		return numba_lib() if numba is not None else None
+
+	if libdir is None:
+		libdir = os.path.dirname(os.path.abspath(__file__))
+	libpath = os.path.join(libdir, spec['lib'])
+	if not os.path.exists(libpath):
+		return None
+	srcpath = os.path.join(libdir, spec['src'])
+	if os.path.exists(srcpath) and os.path.getmtime(srcpath) > os.path.getmtime(libpath):
+		warnings.warn(spec['src']+' modified after compiled '+spec['lib'], Warning)
+	try:
+		libmmult = ctypes.cdll[libpath]
+	except OSError:
+		return None
+	if not hasattr(libmmult, spec['symb']):
+		warnings.warn(spec['lib']+' was compiled from an older '+spec['src']+', recompile it to use it', Warning)
+		return None
+	return libmmult
+
+def time_eval_backend(gdat, dat, name, libmmult, nphon=None, min_time=0.05, nrepeat=3):
+	''' Best wall time in seconds of one likelihood evaluation of a proposal with nphon phonions in every band, using 
+	backend name on the image sizes, PSFs and weights of dat. The number of evaluations per timing is doubled until it 
+	takes at least min_time, and the best of nrepeat timings is kept. '''
+	if nphon is None:
+		# roughly a perturbation of a quarter of the catalog (one region parity), with two phonions per source
+		nphon = int(min(gdat.nominal_nsrc, 2*gdat.max_nsrc))
+	rng = np.random.RandomState(0)
+	props = []
+	for b in range(gdat.nbands):
+		xb = (rng.uniform(size=nphon)*(gdat.imszs[b][0]-1)).astype(np.float32)
+		yb = (rng.uniform(size=nphon)*(gdat.imszs[b][1]-1)).astype(np.float32)
+		fb = (0.01*rng.uniform(size=nphon)).astype(np.float32)
+		props.append((xb, yb, fb))
+	ref = [np.ascontiguousarray(dat.data_array[b], dtype=np.float32) for b in range(gdat.nbands)]
+
+	compiled = 'lib' in eval_backends[name]
+	if compiled:
+		cblas = eval_backends[name]['cblas']
+		initialize_c(gdat, libmmult, cblas=cblas, dat=dat)
+		ctx_eval = libmmult.pcat_ctx_eval if cblas else libmmult.clib_ctxt_eval
+		modls = [np.empty_like(ref[b]) for b in range(gdat.nbands)]
+		diff2s = [np.empty((int(gdat.imszs[b][1]/gdat.regsizes[b] + 1), int(gdat.imszs[b][0]/gdat.regsizes[b] + 1)), dtype=np.float64) for b in range(gdat.nbands)]
+
+		def evaluate():
+			for b in range(gdat.nbands):
+				ctx_eval(gdat.eval_ctxs[b], nphon, props[b][0], props[b][1], props[b][2], 0., None, modls[b], ref[b], diff2s[b], 0, 0, 0)
+	else:
+		def evaluate():
+			for b in range(gdat.nbands):
+				image_model_eval(props[b][0], props[b][1], props[b][2], 0., gdat.imszs[b], dat.ncs[b], np.array(dat.cfs[b]).astype(np.float32), \
+								weights=dat.weights[b], ref=ref[b], lib=libmmult.clib_eval_modl, regsize=gdat.regsizes[b], \
+								sepcf=dat.sepcfs[b] if gdat.separable_psf else None)
+
+	evaluate() # first call pays for JIT compilation and page faults
+	neval = 1
+	while True:
+		t0 = time.time()
+		for i in range(neval):
+			evaluate()
+		dt = time.time() - t0
+		if dt >= min_time:
+			break
+		neval *= 2
+	best = dt
+	for r in range(nrepeat-1):
+		t0 = time.time()
+		for i in range(neval):
+			evaluate()
+		best = min(best, time.time() - t0)
+
+	if compiled:
+		free_c(gdat, libmmult, cblas=cblas)
+	return best/neval
+
+def select_eval_backend(gdat, dat, libdir=None):
+	''' Picks the evaluation backend given by gdat.eval_backend, or the fastest available one on the data of dat when it is 
+	'auto'. Sets gdat.eval_backend to the choice (along with gdat.cblas and gdat.numpy_engine, which the sampler uses to 
+	dispatch) and gdat.eval_backend_times to the benchmark times, so that both end up in the saved params. Returns 
+	the libmmult object of the chosen backend. '''
+	gdat.eval_backend_times = dict()
+	if gdat.eval_backend == 'auto':
+		libs = dict()
+		for name in eval_backends:
+			libmmult = load_eval_backend(name, libdir=libdir)
+			if libmmult is None:
+				continue
+			libs[name] = libmmult
+			gdat.eval_backend_times[name] = time_eval_backend(gdat, dat, name, libmmult)
+		gdat.eval_backend = min(gdat.eval_backend_times, key=gdat.eval_backend_times.get)
+		libmmult = libs[gdat.eval_backend]
+	else:
+		libmmult = load_eval_backend(gdat.eval_backend, libdir=libdir)
+		if libmmult is None:
+			raise ValueError('evaluation backend '+str(gdat.eval_backend)+' is not available')
+
+	gdat.cblas = eval_backends[gdat.eval_backend]['cblas']
+	gdat.openblas = (gdat.eval_backend == 'openblas')
+	gdat.numpy_engine = 'lib' not in eval_backends[gdat.eval_backend]
+	return libmmult
 
 
 def create_directories(gdat):
@@ -125,13 +322,22 @@ def neighbours(x,y,neigh,i,generate=False):
 	neighbours = np.sum(adjacency)
 	if generate:
 		if neighbours:
-			j = np.random.choice(adjacency.size, p=adjacency.flatten()/float(neighbours))
+			# same draw as np.random.choice(adjacency.size, p=adjacency/neighbours), without its checks on p
+			cdf = np.cumsum(adjacency/float(neighbours), dtype=np.float64)
+			j = np.searchsorted(cdf/cdf[-1], np.random.random_sample(), side='right')
 		else:
 			j = -1
 		return neighbours, j
 	else:
 		return neighbours
 
+def neighbour_sums(x, y, x0, y0, neigh, exclude):
+	''' neighbours() for several positions x0, y0 at once, leaving source exclude[k] out of the sum of position k. '''
+	d2 = (x[None,:] - x0[:,None])**2 + (y[None,:] - y0[:,None])**2
+	adjacency = np.exp(-d2/(2.*neigh*neigh))
+	adjacency[np.arange(x0.size), exclude] = 0.
+	return np.sum(adjacency, axis=1)
+
 def get_region(x, offsetx, regsize):
 	return (np.floor(x + offsetx).astype(np.int) / regsize).astype(np.int)
 
@@ -188,7 +394,7 @@ def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow
 	dat = pcat_data(gdat.auto_resize, nregion=gdat.nregion)
 	dat.load_in_data(gdat)
 
-	chain = np.load(gdat.filepath+'/chain.npz')
+	chain = load_chain(gdat.filepath)
 
 	flux_density_conversion_dict = dict({'S': 86.29e-4, 'M':16.65e-3, 'L':34.52e-3})
 
@@ -202,6 +408,8 @@ def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow
 	accept_stats = chain['accept']
 	diff2s = chain['diff2s']
 
+	# chains stopped by the convergence criteria have fewer than nsamp samples
+	gdat.nsamp = len(nsrcs)
 	burn_in = int(gdat.nsamp*burn_in_frac)
 	bands = gdat.bands
 
@@ -437,6 +645,8 @@ def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow
 		proposal_types.append('Templates')
 	if gdat.float_fourier_comps:
 		proposal_types.append('Fourier comps')
+	if getattr(gdat, 'linear_gibbs_moveweight', 0) > 0:
+		proposal_types.append('Linear Gibbs')
 
 
 	print('proposal types:', proposal_types)
@@ -569,6 +779,10 @@ class Proposal:
 		self.change_bkg_bool = False
 		self.change_template_amp_bool = False # template
 		self.change_fourier_comp_bool = False
+		# True for draws from the conditional of the linear parameters, which are always accepted
+		self.gibbs = False
+		# True for moves rejected by the prior before evaluating them, as opposed to out of bounds ones
+		self.prior_reject = False
 		
 		self.dback = np.zeros(gdat.nbands, dtype=np.float32)
 		self.dtemplate = None
@@ -664,6 +878,237 @@ class Proposal:
 			return self.stars0[self._X,:], self.stars0[self._Y,:]
 
 
+class LinearStats():
+	''' Sufficient statistics of the parameters that enter the model linearly, i.e. the background level, the template 
+	amplitudes and the Fourier coefficients. Row k of basis[b] is the image T_k that parameter k adds to band b (ones, 
+	then the templates), the Fourier coefficients follow in the flattened (i,j,k) order of fourier_coeffs. When the model 
+	of band b changes by sum_k d_k T_k the chi squared changes by -2 d.S + d.G.d, with G = T w T^T fixed and S = T (w resid) 
+	maintained along with the residuals, so linear proposals are evaluated without touching the image. The Fourier 
+	templates are never formed, their rows of S and G are contracted from the separable bases one axis at a time. '''
+
+	def __init__(self, gdat, dat, fourier_bases=None):
+		self.nbands = gdat.nbands
+		self.basis, self.fourier_bases, self.gram, self.weights, self.nparams = [], [], [], [], []
+		self.S = [None for b in range(self.nbands)]
+		for b in range(self.nbands):
+			w = dat.weights[b].reshape(-1).astype(np.float64)
+			comps = [np.ones(w.size)]
+			for i in range(gdat.n_templates):
+				temp = dat.template_array[b][i] if i < len(dat.template_array[b]) else None
+				comps.append(np.zeros(w.size) if temp is None else np.reshape(temp, -1))
+			basis = np.array(comps, dtype=np.float64)
+			self.basis.append(basis)
+			self.weights.append(w)
+			gram = np.dot(basis*w, basis.T)
+			fbasis = None
+			if fourier_bases is not None:
+				fbasis = tuple(np.asarray(fb, dtype=np.float64) for fb in fourier_bases[b])
+				xbasis, ybasis = fbasis
+				self.fourier_bases.append(fbasis)
+				w2 = w.reshape(dat.weights[b].shape)
+				cross = np.array([self.fourier_proj(b, (w*row).reshape(w2.shape)) for row in basis])
+				# sum over the second axis first, then the first axis with the products of the y profiles
+				wxx = np.einsum('rc,ic,pc->rip', w2, xbasis, xbasis)
+				nf = cross.shape[1]
+				ffgram = np.einsum('kjr,lmr,rip->ijkpml', ybasis, ybasis, wxx, optimize=True).reshape(nf, nf)
+				gram = np.block([[gram, cross], [cross.T, ffgram]])
+			else:
+				self.fourier_bases.append(None)
+			self.gram.append(gram)
+			self.nparams.append(gram.shape[0])
+
+	def fourier_proj(self, b, image):
+		''' Inner products of image with each Fourier template of band b, flattened like fourier_coeffs. '''
+		xbasis, ybasis = self.fourier_bases[b]
+		return np.einsum('kjr,ri->ijk', ybasis, np.dot(image, xbasis.T)).ravel()
+
+	def mark_stale(self, b=None):
+		''' Drops S of band b (all bands if None), e.g. after the residuals changed in a way not tracked here. It is 
+		recomputed from the residuals when next needed. '''
+		for band in (range(self.nbands) if b is None else [b]):
+			self.S[band] = None
+
+	def delta_chi2(self, coefs, resids):
+		''' Change in chi squared of each band when the model of band b changes by coefs[b] (None if unchanged). '''
+		dchi2 = np.zeros(self.nbands)
+		for b, d in enumerate(coefs):
+			if d is None:
+				continue
+			dchi2[b] = -2*np.dot(d, self.suff(b, resids[b])) + np.dot(d, np.dot(self.gram[b], d))
+		return dchi2
+
+	def suff(self, b, resid):
+		''' S of band b, recomputed from its residual resid if stale. '''
+		if self.S[b] is None:
+			wres = self.weights[b]*resid.reshape(-1)
+			S = np.dot(self.basis[b], wres)
+			if self.fourier_bases[b] is not None:
+				S = np.concatenate([S, self.fourier_proj(b, wres.reshape(resid.shape))])
+			self.S[b] = S
+		return self.S[b]
+
+	def accept(self, b, d):
+		''' Updates S for an accepted change d of band b (after delta_chi2) and returns the change in the model image. '''
+		self.S[b] -= np.dot(self.gram[b], d)
+		nd = self.basis[b].shape[0]
+		nz = np.flatnonzero(d[:nd])
+		dmodel = np.dot(d[nz], self.basis[b][nz])
+		if self.fourier_bases[b] is not None and np.any(d[nd:]):
+			n_terms = self.fourier_bases[b][0].shape[0]
+			dmodel = dmodel + fourier_basis_sum(d[nd:].reshape(n_terms, n_terms, 2), self.fourier_bases[b]).ravel()
+		return dmodel
+
+	def update_pixels(self, b, pix, dmodel):
+		''' Updates S after the model of band b changed by dmodel at the flat pixel indices pix. '''
+		if self.S[b] is not None:
+			wdm = self.weights[b][pix]*dmodel
+			nd = self.basis[b].shape[0]
+			self.S[b][:nd] -= np.dot(self.basis[b][:, pix], wdm)
+			if self.fourier_bases[b] is not None:
+				xbasis, ybasis = self.fourier_bases[b]
+				rows, cols = np.divmod(pix, xbasis.shape[1])
+				self.S[b][nd:] -= np.einsum('p,kjp,ip->ijk', wdm, ybasis[:,:,rows], xbasis[:,cols]).ravel()
+
+
+class CellIndex():
+	''' Grid of cells bucketing the catalog for neighbour and region queries. Cells divide the regions and are no smaller 
+	than the neighbour cutoff, so neighbours lie in the 3x3 block around a position. '''
+
+	def __init__(self, imsz, regsize, cutoff, max_nsrc, cap=8):
+		self.regsize = regsize
+		self.cutoff = cutoff
+		ncell_per_reg = int(regsize // cutoff)
+		self.cellsize = regsize/ncell_per_reg if ncell_per_reg > 0 else float(cutoff)
+		self.ncellx = int(np.ceil(imsz[0]/self.cellsize))
+		self.ncelly = int(np.ceil(imsz[1]/self.cellsize))
+		self.slots = np.zeros((self.ncellx*self.ncelly, cap), dtype=np.int64)
+		self.count = np.zeros(self.ncellx*self.ncelly, dtype=np.int64)
+		self.cell = np.full(max_nsrc, -1, dtype=np.int64)
+		self.pos = np.zeros(max_nsrc, dtype=np.int64)
+		self.ranks = np.arange(cap)
+		self.block = np.reshape(np.meshgrid([-1, 0, 1], [-1, 0, 1]), (2, 1, 9))
+		self.parity_codes = dict()
+
+	def cell_coords(self, x, y):
+		cx = np.minimum(np.maximum(np.floor(np.asarray(x)/self.cellsize).astype(np.int64), 0), self.ncellx-1)
+		cy = np.minimum(np.maximum(np.floor(np.asarray(y)/self.cellsize).astype(np.int64), 0), self.ncelly-1)
+		return cx, cy
+
+	def build(self, x, y, n):
+		''' Indexes sources 0 to n-1 of a catalog with positions x, y. '''
+		self.count[:] = 0
+		self.cell[:] = -1
+		self.insert(np.arange(n), x[0:n], y[0:n])
+
+	def insert(self, idx, x, y):
+		idx = np.asarray(idx, dtype=np.int64)
+		if idx.size == 0:
+			return
+		cx, cy = self.cell_coords(x, y)
+		c = cy*self.ncellx + cx
+		order = np.argsort(c, kind='stable')
+		cs, idxs = c[order], idx[order]
+		# sources falling in the same cell take consecutive positions after the current ones
+		pos = self.count[cs] + np.arange(cs.size) - np.searchsorted(cs, cs)
+		if pos.max() >= self.slots.shape[1]:
+			cap = max(2*self.slots.shape[1], int(pos.max())+1)
+			self.slots = np.concatenate([self.slots, np.zeros((self.slots.shape[0], cap-self.slots.shape[1]), dtype=np.int64)], axis=1)
+			self.ranks = np.arange(cap)
+		self.slots[cs, pos] = idxs
+		self.cell[idxs] = cs
+		self.pos[idxs] = pos
+		self.count += np.bincount(cs, minlength=self.count.size)
+
+	def remove(self, idx):
+		# the last source of each cell takes the place of the removed one
+		for i in np.asarray(idx, dtype=np.int64).ravel():
+			c, p = self.cell[i], self.pos[i]
+			last = self.slots[c, self.count[c]-1]
+			self.slots[c, p] = last
+			self.pos[last] = p
+			self.count[c] -= 1
+			self.cell[i] = -1
+
+	def move(self, idx, x, y):
+		''' Updates the cells of sources idx moved to x, y. Sources staying in their cell are left untouched. '''
+		idx = np.asarray(idx, dtype=np.int64)
+		cx, cy = self.cell_coords(x, y)
+		changed = np.flatnonzero(cy*self.ncellx + cx != self.cell[idx])
+		self.remove(idx[changed])
+		self.insert(idx[changed], np.asarray(x)[changed], np.asarray(y)[changed])
+
+	def relabel(self, old, new):
+		''' Gives sources old the catalog indices new, e.g. when they are moved into the slots of removed sources. '''
+		self.slots[self.cell[old], self.pos[old]] = new
+		self.cell[new], self.pos[new] = self.cell[old], self.pos[old]
+		self.cell[old] = -1
+
+	def candidates(self, x0, y0):
+		''' Catalog indices around positions x0, y0, one row per position padded with -1. '''
+		cx, cy = self.cell_coords(x0, y0)
+		bx, by = cx[:,None] + self.block[0], cy[:,None] + self.block[1]
+		valid = (bx >= 0) & (bx < self.ncellx) & (by >= 0) & (by < self.ncelly)
+		cells = np.where(valid, by*self.ncellx + bx, 0)
+		count = np.where(valid, self.count[cells], 0)
+		return np.where(self.ranks < count[:,:,None], self.slots[cells], -1).reshape(cx.size, 9*self.slots.shape[1])
+
+	def neighbours(self, x, y, x0, y0, neigh, exclude):
+		''' neighbour_sums() truncated at the cutoff radius. '''
+		idx = self.candidates(x0, y0)
+		d2 = (x[idx] - x0[:,None])**2 + (y[idx] - y0[:,None])**2
+		keep = (idx >= 0) & (idx != exclude[:,None]) & (d2 <= self.cutoff*self.cutoff)
+		return np.sum(np.where(keep, np.exp(-d2/(2.*neigh*neigh)), 0.), axis=1)
+
+	def adjacency(self, x, y, x0, y0, neigh, exclude):
+		''' Catalog indices and adjacencies around a single position x0, y0. '''
+		cx = min(max(int(x0 // self.cellsize), 0), self.ncellx-1)
+		cy = min(max(int(y0 // self.cellsize), 0), self.ncelly-1)
+		count = self.count.reshape(self.ncelly, self.ncellx)[max(cy-1, 0):cy+2, max(cx-1, 0):cx+2]
+		slots = self.slots.reshape(self.ncelly, self.ncellx, -1)[max(cy-1, 0):cy+2, max(cx-1, 0):cx+2]
+		idx = slots[self.ranks < count[:,:,None]]
+		dx, dy = x[idx] - x0, y[idx] - y0
+		d2 = dx*dx + dy*dy
+		adjacency = np.exp(-d2/(2.*neigh*neigh))
+		adjacency[(d2 > self.cutoff*self.cutoff) | (idx == exclude)] = 0.
+		return idx, adjacency
+
+	def draw_neighbour(self, x, y, x0, y0, neigh, exclude):
+		''' neighbours() with generate=True for a single position, returning a catalog index or -1. '''
+		idx, adjacency = self.adjacency(x, y, x0, y0, neigh, exclude)
+		cdf = np.cumsum(adjacency)
+		neighbours = cdf[-1] if cdf.size else 0.
+		if neighbours:
+			j = idx[min(np.searchsorted(cdf/neighbours, np.random.random_sample(), side='right'), idx.size-1)]
+		else:
+			j = -1
+		return neighbours, j
+
+	def in_regions(self, x, y, n, offsetx, offsety, parity_x, parity_y):
+		''' idx_parity(), testing only the sources of cells straddling region boundaries. '''
+		code = np.minimum.outer(self.parity_cells(1, offsety, parity_y), self.parity_cells(0, offsetx, parity_x)).ravel()[self.cell[0:n]]
+		idx = np.flatnonzero(code)
+		test = np.flatnonzero(code[idx] == 1)
+		match_x = (get_region(x[idx[test]], offsetx, self.regsize) % 2) == parity_x
+		match_y = (get_region(y[idx[test]], offsety, self.regsize) % 2) == parity_y
+		keep = np.ones(idx.size, dtype=bool)
+		keep[test] = np.logical_and(match_x, match_y)
+		return idx[keep]
+
+	def parity_cells(self, axis, offset, parity):
+		''' Per cell along axis: 2 inside a region of the given parity, 1 straddling one, 0 outside. '''
+		key = (axis, offset, parity)
+		if key not in self.parity_codes:
+			edges = np.arange((self.ncellx, self.ncelly)[axis]+1)*self.cellsize + offset
+			# cell edges padded by a pixel against rounding in the cell assignment
+			first = np.floor(edges[:-1]-1).astype(np.int64) // self.regsize
+			last = np.floor(edges[1:]+1).astype(np.int64) // self.regsize
+			code = np.where(first % 2 == parity, 2, 0)
+			code[last > first] = 1
+			# the edge cells also hold sources clipped onto the grid
+			code[[0, -1]] = 1
+			self.parity_codes[key] = code
+		return self.parity_codes[key]
+
 class Model:
 
 	_X = 0
@@ -705,8 +1150,8 @@ class Model:
 		# the last weight, used for background amplitude sampling, is initialized to zero and set to be non-zero by lion after some preset number of samples, 
 		# so don't change its value up here. There is a bkg_sample_weight parameter in the lion() class
 		
-		self.moveweights = np.array([0., 0., 0., 0., 0., 0.]) # fourier comp, movestar. weights are specified in lion __init__()
-		self.movetypes = ['P *', 'BD *', 'MS *', 'BKG', 'TEMPLATE', 'FC'] # template, fourier comps
+		self.moveweights = np.array([0., 0., 0., 0., 0., 0., 0.]) # fourier comp, movestar. weights are specified in lion __init__()
+		self.movetypes = ['P *', 'BD *', 'MS *', 'BKG', 'TEMPLATE', 'FC', 'LIN GIBBS'] # template, fourier comps
 
 		self.n_templates = gdat.n_templates # template
 		# fourier comp
@@ -715,6 +1160,12 @@ class Model:
 		# this is for perturbing the relative amplitudes of a fixed fourier comp model across bands
 		self.fourier_amp_sig = 0.0005
 
+		# factors on the step sizes and on the weights of each move type, tuned by adapt_proposals during the first 
+		# gdat.adapt_samples thinned samples and fixed afterwards
+		self.step_scales = np.ones(len(self.movetypes))
+		self.weight_scales = np.ones(len(self.movetypes))
+		self.nadapt = 0
+
 
 		self.template_amplitudes = np.zeros((self.n_templates, gdat.nbands))
 		self.init_template_amplitude_dicts = self.gdat.init_template_amplitude_dicts # newt
@@ -732,7 +1183,7 @@ class Model:
 		# fourier comps
 		if self.gdat.float_fourier_comps:
 			self.fourier_coeffs = self.gdat.init_fourier_coeffs.copy()
-			self.fourier_templates = self.gdat.fc_templates
+			self.fourier_bases = self.gdat.fc_bases
 			self.n_fourier_terms = self.gdat.n_fourier_terms
 			self.dfc = np.zeros((self.n_fourier_terms, self.n_fourier_terms, 2))
 			self.dfc_rel_amps = np.zeros((gdat.nbands))
@@ -740,6 +1191,32 @@ class Model:
 		else:
 			self.fc_rel_amps = None
 			self.fourier_coeffs = None
+
+		self.linear_stats = None
+		if self.gdat.linear_suffstats or self.gdat.linear_gibbs_moveweight > 0:
+			self.linear_stats = LinearStats(gdat, dat, self.fourier_bases if self.gdat.float_fourier_comps else None)
+
+		# parameters drawn jointly by gibbs_linear_params as (kind, template index, band), band is None for template 
+		# amplitudes shared by all bands under the delta function color prior. The Fourier coefficients follow them
+		self.gibbs_params = []
+		if self.gdat.float_background:
+			self.gibbs_params.extend([('bkg', None, b) for b in range(gdat.nbands)])
+		if self.gdat.float_templates:
+			for i, key in enumerate(self.gdat.template_order):
+				if self.gdat.delta_cp_bool and (key == 'planck' or key == 'dust'):
+					self.gibbs_params.append(('template', i, None))
+				else:
+					self.gibbs_params.extend([('template', i, b) for b in range(gdat.nbands) if self.dat.template_array[b][i] is not None])
+		# normal matrix of the Gibbs update and the relative Fourier amplitudes it was computed for
+		self.linear_normal = None
+
+		# inverse temperature the likelihood is raised to, below one for the hot replicas of parallel tempering
+		self.beta = 1.
+
+		# threads evaluating strips of regions of point source proposals concurrently, see region_parallel_eval
+		self.region_pool = None
+		if gdat.region_threads > 1 and gdat.nregion > 1:
+			self.region_pool = ThreadPoolExecutor(max_workers=gdat.region_threads)
 		
 		if self.gdat.nsrc_init is not None:
 			self.n = self.gdat.nsrc_init
@@ -757,6 +1234,11 @@ class Model:
 		self.penalty = 1+0.5*gdat.alph*gdat.nbands
 		self.regions_factor = gdat.regions_factor
 		self.regsizes = np.array(gdat.regsizes).astype(np.int)
+
+		# per-band C evaluation contexts from initialize_c, None with the NumPy engine
+		self.eval_ctxs = getattr(gdat, 'eval_ctxs', None)
+		if self.eval_ctxs is not None:
+			self.ctx_eval_multiband = self.libmmult.pcat_ctx_eval_multiband if gdat.cblas else self.libmmult.clib_ctxt_eval_mult
 		
 		self.stars = np.zeros((2+gdat.nbands,gdat.max_nsrc), dtype=np.float32)
 		self.stars[:,0:self.n] = np.random.uniform(size=(2+gdat.nbands,self.n))
@@ -847,12 +1329,63 @@ class Model:
 			print('self.bkg is ', self.bkg, file=gdat.flog)
 			print('self.template amplitudes is ', self.template_amplitudes, file=gdat.flog)
 
+		# spatial index of the catalog for merge/split neighbours and region membership, kept up to date in run_sampler
+		self.cells = None
+		if gdat.cell_index:
+			self.build_cell_index()
+
+	def build_cell_index(self):
+		''' Indexes the catalog with a cutoff radius of gdat.neighbour_cutoff merge kernel widths. '''
+		self.cells = CellIndex(self.imsz0, self.regsizes[0], self.gdat.neighbour_cutoff*self.kickrange, self.max_nsrc)
+		self.cells.build(self.stars[self._X,:], self.stars[self._Y,:], self.n)
+
 
 	def normalize_weights(self, weights):
 		''' This gets used when updating proposal weights during burn-in.'''
 		normalized_weights = weights / np.sum(weights)
 
 		return normalized_weights
+
+	def adapt_proposals(self, accept, outbounds, diff2_list, dts, movetype, chi2_start):
+		''' 
+		Tunes the proposals from the statistics of the last call to run_sampler. The step size of each move type that has one 
+		(source positions and fluxes, kickrange of merges/splits, background, templates and Fourier components) is scaled 
+		by exp(gain*(acceptance - gdat.adapt_target_accept)), and the weight of each active move type moves toward the 
+		decrease of chi squared it bought per second of run time, relative to the others and within gdat.adapt_max_weight_factor 
+		of the weight it was given. The gain decays as 1/sqrt(number of updates) so the tuning settles before it is frozen. 
+		'''
+		gain = 1./np.sqrt(self.nadapt+1.)
+		self.nadapt += 1
+
+		# drop in chi squared and time taken by each iteration
+		dchi2 = -np.diff(diff2_list, prepend=chi2_start)
+		dt = np.sum(dts, axis=0)
+		valid = outbounds == 0
+		rates = np.zeros(len(self.movetypes))
+		drawn = np.zeros(len(self.movetypes), dtype=bool)
+		for k in range(len(self.movetypes)):
+			sel = np.logical_and(movetype == k, valid)
+			if not np.any(sel):
+				continue
+			drawn[k] = True
+			if k in (0, 2, 3, 4, 5):
+				self.step_scales[k] = np.clip(self.step_scales[k]*np.exp(gain*(np.mean(accept[sel]) - self.gdat.adapt_target_accept)), 1e-2, 1e2)
+			if np.sum(dt[sel]) > 0:
+				rates[k] = max(np.sum(dchi2[sel]), 0.)/np.sum(dt[sel])
+
+		active = np.logical_and(self.moveweights > 0, drawn)
+		if np.mean(rates[active]) > 0:
+			target = np.clip(rates[active]/np.mean(rates[active]), 1./self.gdat.adapt_max_weight_factor, self.gdat.adapt_max_weight_factor)
+			self.weight_scales[active] = self.weight_scales[active]**(1.-gain)*target**gain
+
+		# merges and splits take their kernel width from kickrange, and the cutoff of the cell index follows it
+		self.kickrange = self.gdat.kickrange*self.step_scales[2]
+		if self.cells is not None:
+			self.build_cell_index()
+
+		print('Adapted step scales', np.round(self.step_scales, 3), 'weight scales', np.round(self.weight_scales, 3), file=self.gdat.flog)
+		if self.nadapt == self.gdat.adapt_samples:
+			print('Step sizes and move weights are now fixed', file=self.gdat.flog)
    
 	def print_sample_status(self, dts, accept, outbounds, chi2, movetype):  
 		''' 
@@ -890,6 +1423,7 @@ class Model:
 		''' Wrapper for multiband likelihood evaluation given model parameters.'''
 
 		dmodels = []
+		dtemps = []
 		dt_transf = 0
 
 		for b in range(self.nbands):
@@ -922,7 +1456,7 @@ class Model:
 			elif dfc is not None: # fourier comps
 
 				if idxvec is not None:
-					pc_temp = self.fourier_templates[b][idxvec[0], idxvec[1], idxvec[2]]*dfc[idxvec[0], idxvec[1], idxvec[2]]
+					pc_temp = fourier_basis_template(self.fourier_bases[b], idxvec[0], idxvec[1], idxvec[2])*dfc[idxvec[0], idxvec[1], idxvec[2]]
 
 					if dtemp is None:
 						dtemp = fc_rel_amps[b]*pc_temp
@@ -930,38 +1464,38 @@ class Model:
 					else:
 						dtemp += fc_rel_amps[b]*pc_temp
 				else:
-					# pc_temp = np.sum([dfc[i,j,k]*self.fourier_templates[b][i,j,k] for i in range(self.n_fourier_terms) for j in range(self.n_fourier_terms) for k in range(4)], axis=0)
-					pc_temp = np.sum([dfc[i,j,k]*self.fourier_templates[b][i,j,k] for i in range(self.n_fourier_terms) for j in range(self.n_fourier_terms) for k in range(2)], axis=0)
+					pc_temp = fourier_basis_sum(dfc, self.fourier_bases[b])
 
 					if dtemp is None:
 						dtemp = fc_rel_amps[b]*pc_temp
 					else:
 						dtemp += fc_rel_amps[b]*pc_temp
 
-			if b>0:
+			dtemps.append(dtemp)
+
+		if self.eval_ctxs is not None:
+			# astrometry, design matrix, PSF insertion and chi squared for every band in a single call
+			dmodels, diff2s = self.ctx_multiband_eval(x, y, f, bkg, ref, beam_fac*np.array(nc, dtype=np.float64), margin_fac=margin_fac, dtemps=dtemps)
+			return dmodels, diff2s, dt_transf
+
+		for b in range(self.nbands):
+			if b>0 and self.gdat.bands[b] != self.gdat.bands[0]:
 				t4 = time.time()
-				if self.gdat.bands[b] != self.gdat.bands[0]:
-					xp, yp = self.dat.fast_astrom.transform_q(x, y, b-1)
-				else:
-					xp = x
-					yp = y
+				xp, yp = self.dat.fast_astrom.transform_q(x, y, b-1)
 				dt_transf += time.time()-t4
+			else:
+				xp = x
+				yp = y
+
+			dmodel, diff2 = image_model_eval(xp, yp, beam_fac*nc[b]*f[b], bkg[b], self.imszs[b], \
+											nc[b], np.array(cf[b]).astype(np.float32()), weights=self.dat.weights[b], \
+											ref=ref[b], lib=lib, regsize=self.regsizes[b], \
+											margin=self.margins[b]*margin_fac, offsetx=self.offsetxs[b], offsety=self.offsetys[b], template=dtemps[b], \
+											sepcf=self.dat.sepcfs[b] if self.gdat.separable_psf else None)
 
-				dmodel, diff2 = image_model_eval(xp, yp, beam_fac*nc[b]*f[b], bkg[b], self.imszs[b], \
-												nc[b], np.array(cf[b]).astype(np.float32()), weights=self.dat.weights[b], \
-												ref=ref[b], lib=lib, regsize=self.regsizes[b], \
-												margin=self.margins[b]*margin_fac, offsetx=self.offsetxs[b], offsety=self.offsetys[b], template=dtemp)
+			if b>0:
 				diff2s += diff2
-			else:    
-				xp=x
-				yp=y
-
-				dmodel, diff2 = image_model_eval(xp, yp, beam_fac*nc[b]*f[b], bkg[b], self.imszs[b], \
-												nc[b], np.array(cf[b]).astype(np.float32()), weights=self.dat.weights[b], \
-												ref=ref[b], lib=lib, regsize=self.regsizes[b], \
-												margin=self.margins[b]*margin_fac, offsetx=self.offsetxs[b], offsety=self.offsetys[b], template=dtemp)
-			
-				
+			else:
 				diff2s = diff2
 
 
@@ -969,6 +1503,108 @@ class Model:
 
 		return dmodels, diff2s, dt_transf 
 
+	def region_parallel_eval(self, x, y, f, ref, lib, beam_fac=1.):
+		''' Same as pcat_multiband_eval for the phonions of a point source proposal (no background or template change), 
+		with the image split into horizontal strips of rows of regions that are evaluated concurrently on 
+		self.region_pool. Every strip but the first starts at a row of regions of the current y parity, so it ends with 
+		a row of the other parity. Each strip is evaluated on the block of image rows covered by its regions and their 
+		margins, with the phonions of its regions and of the rows of regions on either side, and owns the rows from the 
+		start of that block up to the start of the next one. The compiled routines release the GIL while they run. As 
+		long as the PSF is smaller than a region, the regional chi squared of the active regions and the model images 
+		in and around them match a single evaluation up to float32 rounding. '''
+		nregy = int(self.imsz0[1]/self.regsizes[0] + 1)
+		starts = [0] + [j for j in range(1, nregy) if j % 2 == self.parity_y]
+		groups = [g for g in np.array_split(np.array(starts), min(self.gdat.region_threads, len(starts))) if len(g) > 0]
+		bounds = [(g[0], groups[k+1][0] if k+1 < len(groups) else nregy) for k, g in enumerate(groups)]
+
+		t4 = time.time()
+		regy = get_region(y, self.offsetys[0], self.regsizes[0])
+		xps, yps = [x], [y]
+		for b in range(1, self.nbands):
+			if self.gdat.bands[b] != self.gdat.bands[0]:
+				xp, yp = self.dat.fast_astrom.transform_q(x, y, b-1)
+			else:
+				xp, yp = x, y
+			xps.append(np.asarray(xp, dtype=np.float32))
+			yps.append(np.asarray(yp, dtype=np.float32))
+		dt_transf = time.time()-t4
+		f = np.reshape(f, (self.nbands, -1))
+
+		def first_row(b, j):
+			# first image row of band b in the block of region row j, margin included
+			return 0 if j == 0 else max(j*self.regsizes[b]-self.offsetys[b]-self.margins[b], 0)
+
+		def eval_strip(j0, j1):
+			# phonions in the rows of regions just outside the strip can reach into its margins
+			sel = np.flatnonzero((regy >= j0-1) & (regy <= j1))
+			strip = []
+			for b in range(self.nbands):
+				nrow, ncol = ref[b].shape
+				y0 = first_row(b, j0)
+				y1 = nrow if j1 == nregy else min(j1*self.regsizes[b]-self.offsetys[b]+self.margins[b], nrow)
+				dmodel, diff2 = image_model_eval(xps[b][sel], yps[b][sel]-np.float32(y0), beam_fac*self.dat.ncs[b]*f[b][sel], 0., (ncol, y1-y0), \
+												self.dat.ncs[b], np.array(self.dat.cfs[b]).astype(np.float32), weights=self.dat.weights[b][y0:y1], \
+												ref=ref[b][y0:y1], lib=lib, regsize=self.regsizes[b], margin=self.margins[b], offsetx=self.offsetxs[b], \
+												offsety=self.offsetys[b]+y0-j0*self.regsizes[b], sepcf=self.dat.sepcfs[b] if self.gdat.separable_psf else None)
+				strip.append((dmodel.reshape(y1-y0, ncol), diff2[:j1-j0]))
+			return strip
+
+		strips = list(self.region_pool.map(lambda bound: eval_strip(*bound), bounds))
+
+		dmodels = [np.empty_like(ref[b]) for b in range(self.nbands)]
+		diff2s = np.zeros((nregy, int(self.imsz0[0]/self.regsizes[0] + 1)))
+		for k, (j0, j1) in enumerate(bounds):
+			for b in range(self.nbands):
+				y0 = first_row(b, j0)
+				y1 = ref[b].shape[0] if j1 == nregy else first_row(b, j1)
+				dmodels[b][y0:y1] = strips[k][b][0][:y1-y0]
+				diff2s[j0:j1] += strips[k][b][1]
+
+		return dmodels, diff2s, dt_transf
+
+	def ctx_multiband_eval(self, x, y, f, bkg, ref, fscale, margin_fac=1, dtemps=None):
+		''' Evaluates the model images and the regional chi squared summed over bands through the fused kernel of the compiled 
+		library, using the persistent per-band contexts from initialize_c. x and y are pivot band positions, the transformation 
+		to the other bands happens on the C side. Row b of f is scaled by fscale[b]. '''
+		dmodels = [np.empty((self.imszs[b][0], self.imszs[b][1]), dtype=np.float32) for b in range(self.nbands)]
+		diff2s = np.empty((int(self.imszs[0][1]/self.regsizes[0] + 1), int(self.imszs[0][0]/self.regsizes[0] + 1)), dtype=np.float64)
+		if dtemps is None:
+			dtemps = [None for b in range(self.nbands)]
+		dtemps = [None if dtemp is None else np.ascontiguousarray(dtemp, dtype=np.float32) for dtemp in dtemps]
+		x = np.ascontiguousarray(x, dtype=np.float32)
+
+		ptrs = lambda arrs: (c_void_p*self.nbands)(*[None if arr is None else arr.ctypes.data for arr in arrs])
+		self.ctx_eval_multiband(self.nbands, (c_void_p*self.nbands)(*self.eval_ctxs), x.size, x, np.ascontiguousarray(y, dtype=np.float32), \
+					np.ascontiguousarray(np.reshape(f, (self.nbands, x.size)), dtype=np.float32), np.ascontiguousarray(fscale, dtype=np.float64), \
+					np.ascontiguousarray(bkg, dtype=np.float32), ptrs(dtemps), ptrs(dmodels), ptrs(ref), diff2s, \
+					(self.margins*margin_fac).astype(np.int32), self.offsetxs.astype(np.int32), self.offsetys.astype(np.int32))
+		return dmodels, diff2s
+
+	def pcat_multiband_footprint_eval(self, x, y, f, nc, cf, resids, beam_fac=1.):
+		''' Sparse counterpart of pcat_multiband_eval used for incremental likelihood evaluation. Returns the pixels touched by 
+		the phonion PSF stamps and the model change on them for each band, along with the change in chi squared of each region. '''
+
+		footprints = []
+		ddiff2s = 0.
+		dt_transf = 0
+
+		for b in range(self.nbands):
+			if b>0 and self.gdat.bands[b] != self.gdat.bands[0]:
+				t4 = time.time()
+				xp, yp = self.dat.fast_astrom.transform_q(x, y, b-1)
+				dt_transf += time.time()-t4
+			else:
+				xp = x
+				yp = y
+
+			pix, dmodel = image_model_footprint(xp, yp, beam_fac*nc[b]*f[b], self.imszs[b], nc[b], np.array(cf[b]).astype(np.float32()), \
+												sepcf=self.dat.sepcfs[b] if self.gdat.separable_psf else None)
+			ddiff2s = ddiff2s + footprint_delta_chi2(pix, dmodel, resids[b], self.dat.weights[b], self.imszs[b], self.regsizes[b], \
+														self.margins[b], self.offsetxs[b], self.offsetys[b])
+			footprints.append((pix, dmodel))
+
+		return footprints, ddiff2s, dt_transf
+
 
 	def run_sampler(self, sample_idx):
 		''' run_sampler() completes nloop samples, so the function is called nsamp times'''
@@ -978,6 +1614,7 @@ class Model:
 		movetype = np.zeros(self.nloop)
 		accept = np.zeros(self.nloop)
 		outbounds = np.zeros(self.nloop)
+		priorrejects = np.zeros(self.nloop)
 		dts = np.zeros((4, self.nloop)) # array to store time spent on different proposals
 		diff2_list = np.zeros(self.nloop) 
 
@@ -1044,8 +1681,8 @@ class Model:
 			lazy_temps = []
 			for b in range(self.nbands):
 				# fcomp color
-				lazy_temps.append(np.sum([self.fourier_coeffs[i,j,k]*self.fourier_templates[b][i,j,k] for i in range(self.n_fourier_terms) for j in range(self.n_fourier_terms) for k in range(2)], axis=0))
-				# lazy_temps.append(np.sum([self.fourier_coeffs[i,j,k]*self.fourier_templates[b][i,j,k] for i in range(self.n_fourier_terms) for j in range(self.n_fourier_terms) for k in range(4)], axis=0))
+				# accumulated in double precision, the bases themselves are single precision
+				lazy_temps.append(fourier_basis_sum(self.fourier_coeffs, self.fourier_bases[b]).astype(np.float64))
 			
 			running_temp = np.array(lazy_temps).copy()
 
@@ -1057,6 +1694,17 @@ class Model:
 		for b in range(self.nbands):
 			resids[b] -= models[b]
 
+		# running chi squared of each band, updated from the accepted changes and recomputed from the residuals every 
+		# chi2_recompute_interval iterations so that round-off doesn't accumulate
+		chi2 = np.array([self.band_chi2(resids[b], b) for b in range(self.nbands)])
+		chi2_start = np.sum(chi2)
+		# regional chi squared of each band (margins included) for the current residuals, None when not known
+		diff2_bands = [None for b in range(self.nbands)]
+		if self.linear_stats is not None:
+			self.linear_stats.mark_stale()
+		# residuals as seen by the proposals that need them
+		self.resids = resids
+
 		
 		'''the proposals here are: move_stars (P) which changes the parameters of existing model sources, 
 		birth/death (BD) and merge/split (MS). Don't worry about perturb_astrometry. 
@@ -1064,13 +1712,13 @@ class Model:
 		
 		# fourier comp
 		movefns = [self.move_stars, self.birth_death_stars, self.merge_split_stars, self.perturb_background, \
-						self.perturb_template_amplitude, self.perturb_fourier_comp] # template
+						self.perturb_template_amplitude, self.perturb_fourier_comp, self.gibbs_linear_params] # template
 
 		if self.gdat.nregion > 1:
 			xparities = np.random.randint(2, size=self.nloop)
 			yparities = np.random.randint(2, size=self.nloop)
 
-		rtype_array = np.random.choice(self.moveweights.size, p=self.normalize_weights(self.moveweights), size=self.nloop)
+		rtype_array = np.random.choice(self.moveweights.size, p=self.normalize_weights(self.moveweights*self.weight_scales), size=self.nloop)
 
 		movetype = rtype_array
 
@@ -1117,9 +1765,15 @@ class Model:
 				if rtype > 2:
 					margin_fac = 0
 
+				footprints = None
+				lin_coefs = None
 
+				if rtype > 2 and self.linear_stats is not None:
+					# linear parameters, the change in chi squared follows from the sufficient statistics alone
+					lin_coefs = self.linear_move_coefs(proposal, rtype)
+					dchi2s = self.linear_stats.delta_chi2(lin_coefs, resids)
 
-				if rtype == 3: # background
+				elif rtype == 3: # background
 					# recompute model likelihood with margins set to zero, use current values of star parameters and use background level equal to self.bkg (+self.dback up to this point)
 
 					mods, diff2s_nomargin, dt_transf = self.pcat_multiband_eval(self.stars[self._X,0:self.n], self.stars[self._Y,0:self.n], self.stars[self._F:,0:self.n], \
@@ -1164,6 +1818,15 @@ class Model:
 		
 
 
+				elif self.gdat.incremental_llik:
+					# only pixels under the phonion PSF stamps change, so the regional chi squared is updated from those alone
+					footprints, ddiff2s, dt_transf = self.pcat_multiband_footprint_eval(proposal.xphon, proposal.yphon, proposal.fphon, self.dat.ncs, self.dat.cfs, \
+													resids, beam_fac=self.pixel_per_beam)
+					diff2s = -2*logL + ddiff2s
+
+				elif self.region_pool is not None and rtype < 3:
+					dmodels, diff2s, dt_transf = self.region_parallel_eval(proposal.xphon, proposal.yphon, proposal.fphon, resids, lib, beam_fac=self.pixel_per_beam)
+
 				else:
 
 					dmodels, diff2s, dt_transf = self.pcat_multiband_eval(proposal.xphon, proposal.yphon, proposal.fphon, proposal.dback, self.dat.ncs, self.dat.cfs, weights=self.dat.weights, \
@@ -1171,13 +1834,18 @@ class Model:
 	
 				
 
-				plogL = -0.5*diff2s  
+				if lin_coefs is None:
+					plogL = -0.5*diff2s  
 
-				if rtype < 3:
-					plogL[(1-self.parity_y)::2,:] = float('-inf') # don't accept off-parity regions
-					plogL[:,(1-self.parity_x)::2] = float('-inf')
-				
-				dlogP = plogL - logL
+					if rtype < 3:
+						plogL[(1-self.parity_y)::2,:] = float('-inf') # don't accept off-parity regions
+						plogL[:,(1-self.parity_x)::2] = float('-inf')
+					
+					dlogP = self.beta*(plogL - logL)
+				else:
+					# only the sum over regions enters the acceptance of linear moves
+					dlogP = np.zeros((self.nregy, self.nregx))
+					dlogP[0,0] = -0.5*self.beta*np.sum(dchi2s)
 				
 				assert np.isnan(dlogP).any() == False
 				
@@ -1219,7 +1887,10 @@ class Model:
 
 					# compute dlogP over the full image
 					# compute acceptance
-					accept_or_not = (np.log(np.random.uniform()) < total_dlogP).astype(np.int32)
+					if proposal.gibbs:
+						accept_or_not = 1
+					else:
+						accept_or_not = (np.log(np.random.uniform()) < total_dlogP).astype(np.int32)
 
 					if accept_or_not:
 						# set all acceptreg for subregions to 1
@@ -1229,29 +1900,31 @@ class Model:
 
 				
 				''' for each band compute the delta log likelihood between states, then add these together'''
-				for b in range(self.nbands):
-					dmodel_acpt = np.zeros_like(dmodels[b])
-					diff2_acpt = np.zeros_like(diff2s)
-
-					if self.gdat.cblas:
-
-						self.libmmult.pcat_imag_acpt(self.imszs[b][0], self.imszs[b][1], dmodels[b], dmodel_acpt, acceptreg, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
-						# using this dmodel containing only accepted moves, update logL
-						self.libmmult.pcat_like_eval(self.imszs[b][0], self.imszs[b][1], dmodel_acpt, resids[b], self.dat.weights[b], diff2_acpt, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])   
-					else:
-						
-						self.libmmult.clib_updt_modl(self.imszs[b][0], self.imszs[b][1], dmodels[b], dmodel_acpt, acceptreg, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
-						# using this dmodel containing only accepted moves, update logL
-						self.libmmult.clib_eval_llik(self.imszs[b][0], self.imszs[b][1], dmodel_acpt, resids[b], self.dat.weights[b], diff2_acpt, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])   
+				if footprints is not None:
+					diff2_total1 = self.accept_footprint_regions(footprints, acceptreg, logL, resids, models, chi2, diff2_bands)
+
+				elif lin_coefs is not None:
+					# accepted or rejected over the whole image, so only accepted moves touch the residuals
+					if np.any(acceptreg):
+						for b in range(self.nbands):
+							if lin_coefs[b] is None:
+								continue
+							dmodel_acpt = self.linear_stats.accept(b, lin_coefs[b]).astype(np.float32).reshape(resids[b].shape)
+							if diff2_bands[b] is None:
+								diff2_bands[b] = np.zeros_like(logL)
+								self.eval_llik(b, np.zeros_like(resids[b]), resids[b], diff2_bands[b])
+							diff2_acpt = np.zeros_like(logL)
+							self.eval_llik(b, dmodel_acpt, resids[b], diff2_acpt)
+							logL = logL - 0.5*(diff2_acpt - diff2_bands[b])
+							diff2_bands[b] = diff2_acpt
+
+							resids[b] -= dmodel_acpt
+							models[b] += dmodel_acpt
+							chi2[b] += dchi2s[b]
+					diff2_total1 = -2*logL
 
-					resids[b] -= dmodel_acpt
-
-					models[b] += dmodel_acpt
-
-					if b==0:
-						diff2_total1 = diff2_acpt
-					else:
-						diff2_total1 += diff2_acpt
+				else:
+					diff2_total1 = self.accept_model_regions(rtype, dmodels, acceptreg, resids, models, chi2, diff2_bands)
 
 				logL = -0.5*diff2_total1
 
@@ -1260,6 +1933,8 @@ class Model:
 					starsp = proposal.starsp.compress(acceptprop, axis=1)
 					idx_move_a = proposal.idx_move.compress(acceptprop)
 					self.stars[:, idx_move_a] = starsp
+					if self.cells is not None:
+						self.cells.move(idx_move_a, starsp[self._X,:], starsp[self._Y,:])
 
 				
 				if proposal.do_birth:
@@ -1267,16 +1942,13 @@ class Model:
 					starsb = starsb.reshape((2+self.nbands,-1))
 					num_born = starsb.shape[1]
 					self.stars[:, self.n:self.n+num_born] = starsb
+					if self.cells is not None:
+						self.cells.insert(np.arange(self.n, self.n+num_born), starsb[self._X,:], starsb[self._Y,:])
 					self.n += num_born
 
 				if proposal.idx_kill is not None:
 					idx_kill_a = proposal.idx_kill.compress(acceptprop, axis=0).flatten()
-					num_kill = idx_kill_a.size
-				   
-					# nstar is correct, not n, because x,y,f are full nstar arrays
-					self.stars[:, 0:self.max_nsrc-num_kill] = np.delete(self.stars, idx_kill_a, axis=1)
-					self.stars[:, self.max_nsrc-num_kill:] = 0
-					self.n -= num_kill
+					self.kill_stars(idx_kill_a)
 
 				if proposal.change_bkg_bool:
 					if np.sum(acceptreg) > 0:
@@ -1294,7 +1966,11 @@ class Model:
 							self.dfc += proposal.dfc
 
 							for b in range(self.nbands):
-								running_temp[b] += self.fourier_templates[b][proposal.idx0, proposal.idx1, proposal.idxk]*proposal.dfc[proposal.idx0, proposal.idx1, proposal.idxk]
+								if proposal.gibbs:
+									running_temp[b] += fourier_basis_sum(proposal.dfc, self.fourier_bases[b])
+								else:
+									# rank-1 update, only the outer product of the two 1D profiles is formed
+									running_temp[b] += fourier_basis_template(self.fourier_bases[b], proposal.idx0, proposal.idx1, proposal.idxk)*proposal.dfc[proposal.idx0, proposal.idx1, proposal.idxk]
 	
 				dts[2,i] = time.time() - t3
 
@@ -1309,13 +1985,23 @@ class Model:
 					else:
 						accept[i] = 0
 			
+			elif proposal is not None and proposal.prior_reject:
+				priorrejects[i] = 1
 			else:
 				if self.verbtype > 1:
 					print('out of bounds')
 				outbounds[i] = 1
 
-			for b in range(self.nbands):
-				diff2_list[i] += np.sum(self.dat.weights[b]*(self.dat.data_array[b]-models[b])*(self.dat.data_array[b]-models[b]))
+			if self.gdat.chi2_recompute_interval and (i+1) % self.gdat.chi2_recompute_interval == 0:
+				for b in range(self.nbands):
+					chi2_full = self.band_chi2(resids[b], b)
+					if self.verbtype > 1:
+						print('running chi2 of band', b, 'drifted by', chi2[b]-chi2_full)
+					chi2[b] = chi2_full
+				if self.linear_stats is not None:
+					self.linear_stats.mark_stale()
+
+			diff2_list[i] = np.sum(chi2)
 
 					
 			if self.verbtype > 1:
@@ -1326,10 +2012,6 @@ class Model:
 				print(diff2_list[i])
 			
 		# this is after nloop iterations
-		chi2 = np.zeros(self.nbands)
-		for b in range(self.nbands):
-			chi2[b] = np.sum(self.dat.weights[b]*(self.dat.data_array[b]-models[b])*(self.dat.data_array[b]-models[b]))
-			
 		if self.verbtype > 1:
 			print('end of sample')
 			print('self.n end')
@@ -1354,6 +2036,12 @@ class Model:
 		print('at the end of nloop, self.dback is', self.dback, 'so self.bkg is now ', self.bkg)
 		self.dback = np.zeros_like(self.bkg)
 
+		if np.any(priorrejects):
+			print('Moves rejected by the SZ positivity prior:', int(np.sum(priorrejects)), file=self.gdat.flog)
+
+		if sample_idx < self.gdat.adapt_samples:
+			self.adapt_proposals(accept, outbounds, diff2_list, dts, movetype, chi2_start)
+
 		timestat_array, accept_fracs = self.print_sample_status(dts, accept, outbounds, chi2, movetype)
 
 
@@ -1386,7 +2074,238 @@ class Model:
 
 		return self.n, chi2, timestat_array, accept_fracs, diff2_list, rtype_array, accept, resids, models
 
+	def accept_model_regions(self, rtype, dmodels, acceptreg, resids, models, chi2, diff2_bands):
+		''' Adds the model change dmodels of each band to the models and subtracts it from the residuals within the accepted 
+		regions (margins included), keeping the running chi squared and the regional chi squared diff2_bands up to date. 
+		Returns the regional chi squared of the new residuals summed over bands. '''
+		for b in range(self.nbands):
+			dmodel_acpt = np.zeros_like(dmodels[b])
+			diff2_acpt = np.zeros(acceptreg.shape, dtype=np.float64)
+
+			if self.gdat.cblas:
+
+				self.libmmult.pcat_imag_acpt(self.imszs[b][0], self.imszs[b][1], dmodels[b], dmodel_acpt, acceptreg, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
+				# using this dmodel containing only accepted moves, update logL
+				self.libmmult.pcat_like_eval(self.imszs[b][0], self.imszs[b][1], dmodel_acpt, resids[b], self.dat.weights[b], diff2_acpt, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])   
+			else:
+			
+				self.libmmult.clib_updt_modl(self.imszs[b][0], self.imszs[b][1], dmodels[b], dmodel_acpt, acceptreg, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
+				# using this dmodel containing only accepted moves, update logL
+				self.libmmult.clib_eval_llik(self.imszs[b][0], self.imszs[b][1], dmodel_acpt, resids[b], self.dat.weights[b], diff2_acpt, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])   
+
+			# accepted point source regions all have the same parity, so with their margins they don't overlap and the 
+			# change in chi squared is the change in their regional values. Anything else gets a full recompute
+			sparse_update = rtype < 3 and diff2_bands[b] is not None and 2*self.margins[b] <= self.regsizes[b]
+			if sparse_update:
+				chi2[b] += np.sum(diff2_acpt[acceptreg > 0]) - np.sum(diff2_bands[b][acceptreg > 0])
+			diff2_bands[b] = diff2_acpt
+
+			resids[b] -= dmodel_acpt
+
+			models[b] += dmodel_acpt
+
+			if not sparse_update and np.any(acceptreg):
+				chi2[b] = self.band_chi2(resids[b], b)
+			if self.linear_stats is not None and np.any(acceptreg):
+				self.linear_stats.mark_stale(b)
+
+			if b==0:
+				diff2_total1 = diff2_acpt.copy()
+			else:
+				diff2_total1 += diff2_acpt
+
+		return diff2_total1
+
+	def accept_footprint_regions(self, footprints, acceptreg, logL, resids, models, chi2, diff2_bands):
+		''' Counterpart of accept_model_regions for the sparse model changes of pcat_multiband_footprint_eval, only the 
+		footprint pixels inside accepted regions are touched. logL is the regional log likelihood before the update. '''
+		diff2_total1 = -2*logL
+		for b in range(self.nbands):
+			pix, dmodel = footprints[b]
+			acpt_pix = in_regions(pix, acceptreg, self.imszs[b][0], self.imszs[b][1], self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
+			pix = pix.compress(acpt_pix)
+			dmodel = dmodel.compress(acpt_pix)
+
+			diff2_total1 = diff2_total1 + footprint_delta_chi2(pix, dmodel, resids[b], self.dat.weights[b], self.imszs[b], self.regsizes[b], \
+															self.margins[b], self.offsetxs[b], self.offsetys[b])
+			chi2[b] += np.sum(self.dat.weights[b].reshape(-1)[pix]*dmodel*(dmodel - 2*resids[b].reshape(-1)[pix]))
+			diff2_bands[b] = None
+			if self.linear_stats is not None:
+				self.linear_stats.update_pixels(b, pix, dmodel)
+			resids[b].reshape(-1)[pix] -= dmodel.astype(np.float32)
+			models[b].reshape(-1)[pix] += dmodel.astype(np.float32)
+
+		return diff2_total1
+
+	def eval_llik(self, b, image, ref, diff2):
+		''' Regional chi squared of image - ref in band b, with the current offsets and margins. '''
+		if self.gdat.cblas:
+			self.libmmult.pcat_like_eval(self.imszs[b][0], self.imszs[b][1], image, ref, self.dat.weights[b], diff2, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
+		else:
+			self.libmmult.clib_eval_llik(self.imszs[b][0], self.imszs[b][1], image, ref, self.dat.weights[b], diff2, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
+
+	def linear_move_coefs(self, proposal, rtype):
+		''' Changes of the linear parameters of each band proposed by a background (rtype 3), template (4), Fourier 
+		component (5) or joint Gibbs (6) move, in the basis of self.linear_stats. Bands that don't change get None. '''
+		coefs = []
+		for b in range(self.nbands):
+			d = np.zeros(self.linear_stats.nparams[b])
+			if rtype == 3 or rtype == 6:
+				d[0] = proposal.dback[b]
+			if (rtype == 4 or rtype == 6) and proposal.dtemplate is not None:
+				d[1:1+self.n_templates] = proposal.dtemplate[:,b]
+			if rtype == 5 and proposal.fc_rel_amp_bool:
+				d[1+self.n_templates:] = proposal.dfc_rel_amps[b]*(self.fourier_coeffs+self.dfc).ravel()
+			elif (rtype == 5 or rtype == 6) and self.gdat.float_fourier_comps:
+				d[1+self.n_templates:] = (self.fc_rel_amps[b]+self.dfc_rel_amps[b])*proposal.dfc.ravel()
+			coefs.append(d if np.any(d) else None)
+		return coefs
+
+	def linear_normal_matrix(self, rel_amps, bkg_prior_sig):
+		''' Maps J_b from the parameters of gibbs_linear_params to the basis of self.linear_stats for every band, and the 
+		Cholesky factorization of the normal matrix beta*sum_b J_b^T G_b J_b plus the background prior precision. Cached 
+		until the relative Fourier amplitudes rel_amps or the inverse temperature change. '''
+		key = (self.beta, None if rel_amps is None else np.asarray(rel_amps, dtype=np.float64).tobytes())
+		if self.linear_normal is not None and self.linear_normal[0] == key:
+			return self.linear_normal[1:]
+
+		nfc = 2*self.n_fourier_terms**2 if self.gdat.float_fourier_comps else 0
+		npar = len(self.gibbs_params) + nfc
+		jacs = []
+		normal = np.zeros((npar, npar))
+		for b in range(self.nbands):
+			jac = np.zeros((self.linear_stats.nparams[b], npar))
+			for p, (kind, i, band) in enumerate(self.gibbs_params):
+				if band is None or band == b:
+					jac[0 if kind == 'bkg' else 1+i, p] = 1.
+			if nfc:
+				jac[1+self.n_templates:, len(self.gibbs_params):] = rel_amps[b]*np.eye(nfc)
+			jacs.append(jac)
+			normal += self.beta*np.dot(jac.T, np.dot(self.linear_stats.gram[b], jac))
+		for p, (kind, i, band) in enumerate(self.gibbs_params):
+			if kind == 'bkg':
+				normal[p,p] += 1./bkg_prior_sig**2
+		# parameters without any weight in the data (e.g. a Fourier block with zero relative amplitudes) are decoupled 
+		# from the rest and stay put
+		fixed = (np.diag(normal) == 0)
+		normal[np.diag_indices(npar)] += 1e-12*np.max(np.diag(normal)) + fixed
+		self.linear_normal = (key, jacs, cho_factor(normal, lower=True), fixed)
+		return self.linear_normal[1:]
+
+	def gibbs_linear_params(self):
+		''' Draws the background levels, template amplitudes and Fourier coefficients jointly from their Gaussian 
+		conditional given the current point source catalog (with the likelihood tempered by self.beta), with the same 
+		background prior as perturb_background. The draw is always accepted, unless it violates the SZ positivity prior. '''
+		proposal = Proposal(self.gdat)
+		bkg_prior_sig = self.gdat.bkg_prior_sig
+		rel_amps = self.fc_rel_amps+self.dfc_rel_amps if self.gdat.float_fourier_comps else None
+		jacs, chol, fixed = self.linear_normal_matrix(rel_amps, bkg_prior_sig)
+
+		# linear term of the log posterior at the current parameters
+		h = self.beta*np.sum([np.dot(jacs[b].T, self.linear_stats.suff(b, self.resids[b])) for b in range(self.nbands)], axis=0)
+		for p, (kind, i, band) in enumerate(self.gibbs_params):
+			if kind == 'bkg':
+				h[p] += (self.bkg_mus[band]-self.bkg[band]-self.dback[band])/bkg_prior_sig**2
+		dtheta = cho_solve(chol, h) + solve_triangular(chol[0], np.random.normal(size=h.size), lower=True, trans='T')
+		dtheta[fixed] = 0.
+
+		proposal.dtemplate = np.zeros((self.n_templates, self.nbands))
+		for p, (kind, i, band) in enumerate(self.gibbs_params):
+			if kind == 'bkg':
+				proposal.dback[band] = dtheta[p]
+			elif band is None:
+				proposal.dtemplate[i,:] = dtheta[p]
+			else:
+				proposal.dtemplate[i,band] = dtheta[p]
+
+		if self.gdat.float_templates and self.gdat.sz_positivity_prior:
+			for i, key in enumerate(self.gdat.template_order):
+				if key == 'sze' and np.any(self.template_amplitudes[i]+self.dtemplate[i]+proposal.dtemplate[i] < 0):
+					proposal.prior_reject = True
+					return proposal
+
+		proposal.gibbs = True
+		if self.gdat.float_background:
+			proposal.change_bkg()
+		if self.gdat.float_templates:
+			proposal.change_template_amplitude()
+		if self.gdat.float_fourier_comps:
+			proposal.dfc = dtheta[len(self.gibbs_params):].reshape(proposal.dfc.shape)
+			proposal.change_fourier_comp()
+
+		return proposal
+
+	def get_state(self):
+		''' Copy of the catalog and linear parameters of the current state, as read by Samples.add_sample. Only complete 
+		between calls of run_sampler, which folds in the pending changes of the linear parameters at the end. '''
+		return dict({'n':self.n, 'stars':self.stars.copy(), 'bkg':self.bkg.copy(), 'template_amplitudes':self.template_amplitudes.copy(), \
+					'fourier_coeffs':None if self.fourier_coeffs is None else self.fourier_coeffs.copy(), \
+					'fc_rel_amps':None if self.fc_rel_amps is None else np.array(self.fc_rel_amps)})
+
+	def get_sampler_state(self):
+		''' State of get_state together with everything else that determines the following samples: the move weights and 
+		minimum flux set by the schedules of lion, the adapted proposals and the order of the cell index. Saved by 
+		lion.save_checkpoint. '''
+		state = self.get_state()
+		state.update(moveweights=self.moveweights.copy(), trueminf=self.trueminf, step_scales=self.step_scales.copy(), \
+					weight_scales=self.weight_scales.copy(), nadapt=self.nadapt, kickrange=self.kickrange)
+		if self.cells is not None:
+			state.update(cell_slots=self.cells.slots.copy(), cell_count=self.cells.count.copy(), cell_cell=self.cells.cell.copy(), \
+					cell_pos=self.cells.pos.copy())
+		return state
+
+	def set_sampler_state(self, state):
+		''' Restores a state of get_sampler_state. '''
+		self.n = int(state['n'])
+		self.stars = np.array(state['stars'], dtype=np.float32)
+		self.bkg = np.array(state['bkg'])
+		self.template_amplitudes = np.array(state['template_amplitudes'])
+		if self.gdat.float_fourier_comps:
+			self.fourier_coeffs = np.array(state['fourier_coeffs'])
+			self.fc_rel_amps = np.array(state['fc_rel_amps'])
+		self.moveweights = np.array(state['moveweights'])
+		self.trueminf = float(state['trueminf'])
+		self.step_scales = np.array(state['step_scales'])
+		self.weight_scales = np.array(state['weight_scales'])
+		self.nadapt = int(state['nadapt'])
+		self.kickrange = float(state['kickrange'])
+		if self.cells is not None:
+			# the order of the sources within the cells decides which neighbour a deviate picks, so it is restored as 
+			# well rather than rebuilt
+			self.build_cell_index()
+			self.cells.slots = np.array(state['cell_slots'])
+			self.cells.count = np.array(state['cell_count'])
+			self.cells.cell = np.array(state['cell_cell'])
+			self.cells.pos = np.array(state['cell_pos'])
+			self.cells.ranks = np.arange(self.cells.slots.shape[1])
+
+	def band_chi2(self, resid, b):
+		''' Weighted chi squared of the residual resid = data - model of band b over the whole image. '''
+		return np.sum(self.dat.weights[b]*resid*resid, dtype=np.float64)
+
+	def neighbour_sums(self, x0, y0, exclude):
+		''' neighbour_sums() over the catalog, through the cell index when there is one. '''
+		if self.cells is not None:
+			return self.cells.neighbours(self.stars[self._X,:], self.stars[self._Y,:], x0, y0, self.kickrange, exclude)
+		return neighbour_sums(self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n], x0, y0, self.kickrange, exclude)
+
+	def kill_stars(self, idx_kill):
+		''' Removes sources idx_kill from the catalog. The last sources of the catalog that survive are moved into the 
+		slots freed below the new number of sources, so stars[:, 0:n] stays the live catalog and only the columns of the 
+		killed and moved sources are touched. '''
+		n = self.n - idx_kill.size
+		holes = np.sort(idx_kill[idx_kill < n])
+		movers = np.delete(np.arange(n, self.n), idx_kill[idx_kill >= n] - n)
+		if self.cells is not None:
+			self.cells.remove(idx_kill)
+			self.cells.relabel(movers, holes)
+		self.stars[:, holes] = self.stars[:, movers]
+		self.stars[:, n:self.n] = 0
+		self.n = n
+
 	def idx_parity_stars(self):
+		if self.cells is not None:
+			return self.cells.in_regions(self.stars[self._X,:], self.stars[self._Y,:], self.n, self.offsetxs[0], self.offsetys[0], self.parity_x, self.parity_y)
 		return idx_parity(self.stars[self._X,:], self.stars[self._Y,:], self.n, self.offsetxs[0], self.offsetys[0], self.parity_x, self.parity_y, self.regsizes[0])
 
 	def bounce_off_edges(self, catalogue): # works on both stars and galaxies
@@ -1407,13 +2326,14 @@ class Model:
 				np.logical_and(catalogue[self._Y,:] > 0, catalogue[self._Y,:] < self.imsz0[1] - 1))
 
 
-	def perturb_background(self, bkg_prior_sig=0.01):
+	def perturb_background(self):
 
 		proposal = Proposal(self.gdat)
+		bkg_prior_sig = self.gdat.bkg_prior_sig
 		# I want this proposal to return the original dback + the proposed change. If the proposal gets approved later on
 		# then model.dback will be set to the updated state
 		bkg_idx = np.random.choice(self.nbands)
-		dback = np.random.normal(0., scale=self.bkg_sigs[bkg_idx])
+		dback = np.random.normal(0., scale=self.bkg_sigs[bkg_idx]*self.step_scales[3])
 
 		proposal.dback[bkg_idx] = dback
 
@@ -1436,7 +2356,7 @@ class Model:
 
 			# choose a component
 			proposal.idx0, proposal.idx1, proposal.idxk = np.random.randint(0, self.n_fourier_terms), np.random.randint(0, self.n_fourier_terms), np.random.randint(0, 2)
-			coeff_pert = np.random.normal(0, self.temp_amplitude_sigs['fc'])
+			coeff_pert = np.random.normal(0, self.temp_amplitude_sigs['fc']*self.step_scales[5])
 			proposal.dfc[proposal.idx0, proposal.idx1, proposal.idxk] = coeff_pert
 
 			# prior on fourier component.. I think this would involve a prior on the power spectrum of the overall fourier series.. is there
@@ -1456,7 +2376,7 @@ class Model:
 			band_weights /= np.sum(band_weights)
 			band_idx = int(np.random.choice(self.gdat.fourier_band_idxs, p=band_weights))
 
-			d_amp = np.random.normal(0, scale=self.fourier_amp_sig)
+			d_amp = np.random.normal(0, scale=self.fourier_amp_sig*self.step_scales[5])
 			proposal.dfc_rel_amps[band_idx] = d_amp 
 
 		proposal.change_fourier_comp()
@@ -1472,7 +2392,7 @@ class Model:
 		template_idx = np.random.choice(self.n_templates) # if multiple templates, choose one to change at a time
 		temp_band_idxs = self.gdat.template_band_idxs[template_idx]
 
-		d_amp = np.random.normal(0., scale=self.temp_amplitude_sigs[self.gdat.template_order[template_idx]])
+		d_amp = np.random.normal(0., scale=self.temp_amplitude_sigs[self.gdat.template_order[template_idx]]*self.step_scales[4])
 
 		if self.gdat.delta_cp_bool and self.gdat.template_order[template_idx] != 'sze':
 			if self.gdat.template_order[template_idx] == 'planck' or self.gdat.template_order[template_idx]=='dust':
@@ -1522,7 +2442,7 @@ class Model:
 		logdf = np.float32(0.01/np.sqrt(self.gdat.nominal_nsrc))
 		ff = np.log(logdf*logdf*f0 + logdf*np.sqrt(lindf*lindf + logdf*logdf*f0*f0)) / logdf
 		ffmin = np.log(logdf*logdf*trueminf + logdf*np.sqrt(lindf*lindf + logdf*logdf*trueminf*trueminf)) / logdf
-		dff = np.random.normal(size=nw).astype(np.float32)
+		dff = np.random.normal(size=nw).astype(np.float32)*np.float32(self.step_scales[0])
 		aboveffmin = ff - ffmin
 		oob_flux = (-dff > aboveffmin)
 		dff[oob_flux] = -2*aboveffmin[oob_flux] - dff[oob_flux]
@@ -1599,6 +2519,7 @@ class Model:
 			print('dpos_rms')
 			print(dpos_rms)
 		
+		dpos_rms *= np.float32(self.step_scales[0])
 		dpos_rms[dpos_rms < 1e-3] = 1e-3 #do we need this line? perhaps not
 		dx = np.random.normal(size=nw).astype(np.float32)*dpos_rms
 		dy = np.random.normal(size=nw).astype(np.float32)*dpos_rms
@@ -1773,6 +2694,9 @@ class Model:
 			# don't want to think about how to bounce split-merge
 			# don't need to check if above fmin, because of how frac is decided
 			inbounds = np.logical_and(self.in_bounds(starsp), self.in_bounds(starsb))
+			if self.cells is not None:
+				# the pair could not be merged back beyond the neighbour cutoff
+				inbounds = np.logical_and(inbounds, dx*dx + dy*dy <= self.cells.cutoff*self.cells.cutoff)
 			stars0 = stars0.compress(inbounds, axis=1)
 			starsp = starsp.compress(inbounds, axis=1)
 			starsb = starsb.compress(inbounds, axis=1)
@@ -1804,15 +2728,10 @@ class Model:
 				print('fminratio')
 				print(fminratio)
 
-			for k in range(nms):
-				xtemp = self.stars[self._X, 0:self.n].copy()
-				ytemp = self.stars[self._Y, 0:self.n].copy()
-				xtemp[idx_move[k]] = starsp[self._X, k]
-				ytemp[idx_move[k]] = starsp[self._Y, k]
-				xtemp = np.concatenate([xtemp, starsb[self._X, k:k+1]])
-				ytemp = np.concatenate([ytemp, starsb[self._Y, k:k+1]])
-				invpairs[k] =  1./neighbours(xtemp, ytemp, self.kickrange, idx_move[k]) #divide by zero
-				invpairs[k] += 1./neighbours(xtemp, ytemp, self.kickrange, self.n)
+			# neighbours of both sources of each pair after its split
+			pair = np.exp(-((starsb[self._X,:]-starsp[self._X,:])**2 + (starsb[self._Y,:]-starsp[self._Y,:])**2)/(2.*self.kickrange*self.kickrange))
+			invpairs[:] = 1./(self.neighbour_sums(starsp[self._X,:], starsp[self._Y,:], idx_move) + pair)
+			invpairs += 1./(self.neighbour_sums(starsb[self._X,:], starsb[self._Y,:], idx_move) + pair)
 			invpairs *= 0.5
 
 		# merge
@@ -1821,9 +2740,8 @@ class Model:
 			nms = int(min(nms, idx_reg.size/2))
 			idx_move = np.empty(nms, dtype=np.int)
 			idx_kill = np.empty(nms, dtype=np.int)
-			choosable = np.zeros(self.max_nsrc, dtype=np.bool)
-			choosable[idx_reg] = True
-			nchoosable = float(idx_reg.size)
+			# sorted sources that can still be picked, idx_reg is sorted
+			choosable = idx_reg.tolist()
 			invpairs = np.empty(nms)
 			
 			if self.verbtype > 1:
@@ -1833,25 +2751,31 @@ class Model:
 				print('idx_kill', idx_kill)
 				
 			for k in range(nms):
-				idx_move[k] = np.random.choice(self.max_nsrc, p=choosable/nchoosable)
-				invpairs[k], idx_kill[k] = neighbours(self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n], self.kickrange, idx_move[k], generate=True)
+				# uniform over the choosable sources
+				idx_move[k] = choosable[min(int(np.random.random_sample()*len(choosable)), len(choosable)-1)]
+				if self.cells is not None:
+					invpairs[k], idx_kill[k] = self.cells.draw_neighbour(self.stars[self._X,:], self.stars[self._Y,:], self.stars[self._X, idx_move[k]], self.stars[self._Y, idx_move[k]], \
+																	self.kickrange, idx_move[k])
+				else:
+					invpairs[k], idx_kill[k] = neighbours(self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n], self.kickrange, idx_move[k], generate=True)
 				if invpairs[k] > 0:
 					invpairs[k] = 1./invpairs[k]
 				# prevent sources from being involved in multiple proposals
-				if not choosable[idx_kill[k]]:
+				pos = bisect_left(choosable, idx_kill[k])
+				if idx_kill[k] == -1 or pos == len(choosable) or choosable[pos] != idx_kill[k]:
 					idx_kill[k] = -1
-				if idx_kill[k] != -1:
-					invpairs[k] += 1./neighbours(self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n], self.kickrange, idx_kill[k])
-					choosable[idx_move[k]] = False
-					choosable[idx_kill[k]] = False
-					nchoosable -= 2
-			invpairs *= 0.5
+				else:
+					del choosable[pos]
+					del choosable[bisect_left(choosable, idx_move[k])]
 
 			inbounds = (idx_kill != -1)
 			idx_move = idx_move.compress(inbounds)
 			idx_kill = idx_kill.compress(inbounds)
 			invpairs = invpairs.compress(inbounds)
 			nms = idx_move.size
+			# neighbours of the sources merged away
+			invpairs += 1./self.neighbour_sums(self.stars[self._X, idx_kill], self.stars[self._Y, idx_kill], idx_kill)
+			invpairs *= 0.5
 			goodmove = nms > 0
 
 			stars0 = self.stars.take(idx_move, axis=1)
@@ -1974,78 +2898,209 @@ class Model:
 
 
 class Samples():
+	''' Thinned samples of a chain. When the run is saved and h5py is available they are streamed to chain.hdf5 in the run 
+	directory: the arrays with one row per sample only hold the samples since the last flush, at most gdat.sample_chunk, 
+	and the residuals and models of the last residual_samples samples are kept in ring datasets of the file. Otherwise 
+	everything stays in memory until save_samples writes chain.npz. Both are read by load_chain. '''
+
+	# names in the chain file of the arrays with one row per sample, besides the fluxes
+	chain_keys = dict({'n':'nsample', 'x':'xsample', 'y':'ysample', 'chi2':'chi2sample', 'times':'timestats', 'accept':'accept_stats', \
+					'diff2s':'diff2_all', 'rtypes':'rtypes', 'accepts':'accept_all', 'bkg':'bkg_sample', 'template_amplitudes':'template_amplitudes', \
+					'fourier_coeffs':'fourier_coeffs', 'fc_rel_amps':'fc_rel_amps'})
 
 	def __init__(self, gdat):
-		self.nsample = np.zeros(gdat.nsamp, dtype=np.int32)
-		self.xsample = np.zeros((gdat.nsamp, gdat.max_nsrc), dtype=np.float32)
-		self.ysample = np.zeros((gdat.nsamp, gdat.max_nsrc), dtype=np.float32)
-		self.timestats = np.zeros((gdat.nsamp, 6, 7), dtype=np.float32) # fourier comps
-
-		self.diff2_all = np.zeros((gdat.nsamp, gdat.nloop), dtype=np.float32)
-		self.accept_all = np.zeros((gdat.nsamp, gdat.nloop), dtype=np.float32)
-		self.rtypes = np.zeros((gdat.nsamp, gdat.nloop), dtype=np.float32)
-		self.accept_stats = np.zeros((gdat.nsamp, 7), dtype=np.float32) # fourier comps
-
-		self.tq_times = np.zeros(gdat.nsamp, dtype=np.float32)
-		self.fsample = [np.zeros((gdat.nsamp, gdat.max_nsrc), dtype=np.float32) for x in range(gdat.nbands)]
+		self.file = None
+		if gdat.save and h5py is not None:
+			self.path = gdat.result_path+'/'+gdat.timestr+'/chain.hdf5'
+			# a resumed chain appends to the file of the run, see set_state
+			self.file = h5py.File(self.path, 'w' if gdat.resume_timestr is None else 'a')
+		# number of rows of the sample arrays, and index of the sample in their first row
+		nrows = gdat.nsamp if self.file is None else min(gdat.sample_chunk, gdat.nsamp)
+		self.offset = 0
+
+		self.nsample = np.zeros(nrows, dtype=np.int32)
+		self.xsample = np.zeros((nrows, gdat.max_nsrc), dtype=np.float32)
+		self.ysample = np.zeros((nrows, gdat.max_nsrc), dtype=np.float32)
+		self.timestats = np.zeros((nrows, 6, 8), dtype=np.float32) # fourier comps, linear gibbs
+
+		self.diff2_all = np.zeros((nrows, gdat.nloop), dtype=np.float32)
+		self.accept_all = np.zeros((nrows, gdat.nloop), dtype=np.float32)
+		self.rtypes = np.zeros((nrows, gdat.nloop), dtype=np.float32)
+		self.accept_stats = np.zeros((nrows, 8), dtype=np.float32) # fourier comps, linear gibbs
+
+		self.tq_times = np.zeros(nrows, dtype=np.float32)
+		self.fsample = [np.zeros((nrows, gdat.max_nsrc), dtype=np.float32) for x in range(gdat.nbands)]
 		
-		self.bkg_sample = np.zeros((gdat.nsamp, gdat.nbands))
-		self.template_amplitudes = np.zeros((gdat.nsamp, gdat.n_templates, gdat.nbands)) # template # newt
+		self.bkg_sample = np.zeros((nrows, gdat.nbands))
+		self.template_amplitudes = np.zeros((nrows, gdat.n_templates, gdat.nbands)) # template # newt
 		# self.fourier_coeffs = np.zeros((gdat.nsamp, gdat.n_fourier_terms, gdat.n_fourier_terms, 4)) # fourier comps
-		self.fourier_coeffs = np.zeros((gdat.nsamp, gdat.n_fourier_terms, gdat.n_fourier_terms, 2)) # fourier comps
+		self.fourier_coeffs = np.zeros((nrows, gdat.n_fourier_terms, gdat.n_fourier_terms, 2)) # fourier comps
 
-		self.fc_rel_amps = np.zeros((gdat.nsamp, gdat.nbands)) # fourier comp colors
+		self.fc_rel_amps = np.zeros((nrows, gdat.nbands)) # fourier comp colors
 
 		self.colorsample = [[] for x in range(gdat.nbands-1)]
-		self.residuals = [np.zeros((gdat.residual_samples, gdat.imszs[i][0], gdat.imszs[i][1])) for i in range(gdat.nbands)]
-		self.model_images = [np.zeros((gdat.residual_samples, gdat.imszs[i][0], gdat.imszs[i][1])) for i in range(gdat.nbands)]
+		self.chi2sample = np.zeros((nrows, gdat.nbands), dtype=np.int32)
 
-		self.chi2sample = np.zeros((gdat.nsamp, gdat.nbands), dtype=np.int32)
+		if self.file is None:
+			self.residuals = [np.zeros((gdat.residual_samples, gdat.imszs[i][0], gdat.imszs[i][1])) for i in range(gdat.nbands)]
+			self.model_images = [np.zeros((gdat.residual_samples, gdat.imszs[i][0], gdat.imszs[i][1])) for i in range(gdat.nbands)]
+		else:
+			for key, attr in self.chain_keys.items():
+				shape = getattr(self, attr).shape[1:]
+				if key not in self.file:
+					self.file.create_dataset(key, shape=(0,)+shape, maxshape=(None,)+shape, dtype=getattr(self, attr).dtype, \
+											chunks=(nrows,)+shape if min(shape, default=1) > 0 else True)
+			if 'f' not in self.file:
+				self.file.create_dataset('f', shape=(gdat.nbands, 0, gdat.max_nsrc), maxshape=(gdat.nbands, None, gdat.max_nsrc), \
+										dtype=np.float32, chunks=(1, nrows, gdat.max_nsrc))
+			# one chunk per map, so writing a map to the ring touches only its own chunk
+			self.residuals = [self.file.require_dataset('residuals'+str(i), shape=(gdat.residual_samples,)+tuple(gdat.imszs[i]), \
+										dtype=np.float64, chunks=(1,)+tuple(gdat.imszs[i])) for i in range(gdat.nbands)]
+			self.model_images = [self.file.require_dataset('model_images'+str(i), shape=(gdat.residual_samples,)+tuple(gdat.imszs[i]), \
+										dtype=np.float64, chunks=(1,)+tuple(gdat.imszs[i])) for i in range(gdat.nbands)]
+
+		# number of samples added so far, fewer than nsamp if the chain is stopped early
+		self.nfilled = 0
+		# temperatures of the parallel tempering replicas and acceptance fractions of the exchanges between neighbouring ones
+		self.temps = None
+		self.swap_accept = None
 		self.nbands = gdat.nbands
 		self.gdat = gdat
 
 	def add_sample(self, j, model, diff2_list, accepts, rtype_array, accept_fracs, chi2_all, statarrays, resids, model_images):
 		
-		self.nsample[j] = model.n
-		self.xsample[j,:] = model.stars[Model._X, :]
-		self.ysample[j,:] = model.stars[Model._Y, :]
-		self.diff2_all[j,:] = diff2_list
-		self.accept_all[j,:] = accepts
-		self.rtypes[j,:] = rtype_array
-		self.accept_stats[j,:] = accept_fracs
-		self.chi2sample[j] = chi2_all
-		self.timestats[j,:] = statarrays
-		self.bkg_sample[j,:] = model.bkg
-		self.template_amplitudes[j,:,:] = model.template_amplitudes # template
+		self.nfilled = j+1
+		i = j - self.offset
+		self.nsample[i] = model.n
+		self.xsample[i,:] = model.stars[Model._X, :]
+		self.ysample[i,:] = model.stars[Model._Y, :]
+		self.diff2_all[i,:] = diff2_list
+		self.accept_all[i,:] = accepts
+		self.rtypes[i,:] = rtype_array
+		self.accept_stats[i,:] = accept_fracs
+		self.chi2sample[i] = chi2_all
+		self.timestats[i,:] = statarrays
+		self.bkg_sample[i,:] = model.bkg
+		self.template_amplitudes[i,:,:] = model.template_amplitudes # template
 		if self.gdat.float_fourier_comps:
-			self.fourier_coeffs[j,:,:,:] = model.fourier_coeffs # fourier comp
-			self.fc_rel_amps[j,:] = model.fc_rel_amps # fourier comp colors
+			self.fourier_coeffs[i,:,:,:] = model.fourier_coeffs # fourier comp
+			self.fc_rel_amps[i,:] = model.fc_rel_amps # fourier comp colors
 
 		for b in range(self.nbands):
-			self.fsample[b][j,:] = model.stars[Model._F+b,:]
-			if self.gdat.nsamp - j < self.gdat.residual_samples+1:
-				self.residuals[b][-(self.gdat.nsamp-j),:,:] = resids[b] 
-				self.model_images[b][-(self.gdat.nsamp-j),:,:] = model_images[b]
+			self.fsample[b][i,:] = model.stars[Model._F+b,:]
+			# the residuals and models of the last residual_samples samples are kept in a ring buffer, since the chain can 
+			# stop before nsamp
+			self.residuals[b][j % self.gdat.residual_samples,:,:] = resids[b] 
+			self.model_images[b][j % self.gdat.residual_samples,:,:] = model_images[b]
+
+		if self.file is not None and i+1 == self.nsample.shape[0]:
+			self.flush()
+
+	def flush(self):
+		''' Appends the samples added since the last flush to chain.hdf5. '''
+		nnew = self.nfilled - self.offset
+		if self.file is None or nnew == 0:
+			return
+		for key, attr in self.chain_keys.items():
+			self.file[key].resize(self.nfilled, axis=0)
+			self.file[key][self.offset:self.nfilled] = getattr(self, attr)[:nnew]
+		self.file['f'].resize(self.nfilled, axis=1)
+		for b in range(self.nbands):
+			self.file['f'][b, self.offset:self.nfilled] = self.fsample[b][:nnew]
+		self.offset = self.nfilled
+
+	def get_state(self):
+		''' What lion.save_checkpoint needs to restore the samples: the number of samples once they have all been 
+		flushed to chain.hdf5, or the samples added so far and the filled part of the residual and model ring buffers 
+		when they are kept in memory. '''
+		ns = self.nfilled
+		state = dict({'nfilled':ns})
+		if self.file is not None:
+			self.flush()
+			self.file.flush()
+			return state
+
+		nres = min(ns, self.gdat.residual_samples)
+		for key in self.chain_keys.values():
+			state[key] = getattr(self, key)[:ns]
+		for b in range(self.nbands):
+			state['fsample'+str(b)] = self.fsample[b][:ns]
+			state['residuals'+str(b)] = self.residuals[b][:nres]
+			state['model_images'+str(b)] = self.model_images[b][:nres]
+		return state
+
+	def set_state(self, state):
+		''' Restores a state of get_state. '''
+		ns = self.nfilled = int(state['nfilled'])
+		if self.file is not None:
+			# samples flushed after the checkpoint are dropped, the resumed chain adds them again. The ring buffers 
+			# catch up on their own
+			self.offset = ns
+			for key in self.chain_keys:
+				self.file[key].resize(ns, axis=0)
+			self.file['f'].resize(ns, axis=1)
+			return
+
+		nres = min(ns, self.gdat.residual_samples)
+		for key in self.chain_keys.values():
+			getattr(self, key)[:ns] = state[key]
+		for b in range(self.nbands):
+			self.fsample[b][:ns] = state['fsample'+str(b)]
+			self.residuals[b][:nres] = state['residuals'+str(b)]
+			self.model_images[b][:nres] = state['model_images'+str(b)]
+
+	def get_residuals(self, b):
+		''' Residuals of band b of the last residual_samples samples in chronological order, read back from chain.hdf5 
+		once save_samples has written it. '''
+		if self.file is None:
+			ns = self.nfilled
+			return self.residuals[b][np.arange(ns-min(ns, self.gdat.residual_samples), ns) % self.gdat.residual_samples]
+		with h5py.File(self.path, 'r') as chain:
+			return chain['residuals'+str(b)][()]
 
 	def save_samples(self, result_path, timestr):
 
+		# only the samples added so far, and their last residual_samples residuals and models in chronological order
+		ns = self.nfilled
+		nres = min(ns, self.gdat.residual_samples)
+		ring = np.arange(ns-nres, ns) % self.gdat.residual_samples
+
+		if self.file is not None:
+			self.flush()
+			for ring_dset in self.residuals+self.model_images:
+				# rotated in place one map at a time, following the cycles of the permutation
+				shift = ring[0]
+				for start in range(np.gcd(nres, shift) if shift > 0 else 0):
+					first = ring_dset[start]
+					k = start
+					while (k+shift) % nres != start:
+						ring_dset[k] = ring_dset[(k+shift) % nres]
+						k = (k+shift) % nres
+					ring_dset[k] = first
+				ring_dset.resize(nres, axis=0)
+			if self.temps is not None:
+				self.file.create_dataset('temps', data=self.temps)
+				self.file.create_dataset('swap_accept', data=self.swap_accept)
+			self.file.close()
+			return
+
 		# fourier comp, fourier comp colors
 		if self.nbands < 3:
 			residuals2, model_images2 = None, None
 		else:
-			residuals2, model_images2 = self.residuals[2], self.model_images[2]
+			residuals2, model_images2 = self.residuals[2][ring], self.model_images[2][ring]
 		if self.nbands < 2:
 			residuals1, model_images1 = None, None
 		else:
-			residuals1, model_images1 = self.residuals[1], self.model_images[1]
+			residuals1, model_images1 = self.residuals[1][ring], self.model_images[1][ring]
 
-		residuals0, model_images0 = self.residuals[0], self.model_images[0]
+		residuals0, model_images0 = self.residuals[0][ring], self.model_images[0][ring]
 
-		np.savez(result_path + '/' + str(timestr) + '/chain.npz', n=self.nsample, x=self.xsample, y=self.ysample, f=self.fsample, \
-			chi2=self.chi2sample, times=self.timestats, accept=self.accept_stats, diff2s=self.diff2_all, rtypes=self.rtypes, \
-			accepts=self.accept_all, residuals0=residuals0, residuals1=residuals1, residuals2=residuals2, model_images0=model_images0,\
-			model_images1=model_images1, model_images2=model_images2, bkg=self.bkg_sample, template_amplitudes=self.template_amplitudes, \
-			fourier_coeffs=self.fourier_coeffs, fc_rel_amps=self.fc_rel_amps)
+		np.savez(result_path + '/' + str(timestr) + '/chain.npz', n=self.nsample[:ns], x=self.xsample[:ns], y=self.ysample[:ns], f=[fs[:ns] for fs in self.fsample], \
+			chi2=self.chi2sample[:ns], times=self.timestats[:ns], accept=self.accept_stats[:ns], diff2s=self.diff2_all[:ns], rtypes=self.rtypes[:ns], \
+			accepts=self.accept_all[:ns], residuals0=residuals0, residuals1=residuals1, residuals2=residuals2, model_images0=model_images0,\
+			model_images1=model_images1, model_images2=model_images2, bkg=self.bkg_sample[:ns], template_amplitudes=self.template_amplitudes[:ns], \
+			fourier_coeffs=self.fourier_coeffs[:ns], fc_rel_amps=self.fc_rel_amps[:ns], temps=self.temps, swap_accept=self.swap_accept)
 
 
 # -------------------- actually execute the thing ----------------
@@ -2104,6 +3159,9 @@ class lion():
 			float_background = False, \
 			# bkg_sig_fac scales the width of the background proposal distribution
 			bkg_sig_fac = 5., \
+			# width of the Gaussian prior on the background levels around their initial values, used by the background 
+			# proposals and the joint Gibbs draws
+			bkg_prior_sig = 0.01, \
 			# bkg_moveweight sets what fraction of the MCMC proposals are dedicated to perturbing the background level, 
 			# as opposed to changing source positions/births/deaths/splits/merges
 			bkg_moveweight = 10., \
@@ -2162,6 +3220,14 @@ class lion():
 			# the relative amplitude of the coefficients across bands
 			dfc_prob = 0.5, \
 
+			# ---------------------------------- LINEAR GIBBS PARAMS ----------------------------------------
+
+			# weight of the move drawing the floating background levels, template amplitudes and fourier coefficients jointly 
+			# from their conditional given the catalog. Zero disables it, it can replace or complement the moves above
+			linear_gibbs_moveweight = 0., \
+			# number of thinned samples before the joint linear parameter draws start
+			linear_gibbs_sample_delay = 50, \
+
 			# this specifies the order of the fourier expansion. the number of fourier components that are fit for is equal to 
 			# n_fourier_terms squared 
 			n_fourier_terms = 5, \
@@ -2190,6 +3256,14 @@ class lion():
 			load_state_timestr = None,\
 			# set flag to True if you want posterior plots/catalog samples/etc from run saved
 			save = True, \
+			# number of thinned samples between checkpoints of the full state of a single chain, written to checkpoint.npz 
+			# in the run directory. None disables them
+			checkpoint_interval = None, \
+			# time string of a run to continue from its last checkpoint, in its own directory. The other parameters should 
+			# be the ones that run was started with, the chain then goes on exactly as it would have without stopping
+			resume_timestr = None, \
+			# number of thinned samples kept in memory before they are appended to chain.hdf5, when h5py is installed
+			sample_chunk = 20, \
 
 			image_extnames=['SIGNAL'], \
 
@@ -2228,6 +3302,38 @@ class lion():
 			# if specified, nsrc_init is the initial number of sources drawn from the model. otherwise a random integer between 1 and max_nsrc is drawn
 			nsrc_init = None, \
 
+			# number of replicas of the model sampled at different likelihood temperatures (parallel tempering), each in its own 
+			# process forked after the data arrays are moved to shared memory. Only the samples of the cold (unit temperature) 
+			# replica are saved. 1 runs a single untempered chain
+			ntemps = 1, \
+			# temperature of the hottest replica, the ones in between are spaced geometrically from 1
+			max_temp = 10., \
+			# number of thinned samples between proposed exchanges of states between neighbouring temperatures
+			swap_interval = 1, \
+			# number of independent chains, each run in its own process forked after the data arrays are moved to shared 
+			# memory and saved in the subdirectory chain<i> of the run directory. Can't be combined with ntemps > 1
+			nchains = 1, \
+			# with several chains, all of them stop once the split-Rhat of the number of sources, backgrounds and template 
+			# amplitudes after burn-in (the first burn_in_frac of the samples drawn so far) is below rhat_threshold and their 
+			# effective sample size summed over chains is above ess_threshold. None disables the criterion, and with both 
+			# None the chains run all nsamp samples
+			rhat_threshold = 1.05, \
+			ess_threshold = 400, \
+			# number of thinned samples between convergence checks
+			convergence_interval = 10, \
+			# the effective sample size and ESS per second of the parameters monitored by run_chains and of the chi squared 
+			# are logged after every thinned sample of a single chain (see lion.monitor_ess). With early_stop the chain 
+			# stops once they meet rhat_threshold and ess_threshold after burn-in
+			early_stop = False, \
+			# number of initial thinned samples during which the step sizes of the proposals are tuned toward 
+			# adapt_target_accept and the move weights toward the proposals that lower the chi squared the most per second 
+			# (see Model.adapt_proposals). Both are frozen afterwards, so these samples should be part of the burn-in. 0 disables it
+			adapt_samples = 0, \
+			# acceptance fraction targeted by the step size adaptation
+			adapt_target_accept = 0.25, \
+			# the adapted move weights stay within this factor of the ones given below
+			adapt_max_weight_factor = 4., \
+
 			# ----------------------------------- DIAGNOSTICS/POSTERIOR ANALYSIS -------------------------------------
 			
 			# interactive backend should be loaded before importing pyplot
@@ -2268,7 +3374,37 @@ class lion():
 			# set to True if using CBLAS library
 			cblas=False, \
 			# set to True if using OpenBLAS library for non-Intel processors
-			openblas=False):
+			openblas=False, \
+			# set to True to use the vectorized NumPy routines in image_eval.py, e.g. when no compiled library is available
+			numpy_engine=False, \
+			# evaluation backend, one of the keys of eval_backends ('mkl', 'openblas', 'blas', 'numba', 'numpy'), or 'auto' to 
+			# benchmark the available ones on the data at startup and use the fastest. cblas, openblas and numpy_engine override it
+			eval_backend='blas', \
+			# if True, point source proposals only evaluate the likelihood over the pixels touched by the PSF stamps of the 
+			# changed sources, rather than rescanning every pixel of every region
+			incremental_llik=False, \
+			# if True, background, template and Fourier component proposals are evaluated from sufficient statistics of the 
+			# residuals against the (fixed) linear templates instead of re-evaluating the model images
+			linear_suffstats=True, \
+			# number of sampler iterations between full recomputations of the running chi squared of each band from the 
+			# residuals. None or 0 never recomputes it
+			chi2_recompute_interval=100, \
+			# number of OpenMP threads used by the region kernels in blas.c/pcat-lion.c (requires compiling with OpenMP, see Makefile)
+			nthreads=1, \
+			# number of threads evaluating point source proposals concurrently on strips of regions, see 
+			# Model.region_parallel_eval. Lets a single chain use several cores on large maps, 1 evaluates the whole image at once
+			region_threads=1, \
+			# if True, the catalog is bucketed in a grid of cells (see CellIndex) so that merge/split neighbour sums and the 
+			# selection of sources in active regions only look at nearby sources rather than the whole catalog
+			cell_index=False, \
+			# with cell_index, radius in units of kickrange beyond which sources are not considered neighbours for merges, 
+			# and beyond which splits are rejected
+			neighbour_cutoff=6., \
+			# if True, PSF stamps are built as the outer product of two 1D sub-pixel profiles instead of from the full polynomial 
+			# fit, which is cheaper per source. Only valid for separable beams (e.g. Gaussian), see psf_separable_fit
+			separable_psf=False, \
+			# maximum allowed deviation of the separable stamps from the polynomial ones, in units of the stamp peak
+			separable_psf_tol=5e-3):
 
 
 		for attr, valu in locals().items():
@@ -2336,7 +3472,10 @@ class lion():
 			else:
 				self.gdat.init_fourier_coeffs = np.zeros((self.gdat.n_fourier_terms, self.gdat.n_fourier_terms, 2))
 
-			self.gdat.fc_templates = multiband_fourier_templates(self.gdat.imszs, self.gdat.n_fourier_terms, show_templates=self.gdat.show_fc_temps, psf_fwhms=[self.gdat.psf_pixel_fwhm for i in range(self.gdat.nbands)])
+			# only the 1D profiles of the separable templates are kept, the 2D templates are formed when needed
+			self.gdat.fc_bases = multiband_fourier_bases(self.gdat.imszs, self.gdat.n_fourier_terms, psf_fwhms=[self.gdat.psf_pixel_fwhm for i in range(self.gdat.nbands)])
+			if self.gdat.show_fc_temps:
+				multiband_fourier_templates(self.gdat.imszs, self.gdat.n_fourier_terms, show_templates=True, psf_fwhms=[self.gdat.psf_pixel_fwhm for i in range(self.gdat.nbands)])
 
 			# fourier comp colors
 			self.gdat.fourier_band_idxs = [None for b in range(self.gdat.nbands)]
@@ -2363,7 +3502,31 @@ class lion():
 
 			print('BIASES are now ', self.gdat.bias)
 
-		if self.gdat.save:
+		# the parallel tempering replicas or chains already keep the cores busy, and processes forked from one that has started an 
+		# OpenMP thread pool hang in their first parallel region
+		if self.gdat.ntemps > 1 and self.gdat.nchains > 1:
+			raise ValueError('parallel tempering (ntemps > 1) and multiple chains (nchains > 1) can not be combined')
+		if self.gdat.resume_timestr is not None and (self.gdat.ntemps > 1 or self.gdat.nchains > 1):
+			raise ValueError('only single chains can be checkpointed and resumed')
+		if (self.gdat.ntemps > 1 or self.gdat.nchains > 1) and self.gdat.nthreads > 1:
+			warnings.warn('parallel tempering replicas and multiple chains run single threaded, setting nthreads=1', Warning)
+			self.gdat.nthreads = 1
+
+		if self.gdat.cblas:
+			self.gdat.eval_backend = 'mkl'
+		elif self.gdat.openblas:
+			self.gdat.eval_backend = 'openblas'
+		elif self.gdat.numpy_engine:
+			self.gdat.eval_backend = 'numpy'
+		self.libmmult = select_eval_backend(self.gdat, self.data)
+
+		if self.gdat.resume_timestr is not None:
+			# continue in the directory of the run being resumed, keeping its config file
+			self.gdat.timestr = self.gdat.resume_timestr
+			self.gdat.newdir = self.gdat.result_path+'/'+self.gdat.timestr
+			self.gdat.frame_dir = self.gdat.newdir+'/frames'
+
+		elif self.gdat.save:
 			#create directory for results, save config file from run
 			frame_dir, newdir, timestr = create_directories(self.gdat)
 			self.gdat.timestr = timestr
@@ -2375,102 +3538,110 @@ class lion():
 	def main(self):
 
 		''' Here is where we initialize the C libraries and instantiate the arrays that will store our 
-		thinned samples and other stats. We want the MKL routine if possible, then OpenBLAS, then regular C,
-		with that order in priority.'''
+		thinned samples and other stats. The evaluation backend was picked by select_eval_backend in __init__.'''
 
 		if self.gdat.print_log:
-			self.gdat.flog = open(self.gdat.result_path+'/'+self.gdat.timestr+'/print_log.txt','w')
+			self.gdat.flog = open(self.gdat.result_path+'/'+self.gdat.timestr+'/print_log.txt','w' if self.gdat.resume_timestr is None else 'a')
 		else:
 			self.gdat.flog = None
 		
-		if self.gdat.cblas:
-			print('Using CBLAS routines for Intel processors.. :-) ', file=self.gdat.flog)
+		for name, dt in self.gdat.eval_backend_times.items():
+			print('Evaluation backend', name, 'takes', np.round(1e3*dt, 3), 'ms per proposal', file=self.gdat.flog)
+		print('Using the '+self.gdat.eval_backend+' evaluation backend', file=self.gdat.flog)
+		libmmult = self.libmmult
 
-			if sys.version_info[0] == 2:
-				libmmult = npct.load_library('pcat-lion', '.')
-			else:
-				libmmult = npct.load_library('pcat-lion', '.')
-				#libmmult = npct.load_library('pcat-lion.so', '.')
+		# the replicas and chains run in forked processes, which allocate their own evaluation contexts
+		if not self.gdat.numpy_engine:
+			initialize_c(self.gdat, libmmult, cblas=self.gdat.cblas, dat=self.data if self.gdat.ntemps == 1 and self.gdat.nchains == 1 else None)
 
-		elif self.gdat.openblas:
-			print('Using OpenBLAS routines... :-/ ', file=self.gdat.flog)
-			# libmmult = ctypes.cdll['pcat-lion-openblas.so']
-			# libmmult = npct.load_library('pcat-lion-openblas', '.')
-			if sys.version_info[0] == 2:
-				libmmult = npct.load_library('blas-open', '.')
-			else:
-				libmmult = npct.load_library('blas-open.so', '.')
+		start_time = time.time()
+		samps = None
+
+		if self.gdat.nchains > 1:
+			timestrs = self.run_chains()
+
+		elif self.gdat.ntemps > 1:
+			samps, model = self.replica_exchange()
+			timestrs = [self.gdat.timestr]
 
 		else:
-			print('Using slower BLAS routines.. :-( ', file=self.gdat.flog)
-			libmmult = ctypes.cdll['./blas.so'] # not sure how stable this is, trying to find a good Python 3 fix to deal with path configuration
-			# libmmult = npct.load_library('blas', '.')
+			samps = Samples(self.gdat)
+			timestrs = [self.gdat.timestr]
+			model = Model(self.gdat, self.data, libmmult)
+			# initial sum of weights used when reweighting after the weights have been normalized to 1
+			sumweights = np.sum(model.moveweights)
 
-		initialize_c(self.gdat, libmmult, cblas=self.gdat.cblas)
+			print('SUM WEIGHTS IS THE FOLLOWING ---------- ', sumweights)
+			# monitored parameters and elapsed time after each thinned sample
+			traces, elapsed = [], []
+			j0 = 0
+			if self.gdat.resume_timestr is not None:
+				traces, elapsed = self.load_checkpoint(model, samps)
+				j0 = samps.nfilled
+				start_time -= elapsed[-1]
+			# run sampler for gdat.nsamp thinned states
 
-		start_time = time.time()
-		samps = Samples(self.gdat)
-		model = Model(self.gdat, self.data, libmmult)
-		# initial sum of weights used when reweighting after the weights have been normalized to 1
-		sumweights = np.sum(model.moveweights)
+			for j in range(j0, self.gdat.nsamp):
+				print('Sample', j, file=self.gdat.flog)
 
+				self.schedule_moves(model, j)
 
-		print('SUM WEIGHTS IS THE FOLLOWING ---------- ', sumweights)
-		# run sampler for gdat.nsamp thinned states
+				_, chi2_all, statarrays,  accept_fracs, diff2_list, rtype_array, accepts, resids, model_images = model.run_sampler(j)
+				samps.add_sample(j, model, diff2_list, accepts, rtype_array, accept_fracs, chi2_all, statarrays, resids, model_images)
 
-		trueminf_schedule_counter = 0
-		for j in range(self.gdat.nsamp):
-			print('Sample', j, file=self.gdat.flog)
+				names, params = self.convergence_params(model)
+				traces.append(np.append(params, np.sum(chi2_all)))
+				elapsed.append(time.time() - start_time)
+				converged = self.monitor_ess(names+['chi2'], traces, elapsed) and self.gdat.early_stop
 
+				if self.gdat.save and self.gdat.checkpoint_interval is not None and (j+1) % self.gdat.checkpoint_interval == 0:
+					self.save_checkpoint(model, samps, traces, elapsed)
 
-			if self.gdat.schedule_trueminf:
+				if converged:
+					print('Stopping after', j+1, 'samples, the chain has converged', file=self.gdat.flog)
+					break
 
-				if j==self.gdat.trueminf_schedule_samp_idxs[trueminf_schedule_counter]:
-					self.gdat.trueminf = self.gdat.trueminf_schedule_vals[trueminf_schedule_counter]
-					model.trueminf = self.gdat.trueminf_schedule_vals[trueminf_schedule_counter]
+		if not self.gdat.numpy_engine:
+			free_c(self.gdat, libmmult, cblas=self.gdat.cblas)
 
-					trueminf_schedule_counter += 1
-					print('changing trueminf: ', self.gdat.trueminf, model.trueminf)
-			
-			# once ready to sample, recompute proposal weights
+		# the chains of run_chains are saved by their own processes
+		if samps is not None:
+			self.save_chain(samps, model)
 
-			if j==self.gdat.movestar_sample_delay:
-				print('starting move star proposals')
-				model.moveweights[0] = self.gdat.movestar_moveweight
-				print('moveweights:', model.moveweights, file=self.gdat.flog)
+		if self.gdat.timestr_list_file is not None:
+			if path.exists(self.gdat.timestr_list_file):
+				timestr_list = list(np.load(self.gdat.timestr_list_file)['timestr_list'])
+				timestr_list.extend(timestrs)
+			else:
+				timestr_list = timestrs
+			np.savez(self.gdat.timestr_list_file, timestr_list=timestr_list)
 
-			if j==self.gdat.birth_death_sample_delay:
-				print('starting merge split')
-				model.moveweights[1] = self.gdat.birth_death_moveweight
-				print('moveweights:', model.moveweights, file=self.gdat.flog)
+		dt_total = time.time() - start_time
+		print('Full Run Time (s):', np.round(dt_total,3), file=self.gdat.flog)
 
-			if j==self.gdat.merge_split_sample_delay:
-				print('starting merge split')
-				model.moveweights[2] = self.gdat.merge_split_moveweight
-				print('moveweights:', model.moveweights, file=self.gdat.flog)
+		print('Time String:', str(self.gdat.timestr), file=self.gdat.flog)
 
-			if j==self.gdat.bkg_sample_delay:
-				if self.gdat.float_background:
-					print('Starting to sample background now', file=self.gdat.flog)
-					model.moveweights[3] = self.gdat.bkg_moveweight
-				print('moveweights:', model.moveweights, file=self.gdat.flog)
+		with open(self.gdat.newdir+'/time_elapsed.txt', 'w') as filet:
+			filet.write('time elapsed: '+str(np.round(dt_total,3))+'\n')
 
-			if j==self.gdat.temp_sample_delay:
-				if self.gdat.float_templates:
-					print('Starting to sample templates now', file=self.gdat.flog)
-					model.moveweights[4] = self.gdat.template_moveweight
-					print('moveweights:', model.moveweights, file=self.gdat.flog)
+		plt.close()
+			
+		if self.gdat.print_log:
+			self.gdat.flog.close()
 
-			if j==self.gdat.fc_sample_delay:
-				if self.gdat.float_fourier_comps:
-					print('Starting to sample fourier components now', file=self.gdat.flog)
-					model.moveweights[5] = self.gdat.fourier_comp_moveweight
-					print('moveweights:', model.moveweights, file=self.gdat.flog)
 
+		if self.gdat.return_median_model and samps is not None:
+			models = []
+			for b in range(self.gdat.nbands):
+				model_samples = np.array([self.data.data_array[b]-resid for resid in samps.get_residuals(b)])
+				median_model = np.median(model_samples, axis=0)
+				models.append(median_model)
+
+			return models
 
-			_, chi2_all, statarrays,  accept_fracs, diff2_list, rtype_array, accepts, resids, model_images = model.run_sampler(j)
-			samps.add_sample(j, model, diff2_list, accepts, rtype_array, accept_fracs, chi2_all, statarrays, resids, model_images)
 
+	def save_chain(self, samps, model):
+		''' Saves the samples and final state of a chain in the run directory, and makes the posterior plots. '''
 
 		if self.gdat.save:
 			print('saving...', file=self.gdat.flog)
@@ -2481,41 +3652,357 @@ class lion():
 			# save final catalog state
 			np.savez(self.gdat.result_path + '/'+str(self.gdat.timestr)+'/final_state.npz', cat=model.stars, bkg=model.bkg, templates=model.template_amplitudes, fourier_coeffs=model.fourier_coeffs)
 
-		if self.gdat.timestr_list_file is not None:
-			if path.exists(self.gdat.timestr_list_file):
-				timestr_list = list(np.load(self.gdat.timestr_list_file)['timestr_list'])
-				timestr_list.append(self.gdat.timestr)
-			else:
-				timestr_list = [self.gdat.timestr]
-			np.savez(self.gdat.timestr_list_file, timestr_list=timestr_list)
-
-
 		if self.gdat.make_post_plots:
 			result_plots(gdat = self.gdat)
 
-		dt_total = time.time() - start_time
-		print('Full Run Time (s):', np.round(dt_total,3), file=self.gdat.flog)
+	def save_checkpoint(self, model, samps, traces, elapsed):
+		''' Saves the state of model, the samples of samps, the monitored traces and elapsed times of main and the state of 
+		the random number generator to checkpoint.npz in the run directory. The file is written under another name 
+		and then renamed, so a crash leaves the previous checkpoint intact. '''
+
+		state = model.get_sampler_state()
+		state.update({'samples_'+key: value for key, value in samps.get_state().items()})
+		state.update(traces=np.array(traces), elapsed=np.array(elapsed))
+		_, state['rng_keys'], state['rng_pos'], state['rng_has_gauss'], state['rng_gauss'] = np.random.get_state()
+
+		checkpoint_path = self.gdat.result_path+'/'+self.gdat.timestr+'/checkpoint.npz'
+		with open(checkpoint_path+'.tmp', 'wb') as file:
+			np.savez(file, **{key: value for key, value in state.items() if value is not None})
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(checkpoint_path+'.tmp', checkpoint_path)
+		print('Saved checkpoint after', samps.nfilled, 'samples', file=self.gdat.flog)
+
+	def load_checkpoint(self, model, samps):
+		''' Restores model, samps and the random number generator from the checkpoint of run gdat.resume_timestr, and 
+		returns the monitored traces and elapsed times of main. '''
+
+		checkpoint = np.load(self.gdat.result_path+'/'+self.gdat.resume_timestr+'/checkpoint.npz')
+		model.set_sampler_state(checkpoint)
+		samps.set_state({key[len('samples_'):]: checkpoint[key] for key in checkpoint.files if key.startswith('samples_')})
+		self.gdat.trueminf = model.trueminf
+		np.random.set_state(('MT19937', checkpoint['rng_keys'], int(checkpoint['rng_pos']), int(checkpoint['rng_has_gauss']), \
+							float(checkpoint['rng_gauss'])))
+		print('Resuming from the checkpoint after', samps.nfilled, 'samples', file=self.gdat.flog)
+
+		return list(checkpoint['traces']), list(checkpoint['elapsed'])
+
+	def schedule_moves(self, model, j):
+		''' Turns on the proposals of model whose delays end at thinned sample j, and updates the minimum flux if it is 
+		scheduled. '''
+
+		if self.gdat.schedule_trueminf and j in self.gdat.trueminf_schedule_samp_idxs:
+			trueminf_schedule_counter = list(self.gdat.trueminf_schedule_samp_idxs).index(j)
+			self.gdat.trueminf = self.gdat.trueminf_schedule_vals[trueminf_schedule_counter]
+			model.trueminf = self.gdat.trueminf_schedule_vals[trueminf_schedule_counter]
+			print('changing trueminf: ', self.gdat.trueminf, model.trueminf)
+
+		# once ready to sample, recompute proposal weights
+
+		if j==self.gdat.movestar_sample_delay:
+			print('starting move star proposals')
+			model.moveweights[0] = self.gdat.movestar_moveweight
+			print('moveweights:', model.moveweights, file=self.gdat.flog)
+
+		if j==self.gdat.birth_death_sample_delay:
+			print('starting merge split')
+			model.moveweights[1] = self.gdat.birth_death_moveweight
+			print('moveweights:', model.moveweights, file=self.gdat.flog)
+
+		if j==self.gdat.merge_split_sample_delay:
+			print('starting merge split')
+			model.moveweights[2] = self.gdat.merge_split_moveweight
+			print('moveweights:', model.moveweights, file=self.gdat.flog)
+
+		if j==self.gdat.bkg_sample_delay:
+			if self.gdat.float_background:
+				print('Starting to sample background now', file=self.gdat.flog)
+				model.moveweights[3] = self.gdat.bkg_moveweight
+			print('moveweights:', model.moveweights, file=self.gdat.flog)
 
-		print('Time String:', str(self.gdat.timestr), file=self.gdat.flog)
+		if j==self.gdat.temp_sample_delay:
+			if self.gdat.float_templates:
+				print('Starting to sample templates now', file=self.gdat.flog)
+				model.moveweights[4] = self.gdat.template_moveweight
+				print('moveweights:', model.moveweights, file=self.gdat.flog)
 
-		with open(self.gdat.newdir+'/time_elapsed.txt', 'w') as filet:
-			filet.write('time elapsed: '+str(np.round(dt_total,3))+'\n')
+		if j==self.gdat.fc_sample_delay:
+			if self.gdat.float_fourier_comps:
+				print('Starting to sample fourier components now', file=self.gdat.flog)
+				model.moveweights[5] = self.gdat.fourier_comp_moveweight
+				print('moveweights:', model.moveweights, file=self.gdat.flog)
 
-		plt.close()
-			
+		if j==self.gdat.linear_gibbs_sample_delay:
+			if len(model.gibbs_params) > 0 or self.gdat.float_fourier_comps:
+				print('Starting joint Gibbs draws of the linear parameters now', file=self.gdat.flog)
+				model.moveweights[6] = self.gdat.linear_gibbs_moveweight
+				print('moveweights:', model.moveweights, file=self.gdat.flog)
+
+	def run_replica(self, conn, k, beta, seed):
+		''' Runs replica k of parallel tempering in a forked process. The replica draws its own initial state from seed and 
+		then follows the commands sent by replica_exchange through conn: run thinned sample j (returning the total log 
+		likelihood, and for the cold replica what Samples records), change the inverse temperature, or stop. '''
+
+		np.random.seed(seed)
+		if self.gdat.print_log:
+			self.gdat.flog = open(self.gdat.result_path+'/'+self.gdat.timestr+'/print_log_replica'+str(k)+'.txt','w')
+
+		if not self.gdat.numpy_engine:
+			initialize_c(self.gdat, self.libmmult, cblas=self.gdat.cblas, dat=self.data)
+		model = Model(self.gdat, self.data, self.libmmult)
+		model.beta = beta
+
+		while True:
+			command, arg = conn.recv()
+			if command == 'sample':
+				j, cold = arg
+				self.schedule_moves(model, j)
+				outputs = model.run_sampler(j)
+				conn.send((-0.5*np.sum(outputs[1]), (model.get_state(), outputs[1:]) if cold else None))
+			elif command == 'beta':
+				model.beta = arg
+			else:
+				break
+
+		if not self.gdat.numpy_engine:
+			free_c(self.gdat, self.libmmult, cblas=self.gdat.cblas)
 		if self.gdat.print_log:
 			self.gdat.flog.close()
+		conn.close()
+
+	def replica_exchange(self):
+		''' Parallel tempering. Runs gdat.ntemps replicas of the model with their likelihoods raised to the inverse of 
+		temperatures spaced geometrically between 1 and gdat.max_temp, each in a process forked after the data arrays 
+		are moved to shared memory. Every gdat.swap_interval thinned samples, neighbouring temperatures (alternately 
+		starting from the coldest and the next one) exchange their states with the usual Metropolis probability 
+		min(1, exp((beta_k - beta_k+1)(logL_k+1 - logL_k))). The replicas exchange their temperatures rather than their 
+		states, which is equivalent and cheaper. Returns the Samples of the replica at unit temperature, along with the 
+		exchange acceptance fractions, and its final state. '''
+
+		temps = np.geomspace(1., self.gdat.max_temp, self.gdat.ntemps)
+		betas = 1./temps
+		print('Parallel tempering with temperatures', temps, file=self.gdat.flog)
+
+		# the replicas only read these, so forked processes all map the same copy
+		self.data.share_memory()
+		if self.gdat.float_fourier_comps:
+			self.gdat.fc_bases = to_shared_memory(self.gdat.fc_bases)
+		if self.gdat.flog is not None:
+			self.gdat.flog.flush()
+
+		mp_ctx = multiprocessing.get_context('fork')
+		seeds = np.random.randint(2**31-1, size=self.gdat.ntemps)
+		conns, procs = [], []
+		for k in range(self.gdat.ntemps):
+			conn, child_conn = mp_ctx.Pipe()
+			proc = mp_ctx.Process(target=self.run_replica, args=(child_conn, k, betas[k], seeds[k]))
+			proc.start()
+			child_conn.close()
+			conns.append(conn)
+			procs.append(proc)
+
+		# opened after the fork, so the replicas don't inherit the handle of the sample file
+		samps = Samples(self.gdat)
 
+		# replica at each temperature, coldest first
+		order = np.arange(self.gdat.ntemps)
+		nswap = np.zeros(self.gdat.ntemps-1)
+		nswap_accept = np.zeros(self.gdat.ntemps-1)
+		logLs = np.zeros(self.gdat.ntemps)
 
-		if self.gdat.return_median_model:
-			models = []
+		for j in range(self.gdat.nsamp):
+			print('Sample', j, file=self.gdat.flog)
+
+			for k in range(self.gdat.ntemps):
+				conns[order[k]].send(('sample', (j, k==0)))
+			for k in range(self.gdat.ntemps):
+				logLs[k], cold_outputs = conns[order[k]].recv()
+				if k == 0:
+					state, (chi2_all, statarrays, accept_fracs, diff2_list, rtype_array, accepts, resids, model_images) = cold_outputs
+					samps.add_sample(j, objectview(state), diff2_list, accepts, rtype_array, accept_fracs, chi2_all, statarrays, resids, model_images)
+
+			if (j+1) % self.gdat.swap_interval == 0:
+				for k in range((j // self.gdat.swap_interval) % 2, self.gdat.ntemps-1, 2):
+					nswap[k] += 1
+					if np.log(np.random.uniform()) < (betas[k]-betas[k+1])*(logLs[k+1]-logLs[k]):
+						nswap_accept[k] += 1
+						order[k], order[k+1] = order[k+1], order[k]
+						conns[order[k]].send(('beta', betas[k]))
+						conns[order[k+1]].send(('beta', betas[k+1]))
+
+				print('Exchange acceptance fractions:', nswap_accept/np.maximum(nswap, 1), file=self.gdat.flog)
+
+		for k in range(self.gdat.ntemps):
+			conns[k].send(('stop', None))
+			conns[k].close()
+			procs[k].join()
+
+		samps.temps = temps
+		samps.swap_accept = nswap_accept/np.maximum(nswap, 1)
+		print('Acceptance fractions of the exchanges between neighbouring temperatures:', samps.swap_accept, file=self.gdat.flog)
+
+		return samps, objectview(state)
+
+	def convergence_params(self, model):
+		''' Names and current values of the parameters whose convergence run_chains monitors: the number of sources, and 
+		the backgrounds and template amplitudes when they are floated. '''
+
+		names, values = ['nsrc'], [model.n]
+		if self.gdat.float_background:
 			for b in range(self.gdat.nbands):
-				model_samples = np.array([self.data.data_array[b]-samps.residuals[b][i] for i in range(self.gdat.residual_samples)])
-				median_model = np.median(model_samples, axis=0)
-				models.append(median_model)
+				names.append('bkg'+str(b))
+				values.append(model.bkg[b])
+		if self.gdat.float_templates:
+			for i, key in enumerate(self.gdat.template_order):
+				for b in range(self.gdat.nbands):
+					if self.data.template_array[b][i] is not None:
+						names.append(key+str(b))
+						values.append(model.template_amplitudes[i,b])
 
-			return models
+		return names, np.array(values, dtype=np.float64)
+
+	def burn_in_end(self):
+		''' First thinned sample after which the proposals are no longer changed by the delays, the minimum flux schedule 
+		or the adaptation of Model.adapt_proposals. '''
+
+		delays = [self.gdat.movestar_sample_delay, self.gdat.birth_death_sample_delay, self.gdat.merge_split_sample_delay]
+		if self.gdat.float_background:
+			delays.append(self.gdat.bkg_sample_delay)
+		if self.gdat.float_templates:
+			delays.append(self.gdat.temp_sample_delay)
+		if self.gdat.float_fourier_comps:
+			delays.append(self.gdat.fc_sample_delay)
+		if self.gdat.schedule_trueminf:
+			delays.append(max(self.gdat.trueminf_schedule_samp_idxs))
+
+		return max(max(delays), self.gdat.adapt_samples)
+
+	def monitor_ess(self, names, traces, elapsed):
+		''' Logs the split-Rhat, effective sample size and ESS per second of wall time of each monitored parameter of a 
+		single chain, over its samples after burn-in: the first burn_in_frac of the samples drawn so far, and at least 
+		the samples before burn_in_end. Returns True once they meet gdat.rhat_threshold and gdat.ess_threshold. '''
+
+		nsamp = len(traces)
+		start = max(int(self.gdat.burn_in_frac*nsamp), self.burn_in_end())
+		if nsamp - start < 4:
+			return False
+
+		samples = np.array(traces[start:])
+		rhats = np.array([split_rhat(samples[None,:,p]) for p in range(samples.shape[1])])
+		esss = np.array([effective_sample_size(samples[None,:,p]) for p in range(samples.shape[1])])
+		print('ESS after', nsamp, 'samples,', nsamp-start, 'after burn-in:', file=self.gdat.flog)
+		for p, name in enumerate(names):
+			print(name, 'split-Rhat', np.round(rhats[p], 3), 'ESS', np.round(esss[p], 1), 'ESS/s', np.round(esss[p]/elapsed[-1], 4), file=self.gdat.flog)
+
+		if self.gdat.rhat_threshold is None and self.gdat.ess_threshold is None:
+			return False
+		return (self.gdat.rhat_threshold is None or np.all(rhats < self.gdat.rhat_threshold)) and \
+			(self.gdat.ess_threshold is None or np.all(esss > self.gdat.ess_threshold))
+
+	def run_chain(self, conn, c, seed):
+		''' Runs chain c of run_chains in a forked process, from an initial state drawn from seed, and saves it in the 
+		subdirectory chain<c> of the run directory. After every thinned sample the monitored parameters (see 
+		convergence_params) are sent through conn, and the chain stops early when run_chains sends anything back. '''
+
+		np.random.seed(seed)
+		if self.gdat.save:
+			self.gdat.timestr = self.gdat.timestr+'/chain'+str(c)
+			self.gdat.frame_dir, self.gdat.newdir, self.gdat.timestr = create_directories(self.gdat)
+			save_params(self.gdat.newdir, self.gdat)
+		if self.gdat.print_log:
+			self.gdat.flog = open(self.gdat.result_path+'/'+self.gdat.timestr+'/print_log.txt','w')
 
+		if not self.gdat.numpy_engine:
+			initialize_c(self.gdat, self.libmmult, cblas=self.gdat.cblas, dat=self.data)
+		model = Model(self.gdat, self.data, self.libmmult)
+		samps = Samples(self.gdat)
+
+		for j in range(self.gdat.nsamp):
+			if conn.poll():
+				print('Stopping after', j, 'samples, the chains have converged', file=self.gdat.flog)
+				break
+			print('Sample', j, file=self.gdat.flog)
 
+			self.schedule_moves(model, j)
 
+			_, chi2_all, statarrays,  accept_fracs, diff2_list, rtype_array, accepts, resids, model_images = model.run_sampler(j)
+			samps.add_sample(j, model, diff2_list, accepts, rtype_array, accept_fracs, chi2_all, statarrays, resids, model_images)
+			conn.send(('sample', self.convergence_params(model)))
 
+		if not self.gdat.numpy_engine:
+			free_c(self.gdat, self.libmmult, cblas=self.gdat.cblas)
+		self.save_chain(samps, model)
+		if self.gdat.print_log:
+			self.gdat.flog.close()
+		conn.send(('done', self.gdat.timestr))
+		conn.close()
+
+	def run_chains(self):
+		''' Runs gdat.nchains independent chains, each in a process forked after the data arrays are moved to shared 
+		memory, with its own seed. Every gdat.convergence_interval samples (over the samples all chains have reached) the 
+		split-Rhat and effective sample size of the parameters of convergence_params are computed after burn-in, and all 
+		chains are stopped once they meet gdat.rhat_threshold and gdat.ess_threshold. Returns the time strings of the run 
+		directories of the chains. '''
+
+		# the chains only read these, so forked processes all map the same copy
+		self.data.share_memory()
+		if self.gdat.float_fourier_comps:
+			self.gdat.fc_bases = to_shared_memory(self.gdat.fc_bases)
+		if self.gdat.flog is not None:
+			self.gdat.flog.flush()
+
+		mp_ctx = multiprocessing.get_context('fork')
+		seeds = np.random.randint(2**31-1, size=self.gdat.nchains)
+		conns, procs = [], []
+		for c in range(self.gdat.nchains):
+			conn, child_conn = mp_ctx.Pipe()
+			proc = mp_ctx.Process(target=self.run_chain, args=(child_conn, c, seeds[c]))
+			proc.start()
+			child_conn.close()
+			conns.append(conn)
+			procs.append(proc)
+
+		monitor = self.gdat.rhat_threshold is not None or self.gdat.ess_threshold is not None
+		traces = [[] for c in range(self.gdat.nchains)]
+		timestrs = [None for c in range(self.gdat.nchains)]
+		running = list(range(self.gdat.nchains))
+		ncheck = self.gdat.convergence_interval
+
+		while len(running) > 0:
+			for conn in multiprocessing.connection.wait([conns[c] for c in running]):
+				c = conns.index(conn)
+				message, value = conn.recv()
+				if message == 'sample':
+					names, params = value
+					traces[c].append(params)
+				else:
+					timestrs[c] = value
+					running.remove(c)
+					conn.close()
+
+			nsamp = min(len(trace) for trace in traces)
+			if monitor and nsamp >= ncheck:
+				ncheck += self.gdat.convergence_interval
+				samples = np.array([trace[int(self.gdat.burn_in_frac*nsamp):nsamp] for trace in traces])
+				if samples.shape[1] < 4:
+					continue
+				rhats = np.array([split_rhat(samples[:,:,p]) for p in range(samples.shape[2])])
+				esss = np.array([effective_sample_size(samples[:,:,p]) for p in range(samples.shape[2])])
+				print('Convergence after', nsamp, 'samples:', file=self.gdat.flog)
+				for p, name in enumerate(names):
+					print(name, 'split-Rhat', np.round(rhats[p], 3), 'ESS', np.round(esss[p], 1), file=self.gdat.flog)
+
+				if (self.gdat.rhat_threshold is None or np.all(rhats < self.gdat.rhat_threshold)) and \
+						(self.gdat.ess_threshold is None or np.all(esss > self.gdat.ess_threshold)):
+					print('Chains have converged, stopping them', file=self.gdat.flog)
+					monitor = False
+					for c in running:
+						try:
+							conns[c].send('stop')
+						except (BrokenPipeError, OSError): # the chain finished in the meantime
+							pass
+
+		for proc in procs:
+			proc.join()
+
+		return timestrs
@@ -1,18 +1,29 @@
 from fast_astrom import *
 import numpy as np
 from astropy.convolution import Gaussian2DKernel
-from image_eval import psf_poly_fit, image_model_eval
+from image_eval import psf_poly_fit, psf_separable_fit, image_model_eval
 import pickle
+import os
+import ctypes
+import multiprocessing
 import matplotlib
 import matplotlib.pyplot as plt
 from astropy.wcs import WCS
+try:
+	import h5py
+except ImportError:
+	h5py = None
 
 
+# fitted PSF coefficients are cached on disk here so that repeated runs and worker processes skip the fit, 
+# the location can be changed with the PCAT_PSF_CACHE environment variable
+psf_cache_dir = os.environ.get('PCAT_PSF_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pcat_psf'))
+
 class objectview(object):
 	def __init__(self, d):
 		self.__dict__ = d
 
-def get_gaussian_psf_template_3_5_20(pixel_fwhm = 3., nbin=5):
+def get_gaussian_psf_template_3_5_20(pixel_fwhm = 3., nbin=5, cache_dir=psf_cache_dir):
 	''' 
 	Computes Gaussian PSF kernel for fast model evaluation with lion
 
@@ -26,6 +37,10 @@ def get_gaussian_psf_template_3_5_20(pixel_fwhm = 3., nbin=5):
 		Upsampling factor for sub-pixel interpolation method in lion
 		Default is 5.
 
+	cache_dir : str, optional
+		Directory of the on-disk cache of polynomial coefficients, passed to psf_poly_fit. None disables it.
+		Default is psf_cache_dir.
+
 	Returns
 	-------
 
@@ -41,10 +56,10 @@ def get_gaussian_psf_template_3_5_20(pixel_fwhm = 3., nbin=5):
 	'''
 	nc = nbin**2
 	psfnew = Gaussian2DKernel((pixel_fwhm/2.355)*nbin, x_size=125, y_size=125).array.astype(np.float32)
-	cf = psf_poly_fit(psfnew, nbin=nbin)
+	cf = psf_poly_fit(psfnew, nbin=nbin, cache_dir=cache_dir)
 	return psfnew, cf, nc, nbin
 
-def get_gaussian_psf_template(pixel_fwhm=3., nbin=5, normalization='max'):
+def get_gaussian_psf_template(pixel_fwhm=3., nbin=5, normalization='max', cache_dir=psf_cache_dir):
 	nc = 25
 	psfnew = Gaussian2DKernel((pixel_fwhm/2.355)*nbin, x_size=125, y_size=125).array.astype(np.float32)
 
@@ -55,7 +70,7 @@ def get_gaussian_psf_template(pixel_fwhm=3., nbin=5, normalization='max'):
 	else:
 		print('Normalizing PSF by kernel sum')
 		psfnew *= nc
-	cf = psf_poly_fit(psfnew, nbin=nbin)
+	cf = psf_poly_fit(psfnew, nbin=nbin, cache_dir=cache_dir)
 	return psfnew, cf, nc, nbin
 
 
@@ -211,6 +226,37 @@ def load_param_dict(timestr, result_path='/Users/luminatech/Documents/multiband_
 	return opt, filepath, result_path
 
 
+def load_chain(filepath):
+
+	''' 
+	Loads the samples of a prior run of PCAT, from chain.hdf5 when they were streamed to disk during the run and from 
+	chain.npz otherwise.
+
+	Parameters
+	----------
+
+	filepath : string
+		directory of the PCAT run.
+
+	Returns
+	-------
+
+	chain : dict-like mapping the names of the sampled quantities (n, x, y, f, bkg, residuals0, ...) to their arrays
+
+	'''
+	if os.path.isfile(filepath+'/chain.hdf5'):
+		if h5py is None:
+			raise ImportError('h5py is needed to read '+filepath+'/chain.hdf5')
+		with h5py.File(filepath+'/chain.hdf5', 'r') as chain:
+			chain = dict({key: chain[key][()] for key in chain.keys()})
+		# keys that chain.npz stores as None, for fewer than three bands or without parallel tempering
+		for key in ['residuals1', 'residuals2', 'model_images1', 'model_images2', 'temps', 'swap_accept']:
+			chain.setdefault(key, None)
+		return chain
+
+	return np.load(filepath+'/chain.npz')
+
+
 def get_rect_mask_bounds(mask):
 
 	''' this function assumes the mask is rectangular in shape, with ones in the desired region and zero otherwise. '''
@@ -221,6 +267,35 @@ def get_rect_mask_bounds(mask):
 	return bounds
 
 
+def to_shared_memory(arrays):
+
+	'''
+	Copies arrays into shared memory, so that processes forked afterwards (e.g. parallel tempering replicas) read 
+	the same physical copy instead of one each once their pages are touched.
+
+	Parameters
+	----------
+
+	arrays : `~numpy.ndarray`, or list/tuple of them (possibly nested, with other entries such as None left as they are)
+
+	Returns
+	-------
+
+	shared : same structure as arrays, with every array replaced by a C-contiguous copy backed by shared memory
+
+	'''
+	if isinstance(arrays, np.ndarray):
+		buf = multiprocessing.RawArray(ctypes.c_char, max(arrays.nbytes, 1))
+		shared = np.frombuffer(buf, dtype=arrays.dtype, count=arrays.size).reshape(arrays.shape)
+		shared[...] = arrays
+		return shared
+
+	if isinstance(arrays, (list, tuple)):
+		return type(arrays)(to_shared_memory(a) for a in arrays)
+
+	return arrays
+
+
 ''' This class sets up the data structures for data/data-related information. 
 load_in_data() loads in data, generates the PSF template and computes weights from the noise model
 '''
@@ -230,9 +305,16 @@ class pcat_data():
 
 	def __init__(self, auto_resize=False, nregion=1):
 		self.ncs, self.nbins, self.psfs, self.cfs, self.biases, self.data_array, self.weights, self.masks, self.errors, \
-			self.widths, self.heights, self.fracs, self.template_array, self.injected_diffuse_comp = [[] for x in range(14)]
+			self.widths, self.heights, self.fracs, self.template_array, self.injected_diffuse_comp, self.sepcfs = [[] for x in range(15)]
 		self.fast_astrom = wcs_astrometry(auto_resize, nregion=nregion)
 
+	def share_memory(self):
+
+		''' Moves the image, noise, mask, PSF and template arrays into shared memory, see to_shared_memory. '''
+
+		for attr in ['data_array', 'weights', 'errors', 'masks', 'psfs', 'cfs', 'sepcfs', 'template_array', 'injected_diffuse_comp']:
+			setattr(self, attr, to_shared_memory(getattr(self, attr)))
+
 	def load_in_data(self, gdat, map_object=None, tail_name=None, show_input_maps=False):
 
 		'''
@@ -586,6 +668,8 @@ class pcat_data():
 
 			self.psfs.append(psf)
 			self.cfs.append(cf)
+			if gdat.separable_psf:
+				self.sepcfs.append(psf_separable_fit(psf, nbin, tol=gdat.separable_psf_tol, cache_dir=psf_cache_dir))
 			self.ncs.append(nc)
 			self.nbins.append(nbin)
 			# self.biases.append(gdat.bias)
@@ -253,7 +253,7 @@ def scotts_rule_bins(samples):
 def make_pcat_sample_gif(timestr, im_path, gif_path=None, cat_xy=True, resids=True, color_color=True, result_path='/Users/luminatech/Documents/multiband_pcat/spire_results/', \
 						gif_fpr = 5):
 
-	chain = np.load('spire_results/'+timestr+'/chain.npz')
+	chain = load_chain('spire_results/'+timestr)
 	residz = chain['residuals0']
 	gdat, filepath, result_path = load_param_dict(timestr, result_path='spire_results/')
 
@@ -424,14 +424,11 @@ def plot_fc_median_std(fourier_coeffs, imsz, ref_img=None, bkg_samples=None, fou
 
 	n_terms = fourier_coeffs.shape[-2]
 
-	all_temps = np.zeros((fourier_coeffs.shape[0], imsz[0], imsz[1]))
-	if fourier_templates is None:
-		fourier_templates = make_fourier_templates(imsz[0], imsz[1], n_terms, psf_fwhm=psf_fwhm)
-
-	for i, fourier_coeff_state in enumerate(fourier_coeffs):
-		all_temps[i] = generate_template(fourier_coeff_state, n_terms, fourier_templates=fourier_templates, N=imsz[0], M=imsz[1])
-		if bkg_samples is not None:
-			all_temps[i] += bkg_samples[i]
+	# all samples reconstructed in one call
+	all_temps = generate_template(fourier_coeffs, n_terms, fourier_templates=fourier_templates, N=imsz[0], M=imsz[1], psf_fwhm=psf_fwhm)
+	if bkg_samples is not None:
+		bkg_samples = np.asarray(bkg_samples)
+		all_temps += bkg_samples.reshape(bkg_samples.shape + (1,)*(all_temps.ndim - bkg_samples.ndim))
 
 	mean_fc_temp = np.median(all_temps, axis=0)
 	std_fc_temp = np.std(all_temps, axis=0)
@@ -490,8 +487,6 @@ def plot_last_fc_map(fourier_coeffs, imsz, ref_img=None, fourier_templates=None,
 	n_terms = fourier_coeffs.shape[-2]
 
 
-	if fourier_templates is None:
-		fourier_templates = make_fourier_templates(imsz[0], imsz[1], n_terms)
 	last_temp = generate_template(fourier_coeffs, n_terms, fourier_templates=fourier_templates, N=imsz[0], M=imsz[1])
 
 	if ref_img is not None:
@@ -1143,7 +1138,7 @@ def grab_atcr(timestr, paramstr='template_amplitudes', band=0, result_dir=None,
 		result_dir = '/Users/richardfeder/Documents/multiband_pcat/spire_results/'
 		print('Result directory assumed to be '+result_dir)
 		
-	chain = np.load(result_dir+str(timestr)+'/chain.npz')
+	chain = load_chain(result_dir+str(timestr))
 	if paramstr=='template_amplitudes':
 		listsamp = chain[paramstr][-nsamp:, band, template_idx]
 	else:
@@ -52,7 +52,7 @@ class pcat_test_suite():
 
 		_, filepath, _ = load_param_dict(ob.gdat.timestr, result_path=self.result_path)
 		timestr = ob.gdat.timestr
-		chain = np.load(filepath+'/chain.npz')
+		chain = load_chain(filepath)
 
 		nb = 0 
 		for band in [band0, band1, band2]:
@@ -245,7 +245,7 @@ class pcat_test_suite():
 			timestr = ob.gdat.timestr
 
 		# use filepath from the last iteration to load estiamte of median background estimate
-		chain = np.load(filepath+'/chain.npz')
+		chain = load_chain(filepath)
 		median_fc = np.median(chain['fourier_coeffs'][-nlast_fc:], axis=0)
 		last_bkg_sample_250 = chain['bkg'][-1,0]
 